@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import deque
+
+import telebot
+from telebot import types
+
+
+class AdminLogQueue:
+    """
+    Delivery of the request logs to admin off the request path.
+
+    Handlers only put the logs to the queue, the background thread joins them into digest messages and sends them
+    every `flush_interval` seconds, or earlier when the digest reaches the max message length. So a request doesn't
+    wait for one more API call, and the admin chat gets a few messages a minute instead of one per request, staying
+    under the Telegram per-chat limit. Photos are sent as albums of up to 10.
+    If the queue holds more than `max_entries` logs, the oldest are dropped and the next digest says how many.
+    A digest, which Telegram rejects because of the HTML markup, is sent again as plain text.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, chat_id: int, flush_interval: float = 5, max_entries: int = 500,
+                 max_message_length: int = 4096, max_retries: int = 3):
+        """
+        :param flush_interval: Send the collected logs every n seconds
+        :param max_entries: Max number of logs and photos in the queue
+        :param max_message_length: Max length of one digest message (4096 is the Telegram limit)
+        :param max_retries: How many times to retry a message after 429 Too Many Requests
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.max_message_length = max_message_length
+        self.max_retries = max_retries
+
+        self.entries = deque()  # HTML texts
+        self.photos = deque()  # (photo, caption)
+        self.pending_length = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.send_lock = threading.Lock()  # digests are sent in order by one thread at a time
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _drop_overflow(self) -> None:
+        while len(self.entries) + len(self.photos) > self.max_entries:
+            if self.entries:
+                self.pending_length -= len(self.entries.popleft()) + 2
+            else:
+                self.photos.popleft()
+            self.dropped += 1
+
+    def add(self, text: str) -> None:
+        """Queue a log message (HTML)."""
+        with self.condition:
+            self.entries.append(text)
+            self.pending_length += len(text) + 2
+            self._drop_overflow()
+            if self.pending_length >= self.max_message_length:
+                self.condition.notify()
+
+    def add_photo(self, photo: str, caption: str = None) -> None:
+        """Queue a photo (file id or URL) with a caption."""
+        with self.condition:
+            self.photos.append((photo, caption))
+            self._drop_overflow()
+            if len(self.photos) >= 10:
+                self.condition.notify()
+
+    def _take_batch(self) -> tuple:
+        with self.condition:
+            entries, photos, dropped = list(self.entries), list(self.photos), self.dropped
+            self.entries.clear()
+            self.photos.clear()
+            self.pending_length = 0
+            self.dropped = 0
+        return entries, photos, dropped
+
+    def _build_messages(self, entries: list, dropped: int) -> list:
+        """Join the logs into messages not longer than `max_message_length`."""
+        if dropped:
+            entries = [f"⚠️ Пропущено логов: {dropped} (очередь переполнена)"] + entries
+
+        messages = []
+        current = ""
+        for entry in entries:
+            if len(entry) > self.max_message_length:  # Слишком длинный лог режем отдельно
+                if current:
+                    messages.append(current)
+                    current = ""
+                messages.extend(telebot.util.smart_split(entry, self.max_message_length))
+            elif current and len(current) + 2 + len(entry) > self.max_message_length:
+                messages.append(current)
+                current = entry
+            else:
+                current = f"{current}\n\n{entry}" if current else entry
+        if current:
+            messages.append(current)
+        return messages
+
+    def _call(self, function, *args, **kwargs) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                function(*args, **kwargs)
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 400 and kwargs.get("parse_mode") is not None:
+                    # Текст юзера в логе сломал HTML-разметку - отправляем дайджест без нее, а не теряем его
+                    print(f"\nОшибка разметки логов админу, отправляю без нее: {e}")
+                    self._call(function, *args, **dict(kwargs, parse_mode=None))
+                    return
+                if e.error_code != 429 or attempt == self.max_retries:
+                    print(f"\nОшибка отправки логов админу: {e}")
+                    return
+                time.sleep((e.result_json.get("parameters") or {}).get("retry_after", 1))
+            except Exception as e:
+                print(f"\nОшибка отправки логов админу: {e}")
+                return
+
+    def flush(self) -> None:
+        """Send all queued logs now."""
+        with self.send_lock:
+            entries, photos, dropped = self._take_batch()
+            for text in self._build_messages(entries, dropped):
+                self._call(self.bot.send_message, self.chat_id, text, parse_mode="HTML")
+
+            for i in range(0, len(photos), 10):
+                album = photos[i:i + 10]
+                if len(album) == 1:
+                    self._call(self.bot.send_photo, self.chat_id, album[0][0], caption=album[0][1])
+                else:
+                    self._call(self.bot.send_media_group, self.chat_id,
+                               [types.InputMediaPhoto(photo, caption=caption) for photo, caption in album])
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+            self.flush()
+
+    def start(self) -> None:
+        """Start the background thread, which sends the logs."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="AdminLogQueue", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        """Stop the background thread and send the rest of the logs."""
+        self._stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,347 @@
+"""
+Asyncio entry point of the bot: `python async_main.py`
+
+Chat requests (plain text messages and `/pro`) are served natively on `AsyncTeleBot` and `AsyncOpenAI`, so one
+process keeps hundreds of LLM calls in flight without a thread per request. All other updates (commands, callbacks,
+photos, voices, `/announce` dialog steps) are passed to the same sync handlers from `main.py`, which run in a thread pool.
+All updates of a user, async and sync, are processed strictly in the order they came.
+The blocking parts of the chat requests (checks, context, billing) run in threads, not on the event loop.
+"""
+import asyncio
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager
+
+import openai
+import telebot
+from openai import AsyncOpenAI
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.util import extract_command
+
+import main
+from resilience import CircuitOpenError
+from streaming import StreamingMessageBuffer, get_chunk_content, get_chunk_usage_tokens
+from workers import get_update_order_key
+
+
+ASYNC_MAX_IN_FLIGHT = 500  # max number of chat requests processed at the same time
+POLLING_TIMEOUT = 20  # long polling timeout in seconds
+
+if os.getenv("TELEGRAM_API_URL"):
+    asyncio_helper.API_URL = os.getenv("TELEGRAM_API_URL")
+if os.getenv("TELEGRAM_FILE_URL"):
+    asyncio_helper.FILE_URL = os.getenv("TELEGRAM_FILE_URL")
+
+async_bot = AsyncTeleBot(os.getenv("TELEGRAM_API_KEY"))
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=main.OPENAI_TIMEOUT, max_retries=0)  # Повторы делает main.openai_caller
+
+# Команды, для которых в main.py есть отдельные обработчики. Остальной текст (в т.ч. /pro) уходит в handle_message
+SYNC_COMMANDS = {command for handler in main.bot.message_handlers for command in (handler["filters"].get("commands") or [])}
+
+bot_id = None  # id of the bot user, filled on start
+stop_event = asyncio.Event()
+in_flight = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+user_locks = {}  # user_id -> [asyncio.Lock, number of updates using it], to keep the order of updates of the same user
+tasks = set()
+# Синхронные обработчики из main.py (войсы, фото, команды) выполняются здесь, а не в пуле main.bot - порядок держат user_locks
+sync_executor = ThreadPoolExecutor(max_workers=max(main.BOT_WORKERS, 1), thread_name_prefix="SyncHandler")
+
+
+def is_async_chat_message(message: types.Message) -> bool:
+    """
+    Check if the message is a chat request, which `main.handle_message` would process, and can be served natively by asyncio.
+    """
+    if message is None or message.content_type != "text":
+        return False
+
+    # Админ посреди диалога /announce - сообщение должен получить зарегистрированный next step обработчик
+    if message.chat.id in main.bot.next_step_backend.handlers:
+        return False
+
+    return extract_command(message.text) not in SYNC_COMMANDS
+
+
+async def async_send_smart_split_message(chat_id: int, text: str, max_length: int = 4096, parse_mode: str = None,
+                                         reply_to_message_id: int = None) -> None:
+    """
+    Async version of `main.send_smart_split_message`.
+    """
+    reply_parameters = None if reply_to_message_id is None else types.ReplyParameters(reply_to_message_id, allow_sending_without_reply=True)
+
+    for chunk in telebot.util.smart_split(text, max_length):
+        await async_bot.send_message(chat_id, chunk, parse_mode=parse_mode, reply_parameters=reply_parameters)
+
+
+async def async_apply_streaming_operation(chat_id: int, message_ids: list, operation: tuple, parse_mode: str = None,
+                                         reply_parameters: types.ReplyParameters = None) -> None:
+    """
+    Async version of `main.apply_streaming_operation`.
+    """
+    action, index, text = operation
+    try:
+        if action == "send":
+            message_ids.append((await async_bot.send_message(chat_id, text, parse_mode=parse_mode, reply_parameters=reply_parameters)).message_id)
+        else:
+            await async_bot.edit_message_text(text, chat_id, message_ids[index], parse_mode=parse_mode)
+    except asyncio_helper.ApiTelegramException as e:
+        if "message is not modified" in e.description:
+            return
+        if parse_mode is not None:  # Ошибка форматирования - отправляем без него
+            await async_apply_streaming_operation(chat_id, message_ids, operation, reply_parameters=reply_parameters)
+        elif action == "send":
+            raise
+        else:
+            print(f"\nНе удалось обновить сообщение со стримом ответа: {e}")
+
+
+async def async_send_streaming_chatgpt_response(message: types.Message, messages: list, lang_model: str) -> tuple:
+    """
+    Async version of `main.send_streaming_chatgpt_response`.
+    Returns the response text, the number of request tokens and whether the answer is complete.
+    """
+    chat_id = message.chat.id
+    if message.chat.type == "private":
+        reply_parameters = None
+        edit_interval = main.STREAM_EDIT_INTERVAL
+    else:
+        reply_parameters = types.ReplyParameters(message.message_id, allow_sending_without_reply=True)
+        edit_interval = main.STREAM_GROUP_EDIT_INTERVAL
+
+    buffer = StreamingMessageBuffer(edit_interval=edit_interval)
+    message_ids = []
+    request_tokens = None
+    is_complete = True
+    started = time.perf_counter()
+
+    stream = main.openai_caller.call_stream_async(
+        lang_model,
+        async_client.chat.completions.create,
+        model=lang_model,
+        max_tokens=main.MAX_REQUEST_TOKENS,
+        messages=messages,
+        stream=True,
+        extra_body={"stream_options": {"include_usage": True}}
+    )
+    try:
+        async with aclosing(stream):  # Слот модели освобождается и при ошибке Telegram посреди стрима
+            async for chunk in stream:
+                usage_tokens = get_chunk_usage_tokens(chunk)
+                if usage_tokens is not None:
+                    request_tokens = usage_tokens
+
+                for operation in buffer.feed(get_chunk_content(chunk)):
+                    await async_apply_streaming_operation(chat_id, message_ids, operation, reply_parameters=reply_parameters)
+                    if operation[0] == "send" and len(message_ids) == 1:  # Юзер увидел начало ответа
+                        main.metrics.observe("first_token", time.perf_counter() - started, lang_model)
+
+        for operation in buffer.finish():
+            await async_apply_streaming_operation(chat_id, message_ids, operation, parse_mode="Markdown", reply_parameters=reply_parameters)
+    except Exception as e:
+        if not message_ids:  # Юзер еще ничего не получил - обычная ошибка запроса
+            raise
+        # Часть ответа уже у юзера: не шлем ему общую ошибку, а списываем токены за полученную часть
+        print(f"\nСтрим ответа прервался после {len(buffer.text)} символов: {e}")
+        is_complete = False
+        try:  # Досылаем то, что успели получить
+            for operation in buffer.finish():
+                await async_apply_streaming_operation(chat_id, message_ids, operation, reply_parameters=reply_parameters)
+        except Exception as e:
+            print(f"\nНе удалось дослать прерванный ответ: {e}")
+
+    if request_tokens is None:
+        request_tokens = await asyncio.to_thread(main.estimate_request_tokens, messages, buffer.text, lang_model)
+
+    return buffer.text, request_tokens, is_complete
+
+
+async def handle_chat_message(message: types.Message) -> None:
+    """
+    Async version of `main.handle_message` for text messages. Uses the same checks, billing and reports.
+    """
+    request_started = time.perf_counter()
+    user_model, refusal = await asyncio.to_thread(main.check_chat_request, message, bot_id)
+    main.metrics.observe("check", time.perf_counter() - request_started, user_model or "")
+    if user_model is None:
+        if refusal is not None:
+            await async_bot.reply_to(message, refusal["text"], parse_mode=refusal["parse_mode"])
+        return
+
+    # Симулируем эффект набора текста, пока бот получает ответ
+    with main.metrics.timer("chat_action", user_model):
+        await async_bot.send_chat_action(message.chat.id, "typing")
+
+    messages, is_user_chat_context_enabled = await asyncio.to_thread(main.prepare_chat_request_messages, message, user_model)
+    cached_response = await asyncio.to_thread(main.get_cached_chatgpt_response, messages, user_model, is_user_chat_context_enabled)
+    is_response_sent = False
+    is_response_complete = True  # Прерванный стрим не кэшируем
+
+    openai_started = time.perf_counter()
+    try:
+        if cached_response is not None:
+            response_content = cached_response["content"]
+            request_tokens = cached_response["tokens"] if main.RESPONSE_CACHE_BILL_HITS else 0
+        elif main.STREAM_RESPONSES:
+            response_content, request_tokens, is_response_complete = await async_send_streaming_chatgpt_response(message, messages, user_model)
+            is_response_sent = True
+        else:
+            response = await main.openai_caller.call_async(
+                user_model,
+                async_client.chat.completions.create,
+                model=user_model,
+                max_tokens=main.MAX_REQUEST_TOKENS,
+                messages=messages
+            )
+            request_tokens = response.usage.total_tokens
+            response_content = response.choices[0].message.content
+    except CircuitOpenError:
+        await async_bot.reply_to(message, "Серверы OpenAI сейчас недоступны. Пожалуйста, повторите запрос через минуту")
+        return
+    except openai.RateLimitError:
+        print("\nЛимит запросов! Или закончились деньги на счету OpenAI")
+        await async_bot.reply_to(message, "Превышен лимит запросов. Пожалуйста, повторите попытку позже")
+        return
+    except Exception as e:
+        print("\nОшибка при запросе по API, OpenAI сбоит! (или же вы не привязали карту на сайте OpenAI)")
+        await async_bot.reply_to(message, "Произошла ошибка на серверах OpenAI.\n"
+                                          "Пожалуйста, попробуйте еще раз или повторите запрос позже")
+        print(e)
+        return
+
+    if cached_response is None:  # При стриминге сюда входит и отправка ответа юзеру
+        main.metrics.observe("openai", time.perf_counter() - openai_started, user_model)
+
+    with main.metrics.timer("persist", user_model):
+        admin_log = await asyncio.to_thread(main.finish_chat_request, message, user_model, request_tokens, response_content,
+                                            is_user_chat_context_enabled, is_cached=cached_response is not None)
+
+    # В групповом чате отвечать на конкретное сообщение, а не просто отправлять сообщение в чат
+    reply_to_message_id = message.message_id if message.chat.type != "private" else None
+    if not is_response_sent:  # При стриминге ответ уже у юзера
+        with main.metrics.timer("telegram_send", user_model):
+            try:
+                await async_send_smart_split_message(message.chat.id, response_content, parse_mode="Markdown", reply_to_message_id=reply_to_message_id)
+            except asyncio_helper.ApiTelegramException as e:
+                print(f"\nОшибка отправки из-за форматирования, отправляю без него.\nТекст ошибки: {e}")
+                await async_send_smart_split_message(message.chat.id, response_content, reply_to_message_id=reply_to_message_id)
+
+    if cached_response is None and is_response_complete:
+        await asyncio.to_thread(main.cache_chatgpt_response, messages, user_model, is_user_chat_context_enabled, response_content, request_tokens)
+
+    print("\n" + admin_log)
+
+    # Отправляем лог работы админу в тг (в фоне, вместе с другими логами)
+    if message.chat.id != main.ADMIN_ID:
+        main.admin_logs.add(admin_log)
+
+    main.metrics.observe("total", time.perf_counter() - request_started, user_model)
+
+
+@asynccontextmanager
+async def user_order(key):
+    """Let the updates with the same key (user) in one at a time, in the order they came. `None` - no ordering."""
+    if key is None:
+        yield
+        return
+
+    lock_entry = user_locks.setdefault(key, [asyncio.Lock(), 0])
+    lock_entry[1] += 1
+    try:
+        async with lock_entry[0]:
+            yield
+    finally:
+        lock_entry[1] -= 1
+        if lock_entry[1] == 0:
+            del user_locks[key]
+
+
+def process_sync_update(update: types.Update) -> None:
+    if hasattr(main.bot, "process_new_updates_inline"):
+        main.bot.process_new_updates_inline([update])
+    else:  # BOT_WORKERS = 0: обычный TeleBot сам раздает апдейты своим потокам, порядок не гарантируется
+        main.bot.process_new_updates([update])
+
+
+async def process_update(update: types.Update) -> None:
+    message = update.message
+    key = get_update_order_key(message or update.callback_query or update.edited_message)
+
+    try:
+        async with user_order(key):  # Апдейты одного юзера обрабатываются строго по очереди
+            # Проверяем здесь, а не при получении: предыдущий апдейт юзера мог зарегистрировать next step обработчик
+            if is_async_chat_message(message):
+                async with in_flight:
+                    await handle_chat_message(message)
+            else:  # Остальные апдейты уходят в синхронные обработчики из main.py
+                await asyncio.get_running_loop().run_in_executor(sync_executor, process_sync_update, update)
+    except Exception as e:
+        print(f"\nОшибка при обработке апдейта {update.update_id}: {e}")
+
+
+def dispatch_update(update: types.Update) -> None:
+    task = asyncio.create_task(process_update(update))
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+    message = update.message
+    if message is not None and message.from_user.id == main.ADMIN_ID and extract_command(message.text) == "stop":
+        stop_event.set()
+
+
+async def poll_updates() -> None:
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = await async_bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, request_timeout=POLLING_TIMEOUT + 10)
+        except Exception as e:
+            print(f"\nОшибка получения апдейтов: {e}")
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            dispatch_update(update)
+
+
+async def run() -> None:
+    global bot_id
+    bot_id = (await async_bot.get_me()).id
+    await async_bot.remove_webhook()  # Пока установлен вебхук main.py, getUpdates не работает
+
+    loop = asyncio.get_running_loop()
+    for signal_name in ("SIGINT", "SIGTERM"):
+        if hasattr(signal, signal_name):
+            try:
+                loop.add_signal_handler(getattr(signal, signal_name), stop_event.set)
+            except NotImplementedError:  # Windows
+                pass
+
+    polling_task = asyncio.create_task(poll_updates())
+    await stop_event.wait()
+    polling_task.cancel()
+
+    # Дожидаемся уже начатых запросов
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await async_bot.close_session()
+
+
+if __name__ == '__main__':
+    print("---работаем (asyncio)---")
+    asyncio.run(run())
+    sync_executor.shutdown()
+    main.bot.stop_bot()  # Дожидаемся обработки уже полученных сообщений
+    main.broadcaster.stop()  # Незаконченная рассылка продолжится при следующем запуске
+    main.summary_executor.shutdown(cancel_futures=True)  # Дожидаемся начатых пересказов, остальные сделаем в следующий раз
+    main.transcoder.close()
+    main.telegram_cache.close()
+    main.admin_logs.close()  # Досылаем накопившиеся логи
+    main.chat_context.close()  # Дописываем несохраненный контекст диалогов
+
+    # Сбрасываем журнал в основной файл, делаем бэкап бд и уведомляем админа об успешном завершении работы
+    main.user_store.export_json(main.BACKUPFILE)
+    main.user_store.close()
+    main.bot.send_message(main.ADMIN_ID, "Бот остановлен")
+    print("\n---работа завершена---")
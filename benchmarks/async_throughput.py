@@ -0,0 +1,74 @@
+"""
+Offline throughput test of the asyncio mode (`async_main.py`) against the stub Telegram + OpenAI server.
+
+Usage: python benchmarks/async_throughput.py [--users 200] [--messages 2] [--latency 1.0]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_server import StubServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="number of users sending messages at the same time")
+    parser.add_argument("--messages", type=int, default=2, help="messages per user")
+    parser.add_argument("--latency", type=float, default=1.0, help="latency of the stub chat completion in seconds")
+    args = parser.parse_args()
+
+    server = StubServer(chat_latency=args.latency).start()
+    admin_id = 1_000_000
+    os.environ.update(server.environ())
+    os.environ.update({"OPENAI_API_KEY": "stub", "TELEGRAM_API_KEY": "123:stub", "ADMIN_ID": str(admin_id)})
+
+    # Бот пишет data.json и контекст в текущую директорию - работаем во временной
+    os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+    import async_main
+    bot_main = async_main.main
+
+    user_ids = list(range(1, args.users + 1))
+    for user_id in user_ids:
+        bot_main.add_new_user(user_id, f"User{user_id}", f"user{user_id}")
+
+    total = args.users * args.messages
+    pushed_at = {}
+    for i in range(args.messages):
+        for user_id in user_ids:
+            pushed_at[server.state.push_message(user_id, f"message {i}")] = time.monotonic()
+
+    async def run_until_done():
+        runner = asyncio.create_task(async_main.run())
+        # На каждый запрос бот отправляет ответ юзеру (логи админу уходят сводками и не считаются)
+        await asyncio.to_thread(server.state.wait_sent, total, "sendMessage", 600, admin_id)
+        async_main.stop_event.set()
+        await runner
+
+    started = time.monotonic()
+    asyncio.run(run_until_done())
+    elapsed = time.monotonic() - started
+
+    first_push = min(pushed_at.values())
+    answers = [sent_time - first_push for sent_time, method, params in server.state.sent
+               if method == "sendMessage" and int(params.get("chat_id")) != admin_id]
+    answers.sort()
+    quantiles = statistics.quantiles(answers, n=100)
+
+    print(f"\nЗапросов: {total}, пользователей: {args.users}, задержка OpenAI: {args.latency} с")
+    print(f"Время: {elapsed:.2f} с, пропускная способность: {total / elapsed:.1f} запросов/с")
+    print(f"Время до ответа p50: {quantiles[49]:.2f} с, p95: {quantiles[94]:.2f} с, p99: {quantiles[98]:.2f} с")
+
+    bot_main.bot.stop_bot()
+    bot_main.user_store.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
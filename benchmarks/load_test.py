@@ -0,0 +1,269 @@
+"""
+Offline load test of the bot handlers (`main.py`) against the stub Telegram + OpenAI server.
+
+Synthetic users send a mix of text messages, voice messages, photos with captions and /imagine requests. The bot gets
+them by long polling and processes them with its real handlers, as in production. The report shows the throughput,
+the latency of each request type (from the moment the update is queued until its handler finishes), the latency
+of the request phases (`main.metrics`) and the file I/O of the user data and chat context per request.
+
+Usage: python benchmarks/load_test.py [--users 100] [--messages 3] [--mix text=70,voice=10,photo=10,image=10]
+                                      [--context-users 0.5] [--latency 1.0] [--tokens 150]
+"""
+import argparse
+import functools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_server import StubServer
+
+REQUEST_TYPES = ("text", "voice", "photo", "image")
+
+
+def parse_mix(mix: str) -> dict:
+    """Parse `text=70,voice=10` into `{"text": 70, "voice": 10}`."""
+    weights = {}
+    for part in mix.split(","):
+        request_type, _, weight = part.partition("=")
+        if request_type.strip() not in REQUEST_TYPES:
+            raise argparse.ArgumentTypeError(f"Unknown request type {request_type!r}, expected one of {', '.join(REQUEST_TYPES)}")
+        weights[request_type.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile (0-100) of the values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+class FileIOCounter:
+    """
+    Counts file I/O of the bot in the working directory with an audit hook: opens for reading and writing,
+    and the bytes written (atomic rewrites by the size of the replaced file, appends by the growth of the file,
+    also of the files which were already open for appending, like the journal). Files are grouped by `classify(path)`.
+    """
+
+    def __init__(self, root: str, classify):
+        self.root = os.path.abspath(root)
+        self.classify = classify
+        self.lock = threading.Lock()
+        self.reads = Counter()
+        self.writes = Counter()
+        self.written_bytes = Counter()
+        self.sizes = {}  # path -> (group, size when counting started or before the first append)
+        self.replaced = set()  # paths rewritten with os.replace(), their growth is already counted
+        self.is_enabled = False
+        sys.addaudithook(self._hook)
+
+    def _group(self, path) -> str:
+        if not isinstance(path, str):
+            return None
+        path = os.path.abspath(path)
+        if not path.startswith(self.root):
+            return None
+        return self.classify(os.path.relpath(path, self.root))
+
+    def _hook(self, event: str, args: tuple) -> None:
+        if not self.is_enabled or event not in ("open", "os.rename"):
+            return
+        group = self._group(args[0] if event == "open" else args[1])
+        if group is None:
+            return
+
+        with self.lock:
+            if event == "os.rename":  # os.replace() временного файла - файл переписан целиком
+                self.replaced.add(os.path.abspath(args[1]))
+                try:
+                    self.written_bytes[group] += os.path.getsize(args[0])
+                except OSError:
+                    pass
+            elif args[1] is not None and any(flag in str(args[1]) for flag in "wax+"):
+                self.writes[group] += 1
+                path = os.path.abspath(args[0])
+                if "a" in str(args[1]) and path not in self.sizes:
+                    self.sizes[path] = (group, os.path.getsize(path) if os.path.exists(path) else 0)
+            else:
+                self.reads[group] += 1
+
+    def start(self) -> None:
+        for folder, _, files in os.walk(self.root):
+            for file_name in files:
+                path = os.path.join(folder, file_name)
+                group = self._group(path)
+                if group is not None:
+                    self.sizes[path] = (group, os.path.getsize(path))
+        self.is_enabled = True
+
+    def stop(self) -> dict:
+        """Stop counting and return `{group: (read opens, write opens, written bytes)}`."""
+        self.is_enabled = False
+        written_bytes = Counter(self.written_bytes)
+        for path, (group, initial_size) in self.sizes.items():
+            if path not in self.replaced and os.path.exists(path):
+                written_bytes[group] += max(0, os.path.getsize(path) - initial_size)
+        groups = set(self.reads) | set(self.writes) | set(written_bytes)
+        return {group: (self.reads[group], self.writes[group], written_bytes[group]) for group in sorted(groups)}
+
+
+class HandlerTimer:
+    """
+    Wraps the message handlers of the bot to record when each pushed update was processed.
+    """
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.condition = threading.Condition()
+        self.pushed_at = {}  # message_id -> (request type, time the update was queued)
+        self.results = []  # (request type, latency, error)
+
+    def push(self, message_id: int, request_type: str) -> None:
+        self.pushed_at[message_id] = (request_type, time.monotonic())
+
+    def instrument(self, bot) -> None:
+        for handler in bot.message_handlers:
+            handler["function"] = self._wrap(handler["function"])
+
+    def _wrap(self, function):
+        @functools.wraps(function)
+        def timed_handler(message, *args, **kwargs):
+            error = None
+            try:
+                return function(message, *args, **kwargs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                pushed = self.pushed_at.pop(message.message_id, None)
+                if pushed is not None:
+                    with self.condition:
+                        self.results.append((pushed[0], time.monotonic() - pushed[1], error))
+                        self.condition.notify_all()
+        return timed_handler
+
+    def wait(self, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.results) >= self.expected, timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="number of synthetic users")
+    parser.add_argument("--messages", type=int, default=3, help="requests per user")
+    parser.add_argument("--mix", type=parse_mix, default="text=70,voice=10,photo=10,image=10", help="weights of the request types")
+    parser.add_argument("--context-users", type=float, default=0.5, help="share of users with the extended chat context enabled")
+    parser.add_argument("--latency", type=float, default=1.0, help="latency of the stub OpenAI requests in seconds")
+    parser.add_argument("--tokens", type=int, default=150, help="total tokens reported by the stub for a chat request")
+    parser.add_argument("--timeout", type=float, default=600, help="max seconds to wait for all requests")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the request mix")
+    args = parser.parse_args()
+
+    server = StubServer(chat_latency=args.latency, prompt_tokens=args.tokens // 3,
+                        completion_tokens=args.tokens - args.tokens // 3).start()
+    admin_id = 1_000_000
+    os.environ.update(server.environ())
+    os.environ.update({"OPENAI_API_KEY": "stub", "TELEGRAM_API_KEY": "123:stub", "ADMIN_ID": str(admin_id)})
+
+    # Бот пишет data.json и контекст в текущую директорию - работаем во временной
+    work_dir = tempfile.mkdtemp(prefix="bot-load-")
+    os.chdir(work_dir)
+    import main as bot_main
+
+    context_folder = os.path.normpath(bot_main.CHAT_CONTEXT_FOLDER)
+    data_files = {bot_main.DATAFILE, bot_main.JOURNALFILE, bot_main.SQLITE_DATAFILE}
+
+    def classify(path: str) -> str:
+        if path.startswith(context_folder + os.sep):
+            return "context"
+        if any(path.startswith(data_file) for data_file in data_files):
+            return "data"
+        return "other"
+
+    io_counter = FileIOCounter(work_dir, classify)
+
+    random.seed(args.seed)
+    user_ids = list(range(1, args.users + 1))
+    for user_id in user_ids:
+        bot_main.add_new_user(user_id, f"User{user_id}", f"user{user_id}")
+        bot_main.user_store.update(user_id, {"balance": 10 ** 9, "premium_balance": 10 ** 9, "image_balance": 10 ** 6})
+        if random.random() < args.context_users:
+            bot_main.user_store.set(user_id, "max_context_length", 5000)
+
+    total = args.users * args.messages
+    timer = HandlerTimer(total)
+    timer.instrument(bot_main.bot)
+
+    request_types = random.choices(list(args.mix), weights=list(args.mix.values()), k=total)
+    io_counter.start()
+    started = time.monotonic()
+    for i, request_type in enumerate(request_types):
+        user_id = user_ids[i % len(user_ids)]
+        if request_type == "voice":
+            update_id = server.state.push_voice(user_id, duration=5)
+        elif request_type == "photo":
+            update_id = server.state.push_photo(user_id, "Что на картинке?")
+        elif request_type == "image":
+            update_id = server.state.push_message(user_id, f"/img кот в космосе {i}")
+        else:
+            update_id = server.state.push_message(user_id, f"message {i}")
+        timer.push(update_id, request_type)
+
+    polling = threading.Thread(target=bot_main.bot.infinity_polling, kwargs={"timeout": 10, "long_polling_timeout": 1}, daemon=True)
+    polling.start()
+    is_finished = timer.wait(args.timeout)
+    elapsed = time.monotonic() - started
+
+    bot_main.bot.stop_polling()
+    polling.join()
+    bot_main.bot.stop_bot()
+    bot_main.chat_context.close()  # Отложенная запись контекста тоже считается в I/O
+    io_stats = io_counter.stop()
+
+    # Отчет
+    completed = len(timer.results)
+    errors = sum(1 for _, _, error in timer.results if error is not None)
+    print(f"\nЗапросов: {total} ({', '.join(f'{t} {n}' for t, n in Counter(request_types).items())}), "
+          f"пользователей: {args.users}, задержка OpenAI: {args.latency} с")
+    if not is_finished:
+        print(f"Не дождались {total - completed} запросов за {args.timeout} с")
+    print(f"Время: {elapsed:.2f} с, пропускная способность: {completed / elapsed:.1f} запросов/с, ошибок: {errors}")
+
+    latencies = defaultdict(list)
+    for request_type, latency, _ in timer.results:
+        latencies[request_type].append(latency)
+        latencies["всего"].append(latency)
+    print(f"\nВремя обработки, с:\n{'тип':<8} {'n':>6} {'p50':>7} {'p95':>7} {'p99':>7}")
+    for request_type in REQUEST_TYPES + ("всего",):
+        values = latencies[request_type]
+        if not values:
+            continue
+        print(f"{request_type:<8} {len(values):>6} {percentile(values, 50):>7.2f} {percentile(values, 95):>7.2f} {percentile(values, 99):>7.2f}")
+
+    print(f"\nЭтапы обработки, мс:\n{'этап':<14} {'модель':<20} {'n':>6} {'p50':>7} {'p95':>7} {'p99':>7}")
+    for phase, model, count, p50, p95, p99, _ in bot_main.metrics.summary():
+        print(f"{phase:<14} {model:<20} {count:>6} {p50 * 1000:>7.0f} {p95 * 1000:>7.0f} {p99 * 1000:>7.0f}")
+
+    print("\nФайловый I/O на запрос:")
+    for group, (reads, writes, written_bytes) in io_stats.items():
+        print(f"{group:<8} открытий на чтение {reads / max(completed, 1):.2f}, на запись {writes / max(completed, 1):.2f}, "
+              f"записано {written_bytes / max(completed, 1) / 1024:.1f} КБ")
+
+    print(f"\nЗапросов к OpenAI: {dict(server.state.openai_endpoints)}")
+
+    bot_main.transcoder.close()
+    bot_main.admin_logs.close()
+    bot_main.user_store.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""
+Stub HTTP server, which stands in for both the Telegram Bot API and the OpenAI API, so the bot can be load tested offline.
+
+Point the bot to it with the environment variables:
+    TELEGRAM_API_URL=http://127.0.0.1:<port>/bot{0}/{1}
+    TELEGRAM_FILE_URL=http://127.0.0.1:<port>/file/bot{0}/{1}
+    OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubState:
+    """
+    Shared state of the stub server: the queue of updates for `getUpdates`, the files for `getFile`
+    and the log of the messages sent by the bot.
+    """
+
+    def __init__(self, chat_latency: float = 0.5, completion_tokens: int = 100, prompt_tokens: int = 50, stream_chunks: int = 10,
+                 vision_latency: float = None, image_latency: float = None, audio_latency: float = None):
+        self.chat_latency = chat_latency  # seconds to wait before answering /v1/chat/completions (with stream - spread over the chunks)
+        self.vision_latency = chat_latency if vision_latency is None else vision_latency  # chat completions with images
+        self.image_latency = chat_latency if image_latency is None else image_latency  # /v1/images/generations
+        self.audio_latency = chat_latency if audio_latency is None else audio_latency  # /v1/audio/transcriptions
+        self.stream_chunks = stream_chunks  # number of text chunks in the streamed answer
+        self.completion_tokens = completion_tokens
+        self.prompt_tokens = prompt_tokens
+
+        self.lock = threading.Condition()
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.files = {}  # file_id -> content
+        self.sent = []  # (time, method, params) of every bot API call except getUpdates
+        self.openai_requests = 0
+        self.openai_endpoints = Counter()  # "chat", "vision", "images", "audio" -> number of requests
+
+    def push_message(self, user_id: int, text: str = None, chat_id: int = None, **extra) -> int:
+        """Add an incoming message (text, or any other content passed in `extra`) to the updates queue. Returns the update id."""
+        with self.lock:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            message = {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id or user_id, "type": "private" if (chat_id or user_id) > 0 else "group", "title": "stub chat"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+            }
+            if text is not None:
+                message["text"] = text
+                if text.startswith("/"):
+                    message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            message.update(extra)
+            self.updates.append({"update_id": update_id, "message": message})
+            self.lock.notify_all()
+            return update_id
+
+    def add_file(self, content: bytes) -> str:
+        """Store a file, which the bot can get with `getFile` and download. Returns the file id."""
+        with self.lock:
+            file_id = f"stub-file-{len(self.files) + 1}"
+            self.files[file_id] = content
+            return file_id
+
+    def push_photo(self, user_id: int, caption: str, file_size: int = 100_000, chat_id: int = None) -> int:
+        """Add an incoming photo with a caption in three sizes (like Telegram sends them). Returns the update id."""
+        sizes = []
+        for width, height in ((90, 68), (800, 600), (1280, 960)):
+            size = file_size * width * height // (1280 * 960)
+            file_id = self.add_file(b"\xff\xd8" + b"\0" * size)
+            sizes.append({"file_id": file_id, "file_unique_id": file_id, "width": width, "height": height, "file_size": size + 2})
+        return self.push_message(user_id, chat_id=chat_id, photo=sizes, caption=caption)
+
+    def push_voice(self, user_id: int, duration: int = 5, chat_id: int = None) -> int:
+        """Add an incoming voice message (OGG, ~4 KB per second). Returns the update id."""
+        content = b"OggS" + b"\0" * (duration * 4000)
+        file_id = self.add_file(content)
+        return self.push_message(user_id, chat_id=chat_id, voice={
+            "file_id": file_id, "file_unique_id": file_id, "duration": duration, "mime_type": "audio/ogg", "file_size": len(content)
+        })
+
+    def get_updates(self, offset: int, timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            return self.updates[:100]
+
+    def record(self, method: str, params: dict) -> int:
+        with self.lock:
+            self.sent.append((time.monotonic(), method, params))
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.lock.notify_all()
+            return message_id
+
+    def wait_sent(self, count: int, method: str = "sendMessage", timeout: float = 60, exclude_chat_id: int = None) -> bool:
+        """Wait until the bot calls `method` at least `count` times (not counting the calls to `exclude_chat_id`)."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while sum(1 for _, sent_method, params in self.sent if sent_method == method
+                      and (exclude_chat_id is None or str(params.get("chat_id")) != str(exclude_chat_id))) < count:
+                if time.monotonic() >= deadline:
+                    return False
+                self.lock.wait(deadline - time.monotonic())
+            return True
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_params(self) -> dict:
+        parsed = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length)
+            content_type = self.headers.get("Content-Type", "")
+            if "application/json" in content_type:
+                params.update(json.loads(body))
+            elif "application/x-www-form-urlencoded" in content_type:
+                params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+        return params
+
+    def _send_json(self, content: dict, status: int = 200) -> None:
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event_stream(self, events: list, delay: float) -> None:
+        """Send server-sent events with chunked transfer encoding, waiting `delay` seconds before each event."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in events + ["[DONE]"]:
+            time.sleep(delay)
+            data = f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        path = urlparse(self.path).path
+        params = self._read_params()
+
+        if path.startswith("/v1/"):
+            self._handle_openai(path[len("/v1/"):], params)
+        elif path.startswith("/file/bot"):
+            self._handle_file(path.rsplit("/", 1)[-1])
+        elif path.startswith("/bot"):
+            self._handle_telegram(path.rsplit("/", 1)[-1], params)
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _handle_telegram(self, method: str, params: dict) -> None:
+        state = self.state
+
+        if method == "getUpdates":
+            updates = state.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+            self._send_json({"ok": True, "result": updates})
+            return
+
+        if method == "getMe":
+            self._send_json({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}})
+            return
+
+        if method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in state.files:
+                self._send_json({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}, 400)
+                return
+            self._send_json({"ok": True, "result": {"file_id": file_id, "file_unique_id": file_id,
+                                                    "file_size": len(state.files[file_id]), "file_path": f"files/{file_id}"}})
+            return
+
+        message_id = state.record(method, params)
+        chat_id = int(params.get("chat_id") or 0)
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"}}
+        if method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            result = dict(message, text=params.get("text", ""))
+        elif method == "sendMediaGroup":
+            media = params.get("media") or "[]"
+            result = [dict(message, message_id=message_id + i) for i in range(len(json.loads(media) if isinstance(media, str) else media))]
+        else:
+            result = True
+        self._send_json({"ok": True, "result": result})
+
+    def _handle_file(self, file_id: str) -> None:
+        content = self.state.files.get(file_id)
+        if content is None:
+            self._send_json({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle_openai(self, endpoint: str, params: dict) -> None:
+        state = self.state
+        is_vision = endpoint == "chat/completions" and any(
+            isinstance(message.get("content"), list) for message in params.get("messages") or [])
+        with state.lock:
+            state.openai_requests += 1
+            state.openai_endpoints["vision" if is_vision else endpoint.split("/")[0]] += 1
+
+        usage = {"prompt_tokens": state.prompt_tokens, "completion_tokens": state.completion_tokens,
+                 "total_tokens": state.prompt_tokens + state.completion_tokens}
+
+        if endpoint == "images/generations":
+            time.sleep(state.image_latency)
+            self._send_json({"created": int(time.time()), "data": [
+                {"url": "https://example.com/stub.png", "revised_prompt": params.get("prompt", "")}
+            ]})
+        elif endpoint == "audio/transcriptions":  # multipart тело не разбираем, ответ всегда один
+            time.sleep(state.audio_latency)
+            self._send_json({"text": "Stub transcription of the voice message"})
+        elif is_vision:
+            time.sleep(state.vision_latency)
+            self._send_json({"id": "chatcmpl-stub", "created": int(time.time()), "model": params.get("model", "stub"),
+                             "object": "chat.completion", "usage": usage, "choices": [
+                                 {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Stub image description"}}
+                             ]})
+        elif endpoint == "chat/completions":
+            content = "Stub answer " * 10
+            base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": params.get("model", "stub")}
+
+            if params.get("stream"):
+                words = content.split(" ")
+                step = max(1, len(words) // state.stream_chunks)
+                events = [dict(base, object="chat.completion.chunk", choices=[
+                    {"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": " ".join(words[i:i + step]) + " "}}
+                ]) for i in range(0, len(words), step)]
+                events[-1]["choices"][0]["finish_reason"] = "stop"
+                if (params.get("stream_options") or {}).get("include_usage"):
+                    events.append(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+                self._send_event_stream(events, state.chat_latency / len(events))
+                return
+
+            time.sleep(state.chat_latency)
+            self._send_json(dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+            ]))
+        else:
+            self._send_json({"error": {"message": f"Unknown endpoint {endpoint}"}}, 404)
+
+
+class StubServer:
+    """
+    Runs the stub Telegram + OpenAI server in a background thread.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **state_kwargs):
+        self.state = StubState(**state_kwargs)
+        handler = type("BoundStubRequestHandler", (StubRequestHandler,), {"state": self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="StubServer", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environ(self) -> dict:
+        """Environment variables pointing the bot to this server."""
+        return {
+            "TELEGRAM_API_URL": self.url + "/bot{0}/{1}",
+            "TELEGRAM_FILE_URL": self.url + "/file/bot{0}/{1}",
+            "OPENAI_BASE_URL": self.url + "/v1",
+        }
+
+    def start(self) -> "StubServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,109 @@
+"""
+Benchmark of the `/top` leaderboards on a large generated user base: the old full sort of all users against the
+user store queries (`heapq.nlargest` for the in-memory / json backends, indexed SQL for SQLite).
+
+Usage: python benchmarks/top_users.py [--users 100000] [--top 10]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SQLiteUserStore, UserStore
+
+PARAMETERS = ["requests", "tokens", "balance", "premium_tokens", "premium_balance", "images", "image_balance", "favors", "ref_id"]
+COST_WEIGHTS = {"tokens": 0.02 / 10, "premium_tokens": 1.0 / 10, "images": 8.0}  # цены в центах как в main.py
+LEGACY_REFS_USERS = 2000  # старый /top refs квадратичный - меряем его только на первых юзерах
+
+
+def generate_users(count: int) -> dict:
+    random.seed(1)
+    data = {"global": {"requests": 0, "tokens": 0, "images": 0}}
+    for user_id in range(1, count + 1):
+        user = {"requests": random.randint(0, 500), "tokens": random.randint(0, 10 ** 6), "balance": random.randint(-1000, 10 ** 5),
+                "name": f"User{user_id}", "username": f"@user{user_id}", "lastdate": "01.01.2024 00:00:00"}
+        if random.random() < 0.3:
+            user.update(premium_tokens=random.randint(0, 10 ** 5), premium_balance=random.randint(0, 10 ** 5))
+        if random.random() < 0.1:
+            user.update(images=random.randint(0, 20), image_balance=random.randint(0, 20), favors=random.randint(0, 3))
+        if user_id > 1 and random.random() < 0.2:
+            user["ref_id"] = random.randint(1, user_id - 1)
+        data[user_id] = user
+    return data
+
+
+def legacy_top(data: dict, max_users: int, value) -> list:
+    """The old implementation: list over all users, full sort, slice."""
+    top = [(user_id, value(user_data)) for user_id, user_data in data.items() if user_id != "global"]
+    top = [user for user in top if user[1] > 0]
+    return sorted(top, key=lambda x: x[1], reverse=True)[:max_users]
+
+
+def legacy_top_referrers(data: dict, max_users: int, limit: int) -> list:
+    """The old implementation of `/top refs`: a scan of all users to count the referrals of each user (only the first `limit` users)."""
+    top = [(user_id, sum(1 for other in data.values() if other.get("ref_id") == user_id)) for user_id in list(data)[1:limit + 1]]
+    return sorted([user for user in top if user[1] > 0], key=lambda x: x[1], reverse=True)[:max_users]
+
+
+def measure(function, repeat: int = 5) -> float:
+    """Return the best time of `repeat` calls in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000, help="number of generated users")
+    parser.add_argument("--top", type=int, default=10, help="size of the leaderboard")
+    args = parser.parse_args()
+
+    data = generate_users(args.users)
+
+    memory_store = UserStore()
+    memory_store.load(default_data=data)
+
+    sqlite_store = SQLiteUserStore(os.path.join(tempfile.mkdtemp(prefix="bot-bench-"), "data.sqlite3"))
+    sqlite_store.load(default_data=data)
+
+    def cost(user_data: dict) -> float:
+        return sum(user_data.get(field, 0) * weight for field, weight in COST_WEIGHTS.items())
+
+    print(f"\nПользователей: {args.users}, топ {args.top}, время в мс (лучшее из 5)\n")
+    print(f"{'параметр':<16}{'сортировка':>12}{'nlargest':>12}{'sqlite':>12}")
+
+    for parameter in PARAMETERS + ["refs", "cost"]:
+        if parameter == "refs":
+            legacy = lambda: legacy_top_referrers(data, args.top, LEGACY_REFS_USERS)
+            new_memory = lambda: memory_store.top_referrers(args.top)
+            new_sqlite = lambda: sqlite_store.top_referrers(args.top)
+        elif parameter == "cost":
+            legacy = lambda: legacy_top(data, args.top, cost)
+            new_memory = lambda: memory_store.top_users_by_weighted_sum(COST_WEIGHTS, args.top)
+            new_sqlite = lambda: sqlite_store.top_users_by_weighted_sum(COST_WEIGHTS, args.top)
+        else:
+            legacy = lambda: legacy_top(data, args.top, lambda user_data: user_data.get(parameter, 0))
+            new_memory = lambda: memory_store.top_users(parameter, args.top)
+            new_sqlite = lambda: sqlite_store.top_users(parameter, args.top)
+
+        if parameter != "refs":
+            expected = [value for _, value in legacy()]
+            assert [value for _, value in new_memory()] == expected, parameter
+            assert [round(value, 6) for _, value in new_sqlite()] == [round(value, 6) for value in expected], parameter
+
+        print(f"{parameter:<16}{measure(legacy, 1 if parameter == 'refs' else 5):>12.1f}{measure(new_memory):>12.2f}{measure(new_sqlite):>12.2f}")
+
+    print(f"\nrefs: старая версия перебирает всех юзеров для каждого юзера (O(n²)), "
+          f"время указано только для первых {LEGACY_REFS_USERS} юзеров")
+    sqlite_store.close()
+
+
+if __name__ == '__main__':
+    main()
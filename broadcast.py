@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import telebot
+
+from storage import load_json_data, write_json_atomic
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: `acquire()` blocks until a send is allowed. `pause()` stops all sends for a while
+    (used for `retry_after` from Telegram 429 responses).
+    """
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity or rate
+        self.clock = clock
+        self.sleep = sleep
+
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.tokens = 0
+
+    def acquire(self, stop_event: threading.Event = None) -> bool:
+        """Wait for a token. Returns False if `stop_event` was set while waiting."""
+        while stop_event is None or not stop_event.is_set():
+            with self.lock:
+                now = self.clock()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - max(self.updated, self.paused_until)) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+
+            if stop_event is not None:
+                stop_event.wait(wait)
+            else:
+                self.sleep(wait)
+        return False
+
+
+class Broadcaster:
+    """
+    Background broadcast job: sends the message to the list of recipients in a separate thread, paced by the token bucket,
+    so the bot keeps handling updates while it runs.
+
+    The progress is saved to `state_path`, so the job is resumed after a restart (`resume()`). At most the messages sent
+    since the last save (`save_interval`) can be sent twice after a crash.
+    Only one broadcast runs at a time.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, state_path: str, rate: float = 25, save_interval: float = 5,
+                 report_interval: float = 60, max_retries: int = 3,
+                 on_progress: Callable[[dict], None] = None, on_finish: Callable[[dict], None] = None):
+        """
+        :param rate: Max messages per second (Telegram allows ~30 per second for the whole bot)
+        :param save_interval: Save the progress every n seconds
+        :param report_interval: Call `on_progress(job)` every n seconds
+        :param max_retries: How many times to retry a recipient after 429 Too Many Requests
+        :param on_progress: Called from the broadcast thread with a copy of the job state
+        :param on_finish: Called from the broadcast thread with a copy of the job state when the job is done or cancelled
+        """
+        self.bot = bot
+        self.state_path = state_path
+        self.bucket = TokenBucket(rate)
+        self.save_interval = save_interval
+        self.report_interval = report_interval
+        self.max_retries = max_retries
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+
+        self.lock = threading.Lock()
+        self.job: Optional[dict] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def progress(self) -> Optional[dict]:
+        """Return a copy of the current job state, or None if there is no job."""
+        with self.lock:
+            return None if self.job is None else dict(self.job, failed=list(self.job["failed"]))
+
+    def start(self, recipients: list, text: str, parse_mode: str = "HTML") -> bool:
+        """Start a new broadcast. Returns False if another broadcast is still running."""
+        if self.is_running():
+            return False
+
+        self._start_job({"text": text, "parse_mode": parse_mode, "recipients": list(recipients), "position": 0,
+                         "sent": 0, "failed": [], "started": time.time(), "cancelled": False})
+        return True
+
+    def resume(self) -> bool:
+        """Resume the broadcast saved in `state_path` (after a restart). Returns True if a job was resumed."""
+        if self.is_running() or not os.path.exists(self.state_path):
+            return False
+
+        job = load_json_data(self.state_path)
+        if job["position"] >= len(job["recipients"]):
+            os.remove(self.state_path)
+            return False
+
+        self._start_job(job)
+        return True
+
+    def cancel(self) -> bool:
+        """Cancel the running broadcast. Returns False if there is nothing to cancel."""
+        if not self.is_running():
+            return False
+
+        with self.lock:
+            self.job["cancelled"] = True
+        self.stop_event.set()
+        self.thread.join()
+        return True
+
+    def stop(self) -> None:
+        """Stop the running broadcast on shutdown, keeping its progress to resume on the next start."""
+        if self.is_running():
+            self.stop_event.set()
+            self.thread.join()
+
+    def _start_job(self, job: dict) -> None:
+        self.job = job
+        self.stop_event.clear()
+        self._save()
+        self.thread = threading.Thread(target=self._run, name="Broadcaster", daemon=True)
+        self.thread.start()
+
+    def _save(self) -> None:
+        with self.lock:
+            job = dict(self.job, failed=list(self.job["failed"]))
+        write_json_atomic(self.state_path, job, indent=None)
+
+    def _send(self, chat_id: int) -> bool:
+        """Send the message to one recipient, waiting for `retry_after` on 429. Returns True if the message was sent."""
+        for attempt in range(self.max_retries + 1):
+            if not self.bucket.acquire(self.stop_event):
+                raise InterruptedError
+
+            try:
+                self.bot.send_message(chat_id, self.job["text"], parse_mode=self.job["parse_mode"])
+                return True
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429:  # Юзер заблокировал бота, удалил аккаунт и т.п. - повтор не поможет
+                    return False
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                print(f"\nРассылка: лимит Telegram, пауза {retry_after} с")
+                self.bucket.pause(retry_after)
+            except Exception as e:
+                print(f"\nРассылка: ошибка отправки {chat_id}: {e}")
+                return False
+        return False
+
+    def _run(self) -> None:
+        last_save = last_report = time.monotonic()
+
+        try:
+            while self.job["position"] < len(self.job["recipients"]):
+                chat_id = self.job["recipients"][self.job["position"]]
+                is_sent = self._send(chat_id)
+
+                with self.lock:
+                    if is_sent:
+                        self.job["sent"] += 1
+                    else:
+                        self.job["failed"].append(chat_id)
+                    self.job["position"] += 1
+
+                now = time.monotonic()
+                if now - last_save >= self.save_interval:
+                    self._save()
+                    last_save = now
+                if now - last_report >= self.report_interval:
+                    self._notify(self.on_progress)
+                    last_report = now
+        except InterruptedError:
+            if not self.job["cancelled"]:  # Остановка бота - сохраняем прогресс, чтобы продолжить при следующем запуске
+                self._save()
+                print("\nРассылка приостановлена до следующего запуска")
+                return
+
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self._notify(self.on_finish)
+
+    def _notify(self, callback: Optional[Callable[[dict], None]]) -> None:
+        if callback is None:
+            return
+        try:
+            callback(self.progress())
+        except Exception as e:  # Ошибка отчета не должна останавливать рассылку
+            print(f"\nРассылка: ошибка отправки отчета: {e}")
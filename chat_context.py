@@ -0,0 +1,407 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+from tokenizer import count_tokens, get_encoding_name
+
+
+ENTRY_OVERHEAD_BYTES = 250  # approximate memory of one stored message besides its text: dict, tuple, deque slot
+
+
+def count_message_tokens(content: str, model: str) -> int:
+    return count_tokens(content, model) + 3  # + служебные токены формата чата на каждое сообщение
+
+
+class ChatContext:
+    """
+    History of the extended chat context of one user.
+
+    Every message is stored with its precomputed length in characters and tokens, and the running totals are kept
+    up to date, so trimming to a budget costs O(number of removed messages) instead of recounting the whole history.
+
+    The oldest messages can be replaced with a short `summary` of them, it's sent before the history as a system message.
+
+    All token counts are made with the tokenizer of one `model`. The user can switch the model, so a model with
+    another encoding recounts the whole history first (see `recount()`), otherwise the budget would be checked
+    against the counts of the wrong tokenizer.
+    """
+
+    def __init__(self, messages: list = (), model: str = "gpt-3.5-turbo"):
+        self.entries = deque()  # (message, chars, tokens)
+        self.model = model  # the model, whose tokenizer counted the tokens
+        self.encoding = get_encoding_name(model)
+        self.total_chars = 0
+        self.total_tokens = 0
+        self.total_bytes = 0  # approximate memory used by the history
+        self.summary = None
+        self.summary_tokens = 0
+        self.extend(messages, model)
+        self.last_used = time.monotonic()
+
+        # Состояние записи на диск (ведет ChatContextStore)
+        self.unsaved = 0  # number of the last messages, which are not saved yet
+        self.needs_rewrite = False  # the history was trimmed, the file must be rewritten as a whole
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, message: dict, model: str) -> None:
+        """Add a message (`{"role": ..., "content": ...}`), its tokens are counted with the tokenizer of the model."""
+        self.recount(model)
+        content = message["content"]
+        chars = len(content)
+        tokens = count_message_tokens(content, self.model)
+        self.entries.append((message, chars, tokens))
+        self.total_chars += chars
+        self.total_tokens += tokens
+        self.total_bytes += sys.getsizeof(content) + ENTRY_OVERHEAD_BYTES
+
+    def extend(self, messages: list, model: str) -> None:
+        for message in messages:
+            self.append(message, model)
+
+    def _remove_oldest(self) -> dict:
+        message, chars, tokens = self.entries.popleft()
+        self.total_chars -= chars
+        self.total_tokens -= tokens
+        self.total_bytes -= sys.getsizeof(message["content"]) + ENTRY_OVERHEAD_BYTES
+        return message
+
+    def recount(self, model: str) -> bool:
+        """
+        Recount the tokens of the history and the summary with the tokenizer of the model, if its encoding differs
+        from the one of the current counts. Returns True if the tokens were recounted.
+        """
+        encoding = get_encoding_name(model)
+        if encoding == self.encoding:
+            return False
+        self.model = model
+        self.encoding = encoding
+        self.entries = deque((message, chars, count_message_tokens(message["content"], model)) for message, chars, _ in self.entries)
+        self.total_tokens = sum(tokens for _, _, tokens in self.entries)
+        if self.summary is not None:
+            self.summary_tokens = count_message_tokens(self.summary_message()["content"], model)
+        return True
+
+    def trim(self, max_chars: int = None, max_tokens: int = None, keep_last: int = 1, model: str = None) -> int:
+        """
+        Remove the oldest messages until the history fits into both limits (None - no limit).
+        `max_chars` limits only the messages, `max_tokens` - the messages together with the summary, counted
+        with the tokenizer of `model` (the model of the current counts if None).
+        The last `keep_last` messages are never removed. Returns the number of removed messages.
+        """
+        if max_tokens is not None and model is not None:
+            self.recount(model)
+        removed = 0
+        while len(self.entries) > keep_last and ((max_chars is not None and self.total_chars > max_chars) or
+                                                 (max_tokens is not None and self.total_tokens + self.summary_tokens > max_tokens)):
+            self._remove_oldest()
+            removed += 1
+        return removed
+
+    def set_summary(self, summary: Optional[str]) -> None:
+        if self.summary is not None:
+            self.total_bytes -= sys.getsizeof(self.summary)
+        self.summary = summary or None
+        self.summary_tokens = 0
+        if self.summary is not None:
+            self.summary_tokens = count_message_tokens(self.summary_message()["content"], self.model)
+            self.total_bytes += sys.getsizeof(self.summary)
+
+    def summary_message(self) -> dict:
+        return {"role": "system", "content": f"Summary of the earlier conversation with the user: {self.summary}"}
+
+    def replace_with_summary(self, summary: str, messages: list) -> int:
+        """
+        Set the summary of the oldest `messages` and remove those of them, which are still in the history
+        (some could be trimmed meanwhile). Returns the number of removed messages.
+        """
+        summarized_ids = {id(message) for message in messages}
+        removed = 0
+        while self.entries and id(self.entries[0][0]) in summarized_ids:
+            self._remove_oldest()
+            removed += 1
+        self.set_summary(summary)
+        return removed
+
+    def history(self) -> list:
+        """Return the messages of the history without the summary."""
+        return [message for message, _, _ in self.entries]
+
+    def messages(self) -> list:
+        """Return the list of messages for the API request, starting with the summary if there is one."""
+        messages = self.history()
+        if self.summary is not None:
+            messages.insert(0, self.summary_message())
+        return messages
+
+
+class ChatContextStore:
+    """
+    Extended chat contexts of all users with write-behind persistence.
+
+    Each user's history is kept in `<folder>/<user_id>.jsonl`, one message per line. New messages are only marked
+    as unsaved on the request path; the background thread appends them to the files and fsyncs every `flush_interval`
+    seconds, so a crash loses at most the messages of the last interval. A file is rewritten as a whole only
+    after its history was trimmed. Old `<user_id>.json` files (a JSON list) are read and converted on the first save.
+    The summary of the history, if there is one, is the first line of the file: `{"summary": "..."}`.
+
+    Histories in memory are an LRU cache bounded by `max_bytes` and by `ttl` seconds of inactivity: evicted histories
+    are saved by the background thread and loaded back from disk on the next use.
+    """
+
+    def __init__(self, folder: str, flush_interval: float = 1.0, max_bytes: int = None, ttl: float = None):
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.contexts = OrderedDict()  # user_id -> ChatContext, the least recently used first
+        self.evicted = {}  # user_id -> ChatContext, evicted from the cache, but not saved yet
+        self.dirty = set()  # user ids with unsaved changes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()  # only one flush writes the files at a time
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, user_id) -> str:
+        return os.path.join(self.folder, f"{user_id}.jsonl")
+
+    def _legacy_path(self, user_id) -> str:
+        return os.path.join(self.folder, f"{user_id}.json")
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.contexts or user_id in self.evicted
+
+    def get(self, user_id, model: str = "gpt-3.5-turbo") -> ChatContext:
+        """Return the user's history, loading it from disk if it's not in the cache."""
+        with self.lock:
+            context = self.contexts.get(user_id)
+            if context is not None:
+                self.hits += 1
+                self.contexts.move_to_end(user_id)
+            else:
+                context = self.evicted.pop(user_id, None)
+                if context is not None:  # Еще не успели сохранить - возвращаем в кэш без чтения с диска
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    context = self._load(user_id, model)
+                self.contexts[user_id] = context
+                self.resident_bytes += context.total_bytes
+                self._evict_over_limit()
+
+            context.last_used = time.monotonic()
+            return context
+
+    def _load(self, user_id, model: str) -> ChatContext:
+        path = self._path(user_id)
+        if os.path.isfile(path):
+            messages = []
+            is_truncated = False
+            with open(path, "r", encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        messages.append(json.loads(line))
+                    except ValueError:  # Недописанная строка после падения
+                        is_truncated = True
+                        break
+            summary = messages.pop(0)["summary"] if messages and "summary" in messages[0] else None
+            context = ChatContext(messages, model)
+            context.set_summary(summary)
+            # Дописывать к битой строке нельзя - новые сообщения склеились бы с ней и потерялись при следующей загрузке
+            context.needs_rewrite = is_truncated
+            return context
+
+        legacy_path = self._legacy_path(user_id)
+        if os.path.isfile(legacy_path):
+            with open(legacy_path, "r", encoding='utf-8') as file:
+                context = ChatContext(json.load(file), model)
+            context.needs_rewrite = True  # Переводим в jsonl при первом сохранении
+            return context
+
+        return ChatContext(model=model)
+
+    def add_messages(self, user_id, messages: list, model: str, save: bool = True) -> None:
+        """Add messages to the user's history. With `save=False` they are saved together with the next saved messages."""
+        with self.lock:
+            context = self.get(user_id, model)
+            total_bytes = context.total_bytes
+            context.extend(messages, model)
+            context.unsaved += len(messages)
+            if save:
+                self.dirty.add(user_id)
+
+            self.resident_bytes += context.total_bytes - total_bytes
+            self._evict_over_limit()
+
+    def trim(self, user_id, max_chars: int = None, max_tokens: int = None, model: str = None) -> int:
+        with self.lock:
+            if user_id not in self:
+                return 0
+            context = self.get(user_id)
+            total_bytes = context.total_bytes
+            removed = context.trim(max_chars=max_chars, max_tokens=max_tokens, model=model)
+            if removed:
+                context.needs_rewrite = True
+                context.unsaved = min(context.unsaved, len(context))
+                self.dirty.add(user_id)
+                self.resident_bytes += context.total_bytes - total_bytes
+            return removed
+
+    def get_summary_candidates(self, user_id, max_tokens: int, keep_last: int) -> Optional[tuple]:
+        """
+        Return `(context, summary, messages)` if the cached history is longer than `max_tokens` (with the summary):
+        the current summary and the oldest messages to summarize, all except the last `keep_last`. Otherwise None.
+        """
+        with self.lock:
+            context = self.contexts.get(user_id)
+            if context is None or context.total_tokens + context.summary_tokens <= max_tokens or len(context) <= keep_last:
+                return None
+            return context, context.summary, context.history()[:len(context) - keep_last]
+
+    def apply_summary(self, user_id, context: ChatContext, summary: str, messages: list) -> bool:
+        """
+        Replace the summarized `messages` of the history (from `get_summary_candidates()`) with the new summary.
+        Returns False if the history was deleted or reloaded meanwhile.
+        """
+        with self.lock:
+            if (self.contexts.get(user_id) or self.evicted.get(user_id)) is not context:
+                return False
+            total_bytes = context.total_bytes
+            context.replace_with_summary(summary, messages)
+            context.needs_rewrite = True
+            context.unsaved = min(context.unsaved, len(context))
+            self.dirty.add(user_id)
+            if user_id in self.contexts:
+                self.resident_bytes += context.total_bytes - total_bytes
+            return True
+
+    def _evict(self, user_id) -> None:
+        context = self.contexts.pop(user_id)
+        self.resident_bytes -= context.total_bytes
+        self.evictions += 1
+        if context.unsaved or context.needs_rewrite:  # Сохранит фоновый поток, до этого история остается доступной
+            self.evicted[user_id] = context
+
+    def _evict_over_limit(self) -> None:
+        # Самую свежую историю не вытесняем, даже если она одна больше лимита
+        while self.max_bytes is not None and self.resident_bytes > self.max_bytes and len(self.contexts) > 1:
+            self._evict(next(iter(self.contexts)))
+
+    def evict_idle(self) -> None:
+        """Evict the histories, which were not used for `ttl` seconds."""
+        if self.ttl is None:
+            return
+        with self.lock:
+            deadline = time.monotonic() - self.ttl
+            while self.contexts:
+                user_id, context = next(iter(self.contexts.items()))
+                if context.last_used > deadline:
+                    break
+                self._evict(user_id)
+
+    def stats(self) -> dict:
+        """Return the cache metrics: number of cached histories, their approximate memory, hits, misses and evictions."""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"users": len(self.contexts), "resident_bytes": self.resident_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits / requests if requests else 0.0}
+
+    def delete(self, user_id) -> None:
+        """Delete the user's history from memory and disk."""
+        with self.flush_lock, self.lock:
+            context = self.contexts.pop(user_id, None)
+            if context is not None:
+                self.resident_bytes -= context.total_bytes
+            self.evicted.pop(user_id, None)
+            self.dirty.discard(user_id)
+            for path in (self._path(user_id), self._legacy_path(user_id)):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def flush(self) -> None:
+        """Write all unsaved changes to disk."""
+        with self.flush_lock:
+            # Под блокировкой только собираем, что записать, сами файлы пишем без нее
+            with self.lock:
+                pending = []
+                for user_id in self.dirty | self.evicted.keys():
+                    context = self.contexts.get(user_id) or self.evicted.get(user_id)
+                    if context is None:
+                        continue
+                    if context.needs_rewrite:
+                        summary = [] if context.summary is None else [{"summary": context.summary}]
+                        pending.append((user_id, context, True, summary + context.history()))
+                    elif context.unsaved:
+                        pending.append((user_id, context, False, context.history()[-context.unsaved:]))
+                    context.needs_rewrite = False
+                    context.unsaved = 0
+                self.dirty.clear()
+                evicted = dict(self.evicted)
+
+            for user_id, context, is_rewrite, messages in pending:
+                try:
+                    self._write(user_id, is_rewrite, messages)
+                except OSError as e:
+                    print(f"\nОшибка сохранения контекста юзера {user_id}: {e}")
+                    # Повторим при следующем сохранении. Файл мог остаться недописанным, поэтому перепишем его целиком
+                    with self.lock:
+                        context.needs_rewrite = True
+                        self.dirty.add(user_id)
+
+            # Вытесненные истории убираем из памяти только после записи, иначе get() мог бы прочитать неполный файл
+            with self.lock:
+                for user_id, context in evicted.items():
+                    if self.evicted.get(user_id) is context and not context.unsaved and not context.needs_rewrite:
+                        del self.evicted[user_id]
+
+    def _write(self, user_id, is_rewrite: bool, messages: list) -> None:
+        lines = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages)
+        path = self._path(user_id)
+
+        if is_rewrite:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding='utf-8') as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+
+            legacy_path = self._legacy_path(user_id)
+            if os.path.isfile(legacy_path):
+                os.remove(legacy_path)
+        else:
+            with open(path, "a", encoding='utf-8') as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def _flush_loop(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            self.evict_idle()
+            self.flush()
+
+    def start(self) -> None:
+        """Start the background thread, which saves the changes every `flush_interval` seconds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="ChatContextFlush", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        """Stop the background thread and save everything."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -9,12 +9,30 @@ import json
 import os
 from datetime import datetime, timedelta
 import time
+import threading
+import secrets
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from urllib.parse import urlparse
 
-from pydub import AudioSegment
 from telebot.util import extract_arguments, extract_command
 from telebot import types
 import base64
-import requests
+
+from admin_reports import AdminLogQueue
+from broadcast import Broadcaster
+from chat_context import ChatContext, ChatContextStore
+from metrics import Metrics
+from resilience import CircuitOpenError, ResilientCaller
+from response_cache import ResponseCache
+from storage import UserStore, JournalStore, SQLiteUserStore
+from telegram_cache import TelegramMetadataCache
+from transcoding import TranscodingBusyError, TranscodingService
+from streaming import StreamingMessageBuffer, get_chunk_content, get_chunk_usage_tokens
+from tokenizer import count_messages_tokens, count_tokens
+from webhook import WebhookServer
+from workers import OrderedTeleBot
 
 
 DEFAULT_MODEL = "gpt-3.5-turbo-0125"  # 16k
@@ -39,15 +57,106 @@ FAVOR_MIN_LIMIT = 10000  # minimum balance to ask for a favor
 # Позволяет боту "помнить" поледние n символов диалога с пользователем за счет увеличенного расхода токенов (округляется вниз до целого сообщения)
 DEFAULT_CHAT_CONTEXT_LENGTH = 5000  # default max length of chat context in characters.
 CHAT_CONTEXT_FOLDER = "chat_context/"
+CHAT_CONTEXT_FLUSH_INTERVAL = 1.0  # new context messages are saved to disk in the background every n seconds (max loss on crash)
+# В памяти держим только недавние диалоги, остальные выгружаются на диск и загружаются обратно при следующем сообщении
+CHAT_CONTEXT_CACHE_MAX_BYTES = 100 * 1024 * 1024  # max memory for the cached chat contexts (approximate)
+CHAT_CONTEXT_CACHE_TTL = 60 * 60  # chat contexts, unused for n seconds, are evicted from memory
+# Сжатие длинной истории: старые сообщения заменяются кратким пересказом от дешевой модели (в фоне, после ответа юзеру)
+CHAT_CONTEXT_SUMMARY = False  # replace old messages of the extended context with a summary (extra background requests, billed to the user)
+CHAT_CONTEXT_SUMMARY_MODEL = DEFAULT_MODEL
+CHAT_CONTEXT_SUMMARY_THRESHOLD = 2000  # summarize the history when it's longer than n tokens
+CHAT_CONTEXT_SUMMARY_KEEP_MESSAGES = 6  # the last n messages are kept verbatim
+CHAT_CONTEXT_SUMMARY_MAX_TOKENS = 500  # max tokens of the summary
+CHAT_CONTEXT_SUMMARY_PROMPT = "Summarize the conversation between the user and the assistant below for the assistant to continue it. " \
+                              "Keep the facts about the user, their requests, decisions and open questions, skip greetings and repetitions. " \
+                              "If there is a previous summary, merge it into the new one. Write in the language of the conversation, " \
+                              f"no more than {CHAT_CONTEXT_SUMMARY_MAX_TOKENS * 2 // 3} words."
+# Окно контекста моделей в токенах: история обрезается так, чтобы запрос вместе с ответом (MAX_REQUEST_TOKENS) в него влезал
+MODEL_CONTEXT_WINDOWS = {DEFAULT_MODEL: 16385, PREMIUM_MODEL: 128000}
+
+# Стриминг ответов: первое сообщение отправляется сразу после первых токенов и дописывается по мере генерации
+STREAM_RESPONSES = True
+STREAM_EDIT_INTERVAL = 1.5  # min seconds between edits of the streamed message in private chats
+STREAM_GROUP_EDIT_INTERVAL = 3.0  # in groups Telegram allows only ~20 messages (and edits) per minute
+
+# Кэш ответов на одинаковые запросы без контекста (например, типовые вопросы с дефолтным системным промптом)
+RESPONSE_CACHE = False
+RESPONSE_CACHE_MODELS = [DEFAULT_MODEL]  # only the answers of these models are cached
+RESPONSE_CACHE_MAX_ENTRIES = 10000  # max answers in memory
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # cached answers expire after n seconds
+RESPONSE_CACHE_FOLDER = "response_cache/"  # disk tier of the cache, survives restarts (None - only in memory)
+RESPONSE_CACHE_MAX_DISK_ENTRIES = 100000  # max answers on disk, the oldest ones are removed over the limit
+RESPONSE_CACHE_BILL_HITS = True  # deduct the tokens of the original request from the user's balance on cache hits
+
+# Запросы к OpenAI: повторы при сбоях с экспоненциальной паузой (или по Retry-After), лимиты и быстрый отказ при падении API
+OPENAI_TIMEOUT = 120  # seconds for one request
+OPENAI_MAX_RETRIES = 3
+OPENAI_RETRY_BASE_DELAY = 0.5  # seconds before the first retry, doubled for each next one (with random jitter)
+OPENAI_RETRY_MAX_DELAY = 20
+OPENAI_CONCURRENCY = {DEFAULT_MODEL: 50, PREMIUM_MODEL: 20, "dall-e-3": 5, "whisper-1": 10}  # max simultaneous requests per model
+OPENAI_DEFAULT_CONCURRENCY = 20
+OPENAI_CIRCUIT_FAILURES = 5  # after n failed requests in a row the requests to the model fail fast...
+OPENAI_CIRCUIT_RESET = 30  # ...for n seconds, then one probe request is sent
+
+# Распознавание изображений: OpenAI уменьшает картинку до 512x512 при detail="low" (фиксированные 85 токенов)
+# и до 768px по короткой стороне при "high", поэтому качаем из Telegram самый маленький размер фото, которого для этого хватает
+VISION_DETAIL = "high"
+VISION_MAX_IMAGE_BYTES = 5 * 1024 * 1024  # larger photos are not sent to OpenAI
+
+# Перекодирование войсов в mp3 (если Whisper не принял ogg) идет в отдельных процессах, чтобы не занимать потоки бота
+TRANSCODE_WORKERS = 2
+TRANSCODE_MAX_PENDING = 4  # more voices at the same time are rejected with "try later"
+TRANSCODE_TIMEOUT = 60  # seconds
+
+# Логи запросов отправляются админу в фоне пачками, а не отдельным сообщением после каждого запроса
+ADMIN_LOG_FLUSH_INTERVAL = 5  # seconds
+ADMIN_LOG_MAX_QUEUE = 500  # if more logs are waiting, the oldest are dropped
+
+# Время этапов обработки запросов (гистограммы по моделям) для /perf и Prometheus: http://127.0.0.1:METRICS_PORT/metrics
+METRICS_PORT = 9101  # None - don't export
+
+TELEGRAM_CACHE_TTL = 60 * 60  # the bot's info from Telegram (get_me) is refreshed in the background every n seconds
+
+# Число потоков для обработки апдейтов: разные юзеры обслуживаются параллельно, сообщения одного юзера - строго по порядку
+BOT_WORKERS = 8  # 0 - стандартный TeleBot без гарантии порядка
+
+# Режим вебхука включается переменной WEBHOOK_URL в .env (https://домен/путь, обычно через nginx), иначе - long polling
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_QUEUE_SIZE = 1000  # max updates accepted but not yet handled (queued or in the handlers pool), the next ones get 503 and are resent by Telegram
+WEBHOOK_MAX_CONNECTIONS = 40  # simultaneous HTTPS connections from Telegram (1-100)
+WEBHOOK_SSL_CERT = None  # path to the certificate, if the bot serves HTTPS itself (a self-signed one is uploaded to Telegram)
+WEBHOOK_SSL_KEY = None
 
 # load .env file with secrets
 load_dotenv()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)  # Без секрета в .env генерируем новый при каждом запуске
+
+# Позволяет направить бота на локальный Bot API сервер или на заглушку для нагрузочных тестов (формат: http://host:port/bot{0}/{1})
+if os.getenv("TELEGRAM_API_URL"):
+    telebot.apihelper.API_URL = os.getenv("TELEGRAM_API_URL")
+if os.getenv("TELEGRAM_FILE_URL"):
+    telebot.apihelper.FILE_URL = os.getenv("TELEGRAM_FILE_URL")
 
 # Load OpenAI API credentials from .env file
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=OPENAI_TIMEOUT, max_retries=0)  # Повторы делает openai_caller
+
+# Все запросы к OpenAI идут через openai_caller: повторы, лимиты одновременных запросов и circuit breaker на каждую модель
+openai_caller = ResilientCaller(OPENAI_MAX_RETRIES, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY, OPENAI_CONCURRENCY,
+                                OPENAI_DEFAULT_CONCURRENCY, OPENAI_CIRCUIT_FAILURES, OPENAI_CIRCUIT_RESET)
+
+# Метрики создаются до всего остального, чтобы ими могли пользоваться все компоненты
+metrics = Metrics()
 
 # Create a new Telebot instance
-bot = telebot.TeleBot(os.getenv("TELEGRAM_API_KEY"))
+if BOT_WORKERS > 0:
+    bot = OrderedTeleBot(os.getenv("TELEGRAM_API_KEY"), num_workers=BOT_WORKERS)
+else:
+    bot = telebot.TeleBot(os.getenv("TELEGRAM_API_KEY"))
+
+# Данные бота из Telegram (id, username) берем из кэша, а не запросом get_me() на каждое сообщение
+telegram_cache = TelegramMetadataCache(bot, TELEGRAM_CACHE_TTL)
 
 # Получаем айди админа, которому в лс будут приходить логи
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
@@ -56,10 +165,20 @@ ADMIN_ID = int(os.getenv("ADMIN_ID"))
 # File with users and global token usage data
 DATAFILE = "data.json"
 BACKUPFILE = "data-backup.json"
+JOURNALFILE = "data.json.journal"  # append-only log of changes since the last snapshot of DATAFILE
+SQLITE_DATAFILE = "data.sqlite3"
+USER_STORE_BACKEND = "json"  # "json" - DATAFILE + JOURNALFILE, "sqlite" - SQLITE_DATAFILE (imports DATAFILE on first run), "memory" - nothing is saved
+JOURNAL_COMPACT_THRESHOLD = 1000  # compact the journal into DATAFILE after this many records
+JOURNAL_COMPACT_INTERVAL = 300  # or every n seconds, whichever comes first
+BROADCASTFILE = "broadcast.json"  # progress of the running /announce broadcast, to resume it after a restart
+
+# Рассылка /announce идет в фоне: Telegram разрешает боту ~30 сообщений в секунду, оставляем запас для обычных ответов
+BROADCAST_RATE = 25  # max broadcast messages per second
+BROADCAST_REPORT_INTERVAL = 60  # send the broadcast progress to admin every n seconds
 
 # Default values for new users, who are not in the data file
 DEFAULT_NEW_USER_DATA = {"requests": 0, "tokens": 0, "balance": NEW_USER_BALANCE,
-                         "name": "None", "username": "None", "lastdate": "01.01.1990 00:00:00"}
+                         "name": "None", "username": "None", "lastdate": "01.01.1990 00:00:00", "lastdate_ts": 0}
 
 
 """======================FUNCTIONS======================="""
@@ -67,47 +186,58 @@ DEFAULT_NEW_USER_DATA = {"requests": 0, "tokens": 0, "balance": NEW_USER_BALANCE
 
 # Function to check if the user is in the data file
 def is_user_exists(user_id: int) -> bool:
-    if user_id in data:
-        return True
-    else:
-        return False
+    return user_store.is_user_exists(user_id)
 
 
 # Function to check if the user is in the blacklist
 def is_user_blacklisted(user_id: int) -> bool:
-    if user_id in data and "blacklist" in data[user_id]:
-        return data[user_id]["blacklist"]
+    if user_store.is_user_exists(user_id):
+        return user_store.get_user(user_id).get("blacklist", False)
     else:
         return False
 
 
+# Function to check if the user has positive balance of the specified type ("balance", "premium_balance" or "image_balance")
+def has_positive_balance(user_id: int, balance_type: str = "balance") -> bool:
+    balance = user_store.get_user(user_id).get(balance_type)
+    return balance is not None and balance > 0
+
+
+# Function to format the username for the data file ("None" for users without username)
+def format_username(username: Optional[str]) -> str:
+    return '@'+username if username is not None else "None"
+
+
 # Function to add new user to the data file
 def add_new_user(user_id: int, name: str, username: str, referrer=None) -> None:
-    data[user_id] = DEFAULT_NEW_USER_DATA.copy()
-    data[user_id]["name"] = name
-
-    if username is not None:
-        data[user_id]["username"] = '@'+username
-    else:
-        data[user_id]["username"] = "None"
+    new_user_data = DEFAULT_NEW_USER_DATA.copy()
+    new_user_data["name"] = name
+    new_user_data["username"] = format_username(username)
 
     if referrer is not None:
-        data[user_id]["balance"] += REFERRAL_BONUS
-        data[user_id]["ref_id"] = referrer
-
+        new_user_data["balance"] += REFERRAL_BONUS
+        new_user_data["ref_id"] = referrer
 
-# Function to update the JSON file with relevant data
-def update_json_file(new_data, file_name=DATAFILE) -> None:
-    with open(file_name, "w", encoding='utf-8') as file:
-        json.dump(new_data, file, ensure_ascii=False, indent=4)
+    user_store.add(user_id, new_user_data)
 
 
 # Function to get user_id by username
+# Поиск по индексу хранилища, регистр и "@" не важны
 def get_user_id_by_username(username: str) -> Optional[int]:
-    for user_id in list(data.keys())[1:]:
-        if data[user_id]["username"] == username:
-            return user_id
-    return None
+    return user_store.find_user_by_username(username)
+
+
+# Обновляем имя и username юзера, если он их сменил в Telegram (индекс username обновится вместе с данными)
+def refresh_user_names(user: types.User) -> None:
+    user_data = user_store.get_user(user.id)
+    changes = {}
+    if user_data["name"] != user.first_name:
+        changes["name"] = user.first_name
+    if user_data["username"] != format_username(user.username):
+        changes["username"] = format_username(user.username)
+
+    if changes:
+        user_store.update(user.id, changes)
 
 
 # Function to get the user's prompt
@@ -121,52 +251,36 @@ def get_user_prompt(user_id: int) -> str:
     :return: The user's prompt
     :rtype: str
     """
-    if data[user_id].get("prompt") is None:
+    prompt = user_store.get_user(user_id).get("prompt")
+    if prompt is None:
         return DEFAULT_SYSTEM_PROMPT
     else:
-        return str(data[user_id]["prompt"])
+        return str(prompt)
 
 
 """БЕТА версия расширенного контекста"""
 
 
-# Function to get the user's chat history from the file named by his user_id
-# TODO: мб изменить и переименовать в именно доставание истории из файла (и вызывать в следующей ф-и с обновлением контекста)
-def get_user_chat_context(user_id: int) -> list:
-    file_path = f"{CHAT_CONTEXT_FOLDER}{user_id}.json"
-
-    if user_id not in chat_context or chat_context[user_id] is None:
-        if os.path.isfile(file_path):
-            with open(file_path, "r", encoding='utf-8') as file:
-                chat_context[user_id] = json.load(file)
-        else:
-            chat_context[user_id] = []
-    return chat_context[user_id]
+# Function to get the user's chat history (loaded from the file named by his user_id on the first use)
+def get_user_chat_context(user_id: int, lang_model: str = DEFAULT_MODEL) -> ChatContext:
+    return chat_context.get(user_id, lang_model)
 
 
-# Function to update the user's chat history in specific user file named by user_id
-def update_user_chat_context(user_id: int, messages: list = None, save_to_file: bool = True) -> None:
-    if user_id not in chat_context or chat_context[user_id] is None:
-        chat_context[user_id] = []
+# Function to update the user's chat history. The file is written in the background (write-behind), not on the request path
+def update_user_chat_context(user_id: int, messages: list = None, save_to_file: bool = True, lang_model: str = DEFAULT_MODEL) -> None:
+    chat_context.add_messages(user_id, messages or [], lang_model, save=save_to_file)
 
-    if messages is not None:
-        chat_context[user_id].extend(messages)
 
-    if save_to_file:
-        with open(f"{CHAT_CONTEXT_FOLDER}{user_id}.json", "w", encoding='utf-8') as file:
-            json.dump(chat_context[user_id], file, ensure_ascii=False, indent=4)
+# Function to trim the user chat context to specific character length and token budget of the model. Remove the oldest messages
+def trim_user_chat_context(user_id: int, max_length: int, max_tokens: int = None, lang_model: str = None) -> None:
+    # Последнее сообщение (текущий запрос юзера) не удаляем. После смены модели токены пересчитываются ее токенизатором
+    chat_context.trim(user_id, max_chars=max_length, max_tokens=max_tokens, model=lang_model)
 
 
-# Function to trim the user chat context to specific character length. Remove the oldest messages
-def trim_user_chat_context(user_id: int, max_length: int) -> None:
-    if user_id in chat_context:
-        total_chars = sum(len(message['content']) for message in chat_context[user_id])
-
-        while total_chars > max_length:
-            # print(f"Trimming chat context for user {user_id}. Current length: {total_chars}")
-            removed_message_length = len(chat_context[user_id].pop(0)['content'])
-            total_chars -= removed_message_length
-        # print(f"Chat context for user {user_id} has been trimmed to {total_chars} chars.")
+# Ф-я для получения бюджета токенов на историю диалога: окно модели минус ответ и системный промпт
+def get_chat_context_token_budget(lang_model: str, system_prompt: str) -> int:
+    context_window = MODEL_CONTEXT_WINDOWS.get(lang_model, MODEL_CONTEXT_WINDOWS[DEFAULT_MODEL])
+    return context_window - MAX_REQUEST_TOKENS - count_messages_tokens([{"role": "system", "content": system_prompt}], lang_model)
 
 
 def is_user_extended_chat_context_enabled(user_id: int) -> bool:
@@ -179,35 +293,94 @@ def is_user_extended_chat_context_enabled(user_id: int) -> bool:
     :return: True if the extended chat context is enabled, False otherwise
     :rtype: bool
     """
-    # return data[user_id].get("is_chat_context_enabled", False)
-    return "max_context_length" in data[user_id]
+    # return user_store.get_user(user_id).get("is_chat_context_enabled", False)
+    return "max_context_length" in user_store.get_user(user_id)
 
 
 # Ф-я для получения максимальной длины контекста для пользовалятеля
 def get_user_max_chat_context_length(user_id: int) -> int:
     # берем информацию из бд, если поле есть у юзера. Иначе возвращаем дефолтное значение
-    # print(data[user_id].get("max_context_length", DEFAULT_CHAT_CONTEXT_LENGTH))
-    return data[user_id].get("max_context_length", DEFAULT_CHAT_CONTEXT_LENGTH)
+    return user_store.get_user(user_id).get("max_context_length", DEFAULT_CHAT_CONTEXT_LENGTH)
 
 
-# Функция для очищения контекста диалога юзера
+# Функция для очищения контекста диалога юзера (из памяти и с диска)
 def delete_user_chat_context(user_id: int) -> None:
-    # Очищаем контекст из памяти
-    if user_id in chat_context:
-        chat_context.pop(user_id)
+    chat_context.delete(user_id)
+
+
+# Ф-я для запуска сжатия истории юзера в фоне, если она длиннее порога (не больше одной задачи на юзера одновременно)
+def schedule_chat_context_summary(user_id: int) -> None:
+    if not CHAT_CONTEXT_SUMMARY:
+        return
+    # Пересказ списывается с баланса модели пересказа - без него юзер ушел бы в минус за запрос, который не делал
+    balance_type = "premium_balance" if CHAT_CONTEXT_SUMMARY_MODEL == PREMIUM_MODEL else "balance"
+    if user_id != ADMIN_ID and not has_positive_balance(user_id, balance_type):
+        return
+    if chat_context.get_summary_candidates(user_id, CHAT_CONTEXT_SUMMARY_THRESHOLD, CHAT_CONTEXT_SUMMARY_KEEP_MESSAGES) is None:
+        return
+
+    with summarizing_users_lock:
+        if user_id in summarizing_users:
+            return
+        summarizing_users.add(user_id)
+    summary_executor.submit(summarize_user_chat_context, user_id)
+
+
+def summarize_user_chat_context(user_id: int) -> None:
+    """
+    This function replaces the oldest messages of the user's extended chat context with their summary,
+    so the next requests send the summary and only the last messages instead of the whole history.
+    It's run in the background, the tokens of the summary request are billed to the user's balance of the summary model,
+    so it's scheduled only for users with a positive balance of that model.
+
+    :param user_id: The user's ID
+    :type user_id: int
+
+    :return: None
+    """
+    try:
+        candidates = chat_context.get_summary_candidates(user_id, CHAT_CONTEXT_SUMMARY_THRESHOLD, CHAT_CONTEXT_SUMMARY_KEEP_MESSAGES)
+        if candidates is None:
+            return
+        context, summary, messages = candidates
+
+        # Переписку отдаем одним сообщением, чтобы модель пересказала ее, а не продолжила диалог
+        transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if summary is not None:
+            transcript = f"Previous summary: {summary}\n\n{transcript}"
+
+        response = openai_caller.call(
+            CHAT_CONTEXT_SUMMARY_MODEL,
+            client.chat.completions.create,
+            model=CHAT_CONTEXT_SUMMARY_MODEL,
+            max_tokens=CHAT_CONTEXT_SUMMARY_MAX_TOKENS,
+            messages=[{"role": "system", "content": CHAT_CONTEXT_SUMMARY_PROMPT}, {"role": "user", "content": transcript}]
+        )
+        new_summary = response.choices[0].message.content
+        if not new_summary:
+            return
 
-    # Удаляем файл с контекстом юзера с диска
-    file_path = f"{CHAT_CONTEXT_FOLDER}{user_id}.json"
-    if os.path.isfile(file_path):
-        os.remove(file_path)
+        chat_context.apply_summary(user_id, context, new_summary, messages)
+        update_global_user_data(
+            user_id,
+            new_requests=0,
+            new_tokens=response.usage.total_tokens if CHAT_CONTEXT_SUMMARY_MODEL != PREMIUM_MODEL else None,
+            new_premium_tokens=response.usage.total_tokens if CHAT_CONTEXT_SUMMARY_MODEL == PREMIUM_MODEL else None,
+            deduct_tokens=True if user_id != ADMIN_ID else False
+        )
+        print(f"\nКонтекст юзера {user_id} сжат: {len(messages)} сообщений -> {response.usage.total_tokens} токенов")
+    except Exception as e:  # Без пересказа история просто обрезается как раньше
+        print(f"\nОшибка сжатия контекста юзера {user_id}: {e}")
+    finally:
+        with summarizing_users_lock:
+            summarizing_users.discard(user_id)
 
 
 """КОНЕЦ БЕТА ВЕРСИИ"""
 
 
-# Function to call the OpenAI API and get the response
-def get_chatgpt_response(user_request: str, lang_model=DEFAULT_MODEL, prev_answer=None, system_prompt=DEFAULT_SYSTEM_PROMPT,
-                         extended_context_messages=None):
+# Function to build the list of messages for the OpenAI API request
+def build_chatgpt_messages(user_request: str, prev_answer=None, system_prompt=DEFAULT_SYSTEM_PROMPT, extended_context_messages=None) -> list:
     messages = [{"role": "system", "content": system_prompt}]
 
     if extended_context_messages is not None:  # Если включен режим длинного контекста TODO: нужна даделька
@@ -220,16 +393,62 @@ def get_chatgpt_response(user_request: str, lang_model=DEFAULT_MODEL, prev_answe
         messages.append({"role": "user", "content": user_request})
         # print("\nЗапрос без контекста")
 
-    return client.chat.completions.create(
+    return messages
+
+
+# Function to call the OpenAI API and get the response
+def get_chatgpt_response(messages: list, lang_model=DEFAULT_MODEL):
+    return openai_caller.call(
+        lang_model,
+        client.chat.completions.create,
         model=lang_model,
         max_tokens=MAX_REQUEST_TOKENS,
         messages=messages
     )
 
 
+# Function to call the OpenAI API with streaming, returns the generator of the response chunks
+# Повторяется только установка соединения: после первых чанков ответ уже у юзера. Слот модели занят, пока стрим не дочитан
+def get_chatgpt_response_stream(messages: list, lang_model=DEFAULT_MODEL):
+    return openai_caller.call_stream(
+        lang_model,
+        client.chat.completions.create,
+        model=lang_model,
+        max_tokens=MAX_REQUEST_TOKENS,
+        messages=messages,
+        stream=True,
+        # Просим прислать usage последним чанком (через extra_body, т.к. наша версия openai не знает stream_options)
+        extra_body={"stream_options": {"include_usage": True}}
+    )
+
+
+# Function to count the request tokens locally, if the API didn't report the usage of the streamed response
+def estimate_request_tokens(messages: list, response_content: str, lang_model=DEFAULT_MODEL) -> int:
+    return count_messages_tokens(messages, lang_model) + count_tokens(response_content, lang_model)
+
+
+# Кэшируем только запросы без контекста: системный промпт и сообщение юзера
+def is_response_cacheable(messages: list, lang_model: str, is_chat_context_enabled: bool) -> bool:
+    return response_cache is not None and lang_model in RESPONSE_CACHE_MODELS and not is_chat_context_enabled and len(messages) == 2
+
+
+# Function to get the cached answer to the same request: `{"content": ..., "tokens": ...}` or None
+def get_cached_chatgpt_response(messages: list, lang_model: str, is_chat_context_enabled: bool) -> Optional[dict]:
+    if not is_response_cacheable(messages, lang_model, is_chat_context_enabled):
+        return None
+    return response_cache.get(lang_model, messages)
+
+
+def cache_chatgpt_response(messages: list, lang_model: str, is_chat_context_enabled: bool, response_content: str, request_tokens: int) -> None:
+    if response_content and is_response_cacheable(messages, lang_model, is_chat_context_enabled):
+        response_cache.put(lang_model, messages, response_content, request_tokens)
+
+
 # Function to generate image with OpenAI API
 def generate_image(image_prompt, model="dall-e-3"):
-    response = client.images.generate(
+    response = openai_caller.call(
+        model,
+        client.images.generate,
         model=model,
         prompt=image_prompt,
         size="1024x1024",
@@ -239,118 +458,115 @@ def generate_image(image_prompt, model="dall-e-3"):
 
 
 # Function to encode the image
-def encode_image_b64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-
-# Функция, которая получает на вход путь к картинке, декодирует ее в base64, отправляет по API в OpenAI и возвращает ответ
-def get_openai_image_recognition_response(image_path: str, user_request: str, max_output_tokens: int = 1000) -> dict:
-    base64_image = encode_image_b64(image_path)  # Getting the base64 string
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {client.api_key}"
-    }
-
-    payload = {
-        "model": "gpt-4o",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": user_request
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ],
-        "max_tokens": 1000
-    }
+def encode_image_b64(image_bytes: bytes) -> str:
+    return base64.b64encode(image_bytes).decode('utf-8')
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    # print(response.status_code)  # 200
-    return response.json()
+
+# Ф-я для выбора размера фото для распознавания: самый маленький из тех, что не будут уменьшены OpenAI сильнее, чем нужно
+def choose_vision_photo_size(photo_sizes: list, detail: str = VISION_DETAIL) -> types.PhotoSize:
+    if detail == "low":
+        is_enough = lambda size: max(size.width, size.height) >= 512
+    else:
+        is_enough = lambda size: min(size.width, size.height) >= 768
+    suitable_sizes = [size for size in photo_sizes if is_enough(size)]
+    if not suitable_sizes:  # Фото меньше, чем нужно модели - берем самое большое
+        return max(photo_sizes, key=lambda size: size.width * size.height)
+    return min(suitable_sizes, key=lambda size: size.width * size.height)
+
+
+# Функция, которая получает на вход картинку, кодирует ее в base64, отправляет по API в OpenAI и возвращает ответ
+# Запрос идет через общий клиент: переиспользует соединения, таймауты, OPENAI_BASE_URL и политику повторов openai_caller
+def get_openai_image_recognition_response(image_bytes: bytes, user_request: str, max_output_tokens: int = 1000, model: str = PREMIUM_MODEL):
+    base64_image = encode_image_b64(image_bytes)  # Getting the base64 string
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": user_request
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{base64_image}",
+                        "detail": VISION_DETAIL
+                    }
+                }
+            ]
+        }
+    ]
+
+    return openai_caller.call(
+        model,
+        client.chat.completions.create,
+        model=model,
+        messages=messages,
+        max_tokens=max_output_tokens
+    )
 
 
 # Function to get all user's referrals
 def get_user_referrals(user_id: int) -> list:
-    user_referrals = []
-    for user in data:
-        if data[user].get("ref_id") == user_id:
-            user_referrals.append(user)
-
-    return user_referrals
+    return user_store.get_referrals(user_id)
 
 
 def get_recent_active_users(days: int) -> list:
-    recent_active_users = []
-    current_date = datetime.now() + timedelta(hours=UTC_HOURS_DELTA)
+    # Список уже отсортирован по дате последнего запроса от новых к старым
+    recent_active_users = user_store.recent_users(time.time() - days * 24 * 60 * 60)
 
-    for user_id, user_data in data.items():
-        if user_id == "global":
-            continue
+    # Extract only user_id from the sorted list
+    recent_active_users = [user_id for user_id, _ in recent_active_users]
 
-        try:
-            last_request_date = datetime.strptime(user_data["lastdate"], DATE_FORMAT)
-        # Если дата в неправильном формате, то пропускаем строчку (значит у юзера все равно 0 запросов, а Вы - олд)
-        except ValueError:
-            continue
+    return recent_active_users
 
-        if (current_date - last_request_date).days < days:
-            recent_active_users.append((user_id, last_request_date))
 
-    # Sort the list by last_request_date in descending order
-    recent_active_users = sorted(recent_active_users, key=lambda x: x[1], reverse=True)
+# Function to convert the displayed date of the last request (server time + UTC_HOURS_DELTA) to unix time
+def parse_lastdate_timestamp(lastdate: str) -> Optional[float]:
+    # "%d-%m-%Y" - формат, в котором раньше создавалась запись админа
+    for date_format in (DATE_FORMAT, "%d-%m-%Y %H:%M:%S"):
+        try:
+            return (datetime.strptime(lastdate, date_format) - timedelta(hours=UTC_HOURS_DELTA)).timestamp()
+        except (TypeError, ValueError):
+            continue
+    return None
 
-    # Extract only user_id from the sorted list
-    recent_active_users = [user_id for user_id, _ in recent_active_users]
 
-    return recent_active_users
+# Добавляем lastdate_ts юзерам из старых версий data.json (один раз, дальше поле пишется при каждом запросе)
+def migrate_lastdate_timestamps() -> None:
+    for user_id, user_data in user_store.users():
+        if "lastdate_ts" not in user_data:
+            user_store.set(user_id, "lastdate_ts", parse_lastdate_timestamp(user_data.get("lastdate")) or 0)
 
 
-# Function to get top users by specified parameter from data.json (requests, tokens, balance, etc.)
+# Function to get top users by specified parameter from the user store (requests, tokens, balance, etc.)
 def get_top_users_by_data_parameter(max_users: int, parameter: str) -> list:
-    top_users = [(user_id, user_data[parameter]) for user_id, user_data in data.items() if user_id != "global" and user_data.get(parameter, 0) > 0]
-    top_users = sorted(top_users, key=lambda x: x[1], reverse=True)
-    top_users = top_users[:max_users]
-
-    return top_users
+    return user_store.top_users(parameter, max_users)
 
 
 # Function to get top users by invited referrals
 def get_top_users_by_referrals(max_users: int) -> list:
-    top_users = [(user_id, len(get_user_referrals(user_id))) for user_id in list(data.keys())[1:]]
-    top_users = [user for user in top_users if user[1] > 0]
-    top_users = sorted(top_users, key=lambda x: x[1], reverse=True)
-    top_users = top_users[:max_users]
-
-    return top_users
+    # В индексе рефералов есть только юзеры, у которых есть хотя бы один реферал
+    return user_store.top_referrers(max_users)
 
 
 # Function to get top users by cost of their requests
 def get_top_users_by_cost(max_users: int) -> list:
-    top_users = [(user_id, calculate_cost(data[user_id]['tokens'], data[user_id].get('premium_tokens', 0), data[user_id].get('images', 0))) for user_id in list(data.keys())[1:]]
-    top_users = [(user[0], round(user[1], 3)) for user in top_users if user[1] > 0]
-    top_users = sorted(top_users, key=lambda x: x[1], reverse=True)
-    top_users = top_users[:max_users]
+    # То же, что calculate_cost(tokens, premium_tokens, images), но считается хранилищем без выгрузки всех юзеров
+    cost_weights = {"tokens": PRICE_CENTS, "premium_tokens": PREMIUM_PRICE_CENTS, "images": IMAGE_PRICE_CENTS}
+    top_users = user_store.top_users_by_weighted_sum(cost_weights, max_users)
 
-    return top_users
+    return [(user_id, round(cost, 3)) for user_id, cost in top_users]
 
 
 # Function to get user current model
 def get_user_active_model(user_id: int) -> str:
-    if data[user_id].get("lang_model") is None:
+    lang_model = user_store.get_user(user_id).get("lang_model")
+    if lang_model is None:
         return DEFAULT_MODEL
     else:
-        model = str(data[user_id]["lang_model"])
+        model = str(lang_model)
         if model == "premium":
             return PREMIUM_MODEL
         else:
@@ -387,7 +603,8 @@ def format_cents_to_price_string(price: float) -> str:
 # Если deduct_tokens = False, то токены не будут списаны с баланса (например, при запросах администратора)
 # Вызывать, только если у пользователя положительный баланс используемых токенов!
 def update_global_user_data(user_id: int, new_requests: int = 1, new_tokens: int = None, new_premium_tokens: int = None,
-                            new_images: int = None, new_whisper_seconds: int = None, deduct_tokens: bool = True) -> None:
+                            new_images: int = None, new_whisper_seconds: int = None, deduct_tokens: bool = True,
+                            is_api_usage: bool = True) -> None:
     """
     This function updates the global and user-specific data based on the new requests, spent tokens, premium tokens and generated images.
     It also updates the session counters for requests, tokens, premium tokens, and images.
@@ -413,50 +630,214 @@ def update_global_user_data(user_id: int, new_requests: int = 1, new_tokens: int
     :param deduct_tokens: Whether to deduct the tokens from the user's balance
     :type deduct_tokens: bool
 
+    :param is_api_usage: Whether the tokens were spent on the OpenAI API. False for the answers from the response cache:
+                         only the user's data is updated, the global and session spendings are not
+    :type is_api_usage: bool
+
     :returns: None
     """
-    global data, session_request_counter, session_tokens, premium_session_tokens, session_images, session_whisper_seconds  # Глобальные счетчики текущей сессии
+    # Под блокировкой хранилища, чтобы параллельные запросы не перезаписали баланс друг друга
+    with user_store.lock:
+        # Собираем только изменившиеся поля, чтобы записать в журнал одну строку на юзера вместо перезаписи всего файла
+        user_data = user_store.get_user(user_id)
+        global_data = user_store.get_global()
+        # lastdate - строка для отображения, lastdate_ts - unix time для выборок по времени
+        user_changes = {"requests": user_data["requests"] + new_requests,
+                        "lastdate": (datetime.now() + timedelta(hours=UTC_HOURS_DELTA)).strftime(DATE_FORMAT),
+                        "lastdate_ts": time.time()}
+        global_changes = {"requests": global_data["requests"] + new_requests}
 
-    data[user_id]["requests"] += new_requests
-    data["global"]["requests"] += new_requests
-    session_request_counter += new_requests
+        if new_tokens:
+            user_changes["tokens"] = user_data["tokens"] + new_tokens
+            global_changes["tokens"] = global_data["tokens"] + new_tokens
 
-    data[user_id]["lastdate"] = (datetime.now() + timedelta(hours=UTC_HOURS_DELTA)).strftime(DATE_FORMAT)
+            if deduct_tokens:
+                user_changes["balance"] = user_data["balance"] - new_tokens
 
-    if new_tokens:
-        data[user_id]["tokens"] += new_tokens
-        data["global"]["tokens"] += new_tokens
-        session_tokens += new_tokens
+        if new_premium_tokens:
+            user_changes["premium_tokens"] = user_data.get("premium_tokens", 0) + new_premium_tokens
+            global_changes["premium_tokens"] = global_data.get("premium_tokens", 0) + new_premium_tokens
 
-        if deduct_tokens:
-            data[user_id]["balance"] -= new_tokens
+            if deduct_tokens:
+                user_changes["premium_balance"] = user_data["premium_balance"] - new_premium_tokens
 
-    if new_premium_tokens:
-        data[user_id]["premium_tokens"] = data[user_id].get("premium_tokens", 0) + new_premium_tokens
-        data["global"]["premium_tokens"] = data["global"].get("premium_tokens", 0) + new_premium_tokens
-        premium_session_tokens += new_premium_tokens
+        if new_images:
+            user_changes["images"] = user_data.get("images", 0) + new_images
+            global_changes["images"] = global_data.get("images", 0) + new_images
 
-        if deduct_tokens:
-            data[user_id]["premium_balance"] -= new_premium_tokens
+            if deduct_tokens:
+                user_changes["image_balance"] = user_data["image_balance"] - new_images
 
-    if new_images:
-        data[user_id]["images"] = data[user_id].get("images", 0) + new_images
-        data["global"]["images"] = data["global"].get("images", 0) + new_images
-        session_images += new_images
+        if new_whisper_seconds:
+            user_changes["whisper_seconds"] = user_data.get("whisper_seconds", 0) + new_whisper_seconds
+            global_changes["whisper_seconds"] = global_data.get("whisper_seconds", 0) + new_whisper_seconds
 
-        if deduct_tokens:
-            data[user_id]["image_balance"] -= new_images
+            if deduct_tokens:
+                # user_changes["balance"] = user_data["balance"] - new_whisper_seconds * 100
+                # минута Виспера - 400 прем токенов (6.666 токенов за 1 секунду), но сейчас скидка 10%
+                user_changes["premium_balance"] = user_changes.get("premium_balance", user_data["premium_balance"]) - new_whisper_seconds * 6
 
-    if new_whisper_seconds:
-        data[user_id]["whisper_seconds"] = data[user_id].get("whisper_seconds", 0) + new_whisper_seconds
-        data["global"]["whisper_seconds"] = data["global"].get("whisper_seconds", 0) + new_whisper_seconds
-        session_whisper_seconds += new_whisper_seconds
+        if not is_api_usage:
+            global_changes = {"requests": global_changes["requests"]}
 
-        if deduct_tokens:
-            # data[user_id]["balance"] -= new_whisper_seconds * 100
-            data[user_id]["premium_balance"] -= new_whisper_seconds * 6  # минута Виспера - 400 прем токенов (6.666 токенов за 1 секунду), но сейчас скидка 10%
+        user_store.update(user_id, user_changes)
+        user_store.update("global", global_changes)
 
-    update_json_file(data)
+    if not is_api_usage:
+        session.add(new_requests)
+        return
+    session.add(new_requests, new_tokens or 0, new_premium_tokens or 0, new_images or 0, new_whisper_seconds or 0)
+
+
+def check_chat_request(message: types.Message, bot_id: int = None) -> tuple:
+    """
+    This function checks if the user can make a chat request and chooses the language model for it.
+    The `/pro` command prefix is removed from `message.text`.
+    It doesn't send anything to Telegram, so it can be used by both sync and async handlers.
+
+    :param message: The user's message
+    :type message: telebot.types.Message
+
+    :param bot_id: The bot's user ID, required only if the message is a reply
+    :type bot_id: int
+
+    :return: `(user_model, None)` if the request is allowed, otherwise `(None, refusal)`, where `refusal` is a dict
+             with `text` and `parse_mode` of the reply to the user, or None if the message must be silently ignored
+    :rtype: tuple
+    """
+    user = message.from_user
+
+    # Если пользователя нет в базе, то перенаправляем его на команду /start и выходим
+    if not is_user_exists(user.id):
+        if is_user_blacklisted(user.id):
+            return None, None
+        return None, {"text": "Вы не зарегистрированы в системе. Напишите /start\n\n"
+                              "Подсказка: за регистрацию по рефке вы получите на 50% больше токенов!", "parse_mode": None}
+
+    # Если юзер ответил на ответ боту другого юзера в групповом чате, то выходим, отвечать не нужно (issue #27)
+    if message.reply_to_message is not None and message.reply_to_message.from_user.id != bot_id and not (message.text or "").startswith('/'):
+        # print(f"\nUser {user.full_name} @{user.username} replied to another user, skip")
+        return None, None
+
+    if message.content_type == "text" and extract_command(message.text) in ["pro", "prem", "premium", "gpt4"]:
+        user_model = PREMIUM_MODEL
+        message.text = extract_arguments(message.text)
+        if message.text == "":
+            return None, {"text": "Введите текст после команды /pro или /gpt4 для обращения к *GPT-4* без смены активной языковой модели\n\n"
+                                  "Пример: `/pro напиши код калькулятора на python`", "parse_mode": "Markdown"}
+    else:
+        user_model = get_user_active_model(user.id)
+
+    # Проверяем, есть ли у пользователя токены на балансе в зависимости от выбранной языковой модели
+    if user_model == DEFAULT_MODEL:
+        if not has_positive_balance(user.id):
+            return None, {"text": 'У вас закончились токены, пополните баланс!\n'
+                                  '<span class="tg-spoiler">/help в помощь</span>', "parse_mode": "HTML"}
+
+    elif user_model == PREMIUM_MODEL:
+        if not has_positive_balance(user.id, "premium_balance"):
+            return None, {"text": 'У вас закончились премиальные токены, пополните баланс!', "parse_mode": "HTML"}
+
+    else:  # Этого случая не может произойти, но пусть будет описан
+        print(f"\nUser {user.full_name} @{user.username} has no access to model {user_model}")
+        return None, {"text": 'У вас нет доступа к этой модели, обратитесь к админу!', "parse_mode": None}
+
+    return user_model, None
+
+
+def prepare_chat_request_messages(message: types.Message, user_model: str = DEFAULT_MODEL) -> tuple:
+    """
+    This function builds the list of messages for the chat request: the extended context with the new user's message
+    (loaded from disk and trimmed) if it's enabled, the replied message if there is one, or just the user's message.
+
+    :param message: The user's message (with `text` already set, e.g. after voice transcription)
+    :type message: telebot.types.Message
+
+    :param user_model: The language model of the request, the extended context is trimmed to fit its context window
+    :type user_model: str
+
+    :return: `(messages, is_chat_context_enabled)`
+    :rtype: tuple
+    """
+    user_id = message.from_user.id
+    system_prompt = get_user_prompt(user_id)
+
+    if is_user_extended_chat_context_enabled(user_id):
+        # Добавляем сообщение пользователя в расширенный контекст (история загружается из файла, если ее еще нет в оперативке)
+        with metrics.timer("context_load", user_model):
+            update_user_chat_context(user_id, [{"role": "user", "content": message.text}], save_to_file=False, lang_model=user_model)
+
+        # Сокращаем историю чата до максимальной длины в символах и до окна контекста модели (округление вниз до целого сообщения)
+        with metrics.timer("context_trim", user_model):
+            trim_user_chat_context(user_id, get_user_max_chat_context_length(user_id), get_chat_context_token_budget(user_model, system_prompt), user_model)
+
+        extended_context_messages = get_user_chat_context(user_id).messages()
+        return build_chatgpt_messages(message.text, system_prompt=system_prompt, extended_context_messages=extended_context_messages), True
+
+    # Если юзер написал запрос в ответ на сообщение бота, то добавляем предыдущий ответ бота в запрос
+    if message.reply_to_message is not None:
+        prev_answer = message.reply_to_message.caption or message.reply_to_message.text
+        return build_chatgpt_messages(message.text, prev_answer=prev_answer, system_prompt=system_prompt), False
+
+    return build_chatgpt_messages(message.text, system_prompt=system_prompt), False
+
+
+def finish_chat_request(message: types.Message, user_model: str, request_tokens: int, response_content: str,
+                        is_chat_context_enabled: bool, voice_duration: int = None, is_cached: bool = False) -> str:
+    """
+    This function bills the user for the chat request, saves the answer to the extended context and creates the admin report.
+
+    :param message: The user's message
+    :type message: telebot.types.Message
+
+    :param user_model: The language model used for the request
+    :type user_model: str
+
+    :param request_tokens: The number of tokens used for the request
+    :type request_tokens: int
+
+    :param response_content: The text of the model's answer
+    :type response_content: str
+
+    :param is_chat_context_enabled: Whether the extended chat context was used for the request
+    :type is_chat_context_enabled: bool
+
+    :param voice_duration: The duration of the transcribed voice message in seconds (default is None)
+    :type voice_duration: int
+
+    :param is_cached: Whether the answer was taken from the response cache (`request_tokens` are billed, but not spent)
+    :type is_cached: bool
+
+    :return: The admin log of the request (use `parse_mode="HTML"`)
+    :rtype: str
+    """
+    user = message.from_user
+
+    update_global_user_data(
+        user.id,
+        new_tokens=request_tokens if user_model == DEFAULT_MODEL else None,
+        new_premium_tokens=request_tokens if user_model == PREMIUM_MODEL else None,
+        new_whisper_seconds=voice_duration,
+        deduct_tokens=True if user.id != ADMIN_ID else False,
+        is_api_usage=not is_cached
+    )
+    refresh_user_names(user)
+
+    # Считаем стоимость запроса в центах в зависимости от выбранной модели
+    current_price_cents = PREMIUM_PRICE_CENTS if user_model == PREMIUM_MODEL else PRICE_CENTS
+    request_price_cents = request_tokens * current_price_cents + (voice_duration or 0) * WHISPER_SEC_PRICE_CENTS
+
+    if is_chat_context_enabled:
+        update_user_chat_context(user.id, [{"role": "assistant", "content": response_content}], lang_model=user_model)
+        schedule_chat_context_summary(user.id)
+
+    # Формируем лог работы для админа
+    admin_log = "ПРЕМ " if user_model == PREMIUM_MODEL else ""
+    admin_log += "КЭШ " if is_cached else ""
+    admin_log += "ВОЙС " if voice_duration is not None else ""
+    admin_log += "EC " if is_chat_context_enabled else ""
+    admin_log += create_request_report(user, message.chat, request_tokens, request_price_cents, voice_duration)
+    return admin_log
 
 
 def send_smart_split_message(bot_instance: telebot.TeleBot, chat_id: int, text: str, max_length: int = 4096, parse_mode: str = None, reply_to_message_id: int = None) -> None:
@@ -496,6 +877,99 @@ def send_smart_split_message(bot_instance: telebot.TeleBot, chat_id: int, text:
         time.sleep(0.1)  # Introduce a small delay between each message to avoid hitting Telegram's rate limits
 
 
+def apply_streaming_operation(bot_instance: telebot.TeleBot, chat_id: int, message_ids: list, operation: tuple,
+                              parse_mode: str = None, reply_parameters: types.ReplyParameters = None) -> None:
+    """
+    Execute one operation of the `StreamingMessageBuffer`: send a new message or edit the already sent one.
+    Failed edits are skipped (the next edit brings the message up to date), failed sends are raised.
+    """
+    action, index, text = operation
+    try:
+        if action == "send":
+            message_ids.append(bot_instance.send_message(chat_id, text, parse_mode=parse_mode, reply_parameters=reply_parameters).message_id)
+        else:
+            bot_instance.edit_message_text(text, chat_id, message_ids[index], parse_mode=parse_mode)
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" in e.description:
+            return
+        if parse_mode is not None:  # Ошибка форматирования - отправляем без него
+            apply_streaming_operation(bot_instance, chat_id, message_ids, operation, reply_parameters=reply_parameters)
+        elif action == "send":
+            raise
+        else:
+            print(f"\nНе удалось обновить сообщение со стримом ответа: {e}")
+
+
+def send_streaming_chatgpt_response(bot_instance: telebot.TeleBot, message: types.Message, messages: list, lang_model: str) -> tuple:
+    """
+    This function gets the response from OpenAI API with streaming and shows it to the user as it's generated:
+    the first message is sent as soon as the first tokens arrive, then it's edited with the rate limit
+    and continued in new messages after 4096 characters. The final text is formatted with Markdown.
+    If the stream breaks after a part of the answer was sent, the error is not raised: the part is returned and billed.
+
+    :param bot_instance: The Telebot instance to use for sending the messages
+    :type bot_instance: telebot.TeleBot
+
+    :param message: The message of the user with the request
+    :type message: telebot.types.Message
+
+    :param messages: The messages for the OpenAI API request
+    :type messages: list
+
+    :param lang_model: The language model to use
+    :type lang_model: str
+
+    :return: The response text, the number of tokens spent on the request and whether the answer is complete
+    :rtype: tuple
+    """
+    started = time.perf_counter()
+    chat_id = message.chat.id
+    # В групповом чате отвечать на конкретное сообщение, а не просто отправлять сообщение в чат
+    if message.chat.type == "private":
+        reply_parameters = None
+        edit_interval = STREAM_EDIT_INTERVAL
+    else:
+        reply_parameters = types.ReplyParameters(message.message_id, allow_sending_without_reply=True)
+        edit_interval = STREAM_GROUP_EDIT_INTERVAL
+
+    buffer = StreamingMessageBuffer(edit_interval=edit_interval)
+    message_ids = []
+    request_tokens = None
+    is_complete = True
+
+    try:
+        with closing(get_chatgpt_response_stream(messages, lang_model=lang_model)) as stream:  # Ошибка Telegram тоже освобождает слот
+            for chunk in stream:
+                usage_tokens = get_chunk_usage_tokens(chunk)
+                if usage_tokens is not None:
+                    request_tokens = usage_tokens
+
+                for operation in buffer.feed(get_chunk_content(chunk)):
+                    apply_streaming_operation(bot_instance, chat_id, message_ids, operation, reply_parameters=reply_parameters)
+                    if operation[0] == "send" and len(message_ids) == 1:  # Юзер увидел начало ответа
+                        metrics.observe("first_token", time.perf_counter() - started, lang_model)
+
+        for operation in buffer.finish():
+            apply_streaming_operation(bot_instance, chat_id, message_ids, operation, parse_mode="Markdown", reply_parameters=reply_parameters)
+    except Exception as e:
+        if not message_ids:  # Юзер еще ничего не получил - обычная ошибка запроса
+            raise
+        # Часть ответа уже у юзера: не шлем ему общую ошибку, а списываем токены за полученную часть
+        print(f"\nСтрим ответа прервался после {len(buffer.text)} символов: {e}")
+        is_complete = False
+        try:  # Досылаем то, что успели получить
+            for operation in buffer.finish():
+                apply_streaming_operation(bot_instance, chat_id, message_ids, operation, reply_parameters=reply_parameters)
+        except Exception as e:
+            print(f"\nНе удалось дослать прерванный ответ: {e}")
+
+    # API не прислал usage (например, прокси его вырезает или стрим прервался) - считаем токены сами
+    if request_tokens is None:
+        request_tokens = estimate_request_tokens(messages, buffer.text, lang_model)
+
+    return buffer.text, request_tokens, is_complete
+
+
 def create_request_report(user: telebot.types.User, chat: telebot.types.Chat, request_tokens: int, request_price: float, voice_seconds: int = None) -> str:
     """
     This function creates a report for the user's request.
@@ -521,50 +995,57 @@ def create_request_report(user: telebot.types.User, chat: telebot.types.Chat, re
     """
 
     voice_seconds_info = f" ({voice_seconds} сек)" if voice_seconds is not None else ""
-    request_info = f"Запрос {session_request_counter}: {request_tokens}{voice_seconds_info} за {format_cents_to_price_string(request_price)}\n"
+    request_info = f"Запрос {session.requests}: {request_tokens}{voice_seconds_info} за {format_cents_to_price_string(request_price)}\n"
 
-    session_cost_cents = calculate_cost(session_tokens, premium_session_tokens, session_images, session_whisper_seconds)
-    session_info = f"Сессия: {session_tokens + premium_session_tokens} за {format_cents_to_price_string(session_cost_cents)}\n"
+    session_cost_cents = calculate_cost(session.tokens, session.premium_tokens, session.images, session.whisper_seconds)
+    session_info = f"Сессия: {session.tokens + session.premium_tokens} за {format_cents_to_price_string(session_cost_cents)}\n"
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        session_info += f"Кэш ответов: {cache_stats['hits']} попаданий, {cache_stats['misses']} промахов\n"
 
     username = f"@{user.username} " if user.username is not None else ""
     user_info = f"Юзер: {telebot.util.escape(user.full_name)} {username}<code>{user.id}</code>\n"
 
-    balance_info = f"Баланс: {data[user.id]['balance']}; {data[user.id].get('premium_balance', '')}\n"
+    user_data = user_store.get_user(user.id)
+    balance_info = f"Баланс: {user_data['balance']}; {user_data.get('premium_balance', '')}\n"
     chat_info = f"Чат: {telebot.util.escape(chat.title)} {chat.id}\n" if chat.id < 0 else ""  # Если сообщение было в групповом чате, то указать данные о нём
 
-    global_cost_cents = calculate_cost(data['global']['tokens'], data['global'].get('premium_tokens', 0), data['global'].get('images', 0), data['global'].get('whisper_seconds', 0))
-    global_info = f"{data['global']} за {format_cents_to_price_string(global_cost_cents)}"
+    global_data = user_store.get_global()
+    global_cost_cents = calculate_cost(global_data['tokens'], global_data.get('premium_tokens', 0), global_data.get('images', 0), global_data.get('whisper_seconds', 0))
+    global_info = f"{global_data} за {format_cents_to_price_string(global_cost_cents)}"
 
     report = f"{request_info}{session_info}{user_info}{balance_info}{chat_info}{global_info}"
     return report
 
 
-def convert_ogg_to_mp3(source_ogg_path: str) -> str:
+def transcribe_audio(audio_bytes: bytes, file_name: str) -> str:
     """
-    Convert an OGG audio file to MP3 format using pydub with ffmpeg.
-    Deletes the original OGG file after conversion.
+    Transcribe the audio with OpenAI Whisper model. The audio is sent from memory, the format is taken from `file_name`.
 
-    :param source_ogg_path: the path to the source OGG audio file.
-    :type source_ogg_path: str
+    :param audio_bytes: the audio file content.
+    :type audio_bytes: bytes
 
-    :return: the path to the converted MP3 audio file.
+    :param file_name: the name of the file for the API, e.g. `voice.ogg`.
+    :type file_name: str
+
+    :return: the text transcription of the audio.
     :rtype: str
     """
-    mp3_path = source_ogg_path.replace(".ogg", ".mp3")
-
-    # load the ogg file using pydub
-    sound = AudioSegment.from_ogg(source_ogg_path)
-
-    # save the mp3 file
-    sound.export(mp3_path, format="mp3")
-
-    os.remove(source_ogg_path)
-    return mp3_path
+    with metrics.timer("openai", "whisper-1"):
+        transcription = openai_caller.call(
+            "whisper-1",
+            client.audio.transcriptions.create,
+            model="whisper-1",
+            file=(file_name, audio_bytes)
+        )
+    return transcription.text
 
 
 def convert_voice_message_to_text(message: telebot.types.Message) -> str:
     """
     Convert a voice message to text using OpenAI Whisper V2 model.
+    Telegram voice messages (OGG/Opus) are sent to Whisper as is, without temporary files,
+    the MP3 transcoding with ffmpeg (in the `transcoder` process pool) is only a fallback if the API rejects the OGG file.
 
     :param message: the Telegram message containing the voice message.
     :type message: telebot.types.Message
@@ -572,58 +1053,104 @@ def convert_voice_message_to_text(message: telebot.types.Message) -> str:
     :return: the text transcription of the voice message.
     :rtype: str
     """
-    # get the voice message
-    voice = message.voice
+    # download the voice message
+    with metrics.timer("download", "whisper-1"):
+        file_info = bot.get_file(message.voice.file_id)
+        downloaded_file = bot.download_file(file_info.file_path)
 
-    # get the file ID
-    file_id = voice.file_id
+    try:
+        return transcribe_audio(downloaded_file, "voice.ogg")
+    except openai.BadRequestError as e:  # Whisper не понял файл - перекодируем в mp3
+        print(f"\nWhisper не принял ogg, перекодируем в mp3: {e}")
+        with metrics.timer("transcode", "whisper-1"):
+            mp3_file = transcoder.transcode(downloaded_file)
+        return transcribe_audio(mp3_file, "voice.mp3")
 
-    # download the voice message
-    file_info = bot.get_file(file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
 
-    # save the downloaded voice message to a local file
-    voice_ogg_path = f"voice_{message.from_user.id}.ogg"
-    with open(voice_ogg_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
+def report_broadcast_progress(job: dict) -> None:
+    """
+    Send the progress of the running /announce broadcast to admin.
+    """
+    processed = job["position"]
+    total = len(job["recipients"])
+    minutes_left = (total - processed) / BROADCAST_RATE / 60
+    bot.send_message(ADMIN_ID, f"Рассылка: обработано {processed} из {total} ({processed * 100 // total}%), "
+                               f"отправлено {job['sent']}, ошибок {len(job['failed'])}.\n"
+                               f"Осталось примерно {minutes_left:.0f} мин.")
 
-    # convert the voice message from OGG to MP3 format
-    voice_mp3_path = convert_ogg_to_mp3(voice_ogg_path)
 
-    # open the converted MP3 file and create a transcription using OpenAI's Whisper model
-    with open(voice_mp3_path, "rb") as audio_file:
-        transcription = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file
-        )
+def report_broadcast_finish(job: dict) -> None:
+    """
+    Send the final report of the /announce broadcast to admin: the number of sent messages and the failed recipients.
+    """
+    admin_log = ""
+    for user_id in job["failed"]:
+        # Юзера могли удалить из базы, пока шла рассылка
+        user_data = user_store.get_user(user_id) if user_store.is_user_exists(user_id) else {"name": "", "username": ""}
+        admin_log += f"❌ {user_data['name']} {user_data['username']} {user_id}" + "\n"
 
-    # delete the MP3 file from disk
-    os.remove(voice_mp3_path)
-    return transcription.text
+    status = "отменена" if job["cancelled"] else "завершена"
+    admin_log = f"Рассылка {status}!\nОтправлено {job['sent']} из {len(job['recipients'])} сообщений." + \
+                ("\n\nНе доставлено:\n" + admin_log if admin_log else "")
 
+    send_smart_split_message(bot, ADMIN_ID, admin_log)
+    print(f"Рассылка {status}, логи отправлены админу")
 
-"""========================SETUP========================="""
 
+class SessionStats:
+    """
+    Request and token counters of the current bot session (since the last launch). Thread-safe.
+    """
 
-# Check if the file exists
-if os.path.isfile(DATAFILE):
-    # Read the contents of the file
-    with open(DATAFILE, "r", encoding='utf-8') as f:
-        data = json.load(f)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.tokens = 0
+        self.premium_tokens = 0
+        self.images = 0
+        self.whisper_seconds = 0
 
-    # Convert keys to integers (except for the first key)
-    for key in list(data.keys())[1:]:
-        data[int(key)] = data.pop(key)
-else:
-    data = {"global": {"requests": 0, "tokens": 0, "images": 0},
-            ADMIN_ID: {"requests": 0, "tokens": 0, "balance": 777777, "premium_balance": 77777, "image_balance": 777,
-                       "name": "АДМИН", "username": "@admin", "lastdate": "01-05-2023 00:00:00"}}
-    # Create the file with default values
-    update_json_file(data)
+    def add(self, requests: int = 0, tokens: int = 0, premium_tokens: int = 0, images: int = 0, whisper_seconds: int = 0) -> None:
+        with self.lock:
+            self.requests += requests
+            self.tokens += tokens
+            self.premium_tokens += premium_tokens
+            self.images += images
+            self.whisper_seconds += whisper_seconds
 
-# Папка для хранения расширенного контекста, если ее еще нет
-os.makedirs(CHAT_CONTEXT_FOLDER, exist_ok=True)
-chat_context = {}
+
+"""========================SETUP========================="""
+
+
+# Load users and global data from the chosen storage backend
+if USER_STORE_BACKEND == "sqlite":
+    user_store = SQLiteUserStore(SQLITE_DATAFILE, import_path=DATAFILE)
+elif USER_STORE_BACKEND == "memory":
+    user_store = UserStore()
+else:  # Снапшот data.json + журнал изменений поверх него
+    user_store = JournalStore(DATAFILE, JOURNALFILE, JOURNAL_COMPACT_THRESHOLD, JOURNAL_COMPACT_INTERVAL)
+
+user_store.load(default_data={
+    "global": {"requests": 0, "tokens": 0, "images": 0},
+    ADMIN_ID: {"requests": 0, "tokens": 0, "balance": 777777, "premium_balance": 77777, "image_balance": 777,
+               "name": "АДМИН", "username": "@admin", "lastdate": "01.05.2023 00:00:00", "lastdate_ts": 0}
+})
+migrate_lastdate_timestamps()
+user_store.start_background_compaction()
+
+# Расширенный контекст юзеров: история в оперативке, файлы в CHAT_CONTEXT_FOLDER дописываются в фоне
+chat_context = ChatContextStore(CHAT_CONTEXT_FOLDER, CHAT_CONTEXT_FLUSH_INTERVAL,
+                                max_bytes=CHAT_CONTEXT_CACHE_MAX_BYTES, ttl=CHAT_CONTEXT_CACHE_TTL)
+chat_context.start()
+telegram_cache.get_me()  # Заполняем кэш при запуске, чтобы первый ответ не ждал запроса к Telegram
+telegram_cache.start()
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_FOLDER,
+                               RESPONSE_CACHE_MAX_DISK_ENTRIES) if RESPONSE_CACHE else None
+transcoder = TranscodingService(TRANSCODE_WORKERS, TRANSCODE_MAX_PENDING, TRANSCODE_TIMEOUT)
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ChatSummary")
+summarizing_users = set()
+summarizing_users_lock = threading.Lock()
+webhook_server = None  # WebhookServer в режиме вебхука
 
 # Calculate the price per token in cents
 PRICE_CENTS = PRICE_1K / 10
@@ -632,7 +1159,28 @@ IMAGE_PRICE_CENTS = IMAGE_PRICE * 100
 WHISPER_SEC_PRICE_CENTS = WHISPER_MIN_PRICE / 60 * 100
 
 # Session token and request counters
-session_request_counter, session_tokens, premium_session_tokens, session_images, session_whisper_seconds = 0, 0, 0, 0, 0  # TODO: мб бахнуть класс session
+session = SessionStats()
+
+# Очередь логов для админа, отправляется фоновым потоком
+admin_logs = AdminLogQueue(bot, ADMIN_ID, ADMIN_LOG_FLUSH_INTERVAL, ADMIN_LOG_MAX_QUEUE)
+admin_logs.start()
+
+# Текущее состояние кэшей и очередей для экспорта метрик
+metrics.gauge("chat_context_resident_bytes", "Memory used by the cached chat contexts", lambda: chat_context.stats()["resident_bytes"])
+metrics.gauge("chat_context_hit_rate", "Share of the chat context reads served from memory", lambda: chat_context.stats()["hit_rate"])
+metrics.gauge("response_cache_hits", "Responses served from the response cache", lambda: response_cache.stats()["hits"] if response_cache else 0)
+metrics.gauge("openai_retries", "Retried OpenAI requests", lambda: openai_caller.stats()["retries"])
+metrics.gauge("openai_rejected", "OpenAI requests rejected by the open circuit", lambda: openai_caller.stats()["rejected"])
+metrics.gauge("admin_log_queue", "Admin logs waiting to be sent", lambda: len(admin_logs.entries) + len(admin_logs.photos))
+if METRICS_PORT:
+    metrics.start_http_server(METRICS_PORT)
+
+# Фоновая рассылка /announce, незаконченная рассылка продолжается после перезапуска
+broadcaster = Broadcaster(bot, BROADCASTFILE, rate=BROADCAST_RATE, report_interval=BROADCAST_REPORT_INTERVAL,
+                          on_progress=report_broadcast_progress, on_finish=report_broadcast_finish)
+if broadcaster.resume():
+    job = broadcaster.progress()
+    bot.send_message(ADMIN_ID, f"Рассылка возобновлена с {job['position']} из {len(job['recipients'])} получателей")
 
 
 """====================ADMIN_COMMANDS===================="""
@@ -654,8 +1202,12 @@ def handle_data_command(message):
         return
 
     if target_user_string == '':  # Если аргументов нет, то отправить весь файл и указать общее число пользователей
-        bot.send_message(ADMIN_ID, f"Число пользователей: {len(data) - 1}\n\n"
+        cache_stats = chat_context.stats()
+        bot.send_message(ADMIN_ID, f"Число пользователей: {user_store.count_users()}\n\n"
+                                   f"Кэш контекста: {cache_stats['users']} юзеров, {cache_stats['resident_bytes'] / 1024:.0f} КБ, "
+                                   f"попаданий {cache_stats['hit_rate']:.0%}, вытеснено {cache_stats['evictions']}\n\n"
                                    f"Копия файла `{DATAFILE}`:", parse_mode="MARKDOWN")
+        user_store.export_json(DATAFILE)  # Выгружаем актуальные данные из хранилища в файл
         bot.send_document(ADMIN_ID, open(DATAFILE, "rb"))
         print("\nДанные отправлены админу")
         return
@@ -676,58 +1228,61 @@ def handle_data_command(message):
         bot.send_message(ADMIN_ID, not_found_string, parse_mode="MARKDOWN")
         return
 
-    if data[target_user_id].get("premium_balance") is not None:
-        premium_string = (f"premium tokens: {data[target_user_id].get('premium_tokens', 0)}\n"
-                          f"premium balance: {data[target_user_id]['premium_balance']}\n\n")
+    target_user_data = user_store.get_user(target_user_id)
+
+    if target_user_data.get("premium_balance") is not None:
+        premium_string = (f"premium tokens: {target_user_data.get('premium_tokens', 0)}\n"
+                          f"premium balance: {target_user_data['premium_balance']}\n\n")
     else:
         premium_string = ""
 
-    if "image_balance" in data[target_user_id]:
-        images_string = (f"images: {data[target_user_id].get('images', 0)}\n"
-                         f"image balance: {data[target_user_id]['image_balance']}\n\n")
+    if "image_balance" in target_user_data:
+        images_string = (f"images: {target_user_data.get('images', 0)}\n"
+                         f"image balance: {target_user_data['image_balance']}\n\n")
     else:
         images_string = ""
 
-    if "whisper_seconds" in data[target_user_id]:
-        whisper_string = f"whisper seconds: {data[target_user_id].get('whisper_seconds', 0)}\n\n"
+    if "whisper_seconds" in target_user_data:
+        whisper_string = f"whisper seconds: {target_user_data.get('whisper_seconds', 0)}\n\n"
     else:
         whisper_string = ""
 
-    if "max_context_length" in data[target_user_id]:
-        extended_context_string = f"max context length: {data[target_user_id]['max_context_length']}\n"
+    if "max_context_length" in target_user_data:
+        extended_context_string = f"max context length: {target_user_data['max_context_length']}\n"
     else:
         extended_context_string = ""
 
     # Если юзер был успешно найден, то формируем здесь сообщение с его статой
     user_data_string = f"id {target_user_id}\n" \
-                       f"{data[target_user_id]['name']} " \
-                       f"{data[target_user_id]['username']}\n\n" \
-                       f"requests: {data[target_user_id]['requests']}\n" \
-                       f"tokens: {data[target_user_id]['tokens']}\n" \
-                       f"balance: {data[target_user_id]['balance']}\n\n" \
+                       f"{target_user_data['name']} " \
+                       f"{target_user_data['username']}\n\n" \
+                       f"requests: {target_user_data['requests']}\n" \
+                       f"tokens: {target_user_data['tokens']}\n" \
+                       f"balance: {target_user_data['balance']}\n\n" \
                        f"{premium_string}" \
                        f"{images_string}" \
                        f"{whisper_string}" \
                        f"{extended_context_string}" \
-                       f"last request: {data[target_user_id]['lastdate']}\n"
+                       f"last request: {target_user_data['lastdate']}\n"
 
     # Calculate user cost in cents and round it to 3 digits after the decimal point
-    user_cost_cents = calculate_cost(data[target_user_id]['tokens'], data[target_user_id].get('premium_tokens', 0),
-                                     data[target_user_id].get('images', 0), data[target_user_id].get('whisper_seconds', 0))
+    user_cost_cents = calculate_cost(target_user_data['tokens'], target_user_data.get('premium_tokens', 0),
+                                     target_user_data.get('images', 0), target_user_data.get('whisper_seconds', 0))
     user_data_string += f"user cost: {format_cents_to_price_string(user_cost_cents)}\n\n"
 
     # Если есть инфа о количестве исполненных просьб на пополнение, то выдать ее
-    if "favors" in data[target_user_id]:
-        user_data_string += f"favors: {data[target_user_id]['favors']}\n\n"
+    if "favors" in target_user_data:
+        user_data_string += f"favors: {target_user_data['favors']}\n\n"
 
     # Если у пользователя есть промпт, то выдать его
-    if "prompt" in data[target_user_id]:
-        user_data_string += f"prompt: {data[target_user_id].get('prompt')}\n\n"
+    if "prompt" in target_user_data:
+        user_data_string += f"prompt: {target_user_data.get('prompt')}\n\n"
 
     # Если пользователя пригласили по рефке, то выдать информацию о пригласившем
-    if "ref_id" in data[target_user_id]:
-        referrer = data[target_user_id]["ref_id"]
-        user_data_string += f"invited by: {data[referrer]['name']} {data[referrer]['username']} {referrer}\n\n"
+    referrer = user_store.get_referrer(target_user_id)
+    if referrer is not None:
+        referrer_data = user_store.get_user(referrer)
+        user_data_string += f"invited by: {referrer_data['name']} {referrer_data['username']} {referrer}\n\n"
 
     user_referrals_list: list = get_user_referrals(target_user_id)
     if not user_referrals_list:  # Если рефералов нет, то просто отправляем текущие данные по пользователю
@@ -736,7 +1291,8 @@ def handle_data_command(message):
 
     user_data_string += f"{len(user_referrals_list)} invited users:\n"
     for ref in user_referrals_list:
-        user_data_string += f"{data[ref]['name']} {data[ref]['username']} {ref}: {data[ref]['requests']}\n"
+        ref_data = user_store.get_user(ref)
+        user_data_string += f"{ref_data['name']} {ref_data['username']} {ref}: {ref_data['requests']}\n"
 
     send_smart_split_message(bot, ADMIN_ID, user_data_string)
 
@@ -772,7 +1328,8 @@ def handle_recent_users_command(message):
 
     answer = f"Активные юзеры за последние {num_of_days} дней: {len(recent_active_users)}\n\n"
     for user_id in recent_active_users:
-        answer += f"{data[user_id]['name']} {data[user_id]['username']} {user_id}: {data[user_id]['requests']}\n"
+        user_data = user_store.get_user(user_id)
+        answer += f"{user_data['name']} {user_data['username']} {user_id}: {user_data['requests']}\n"
 
     send_smart_split_message(bot, ADMIN_ID, answer, reply_to_message_id=message.message_id)
 
@@ -817,13 +1374,42 @@ def handle_top_users_command(message):
     user_place = 1
     answer = f"Топ {max_users} пользователей by {parameter}:\n\n"
     for user_id, parameter_value in top_users:
-        answer += (f"{user_place}. {data[user_id]['name']} {data[user_id]['username'] if data[user_id]['username'] != 'None' else ''} "
+        user_data = user_store.get_user(user_id)
+        answer += (f"{user_place}. {user_data['name']} {user_data['username'] if user_data['username'] != 'None' else ''} "
                    f"{user_id}: {parameter_value}\n")
         user_place += 1
 
     send_smart_split_message(bot, ADMIN_ID, answer, reply_to_message_id=message.message_id)
 
 
+# Define the handler for the admin /perf command to get the latency of the request phases
+@bot.message_handler(commands=["perf", "latency"])
+def handle_perf_command(message):
+    if message.from_user.id != ADMIN_ID or message.chat.type != "private":
+        return
+
+    rows = metrics.summary()
+    if not rows:
+        bot.reply_to(message, "Запросов с момента запуска ещё не было")
+        return
+
+    table = f"{'этап':<14} {'модель':<18} {'n':>5} {'p50':>6} {'p95':>6} {'p99':>6}\n"
+    for phase, model, count, p50, p95, p99, _ in rows:
+        table += f"{phase:<14} {model[:18]:<18} {count:>5} {p50 * 1000:>6.0f} {p95 * 1000:>6.0f} {p99 * 1000:>6.0f}\n"
+
+    context_stats = chat_context.stats()
+    caller_stats = openai_caller.stats()
+    answer = (f"Время этапов запросов, мс:\n<pre>{telebot.util.escape(table)}</pre>\n"
+              f"Кэш контекста: попаданий {context_stats['hit_rate']:.0%}, {context_stats['resident_bytes'] / 1024:.0f} КБ\n")
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        answer += f"Кэш ответов: {cache_stats['hits']} попаданий, {cache_stats['misses']} промахов\n"
+    answer += (f"OpenAI: повторов {caller_stats['retries']}, отклонено {caller_stats['rejected']}"
+               f"{', открыты: ' + ', '.join(caller_stats['open_circuits']) if caller_stats['open_circuits'] else ''}")
+
+    send_smart_split_message(bot, ADMIN_ID, answer, parse_mode="HTML", reply_to_message_id=message.message_id)
+
+
 # Define the handler for the admin /refill command
 @bot.message_handler(commands=["r", "refill"])
 def handle_refill_command(message):
@@ -889,18 +1475,14 @@ def handle_refill_command(message):
         bot.send_message(ADMIN_ID, wrong_input_string, parse_mode="MARKDOWN")
         return
 
-    # Сначала проверяем, есть ли такой тип баланса у юзера (если нет, то создаем), а потом уже пополняем
-    if data[target_user_id].get(balance_type) is None:
-        data[target_user_id][balance_type] = 0
+    # Если такого типа баланса у юзера еще нет, то он создастся с нуля
+    new_balance = user_store.increment(target_user_id, balance_type, amount)
 
-    data[target_user_id][balance_type] += amount
-
-    update_json_file(data)
-    bot.send_message(ADMIN_ID, success_string + f"\nТекущий {prefix}баланс: {data[target_user_id][balance_type]}")
+    bot.send_message(ADMIN_ID, success_string + f"\nТекущий {prefix}баланс: {new_balance}")
     try:
         if amount > 0:
             bot.send_message(target_user_id, f"Ваш баланс пополнен на {amount} {prefix}токенов!\n"
-                                             f"Текущий {prefix}баланс: {data[target_user_id][balance_type]}")
+                                             f"Текущий {prefix}баланс: {new_balance}")
     except Exception as e:
         bot.send_message(ADMIN_ID, f"Ошибка при уведомлении юзера {target_user}, походу он заблочил бота 🤬")
         print(e)
@@ -942,8 +1524,7 @@ def handle_block_command(message):
         bot.send_message(ADMIN_ID, wrong_input_string, parse_mode="MARKDOWN")
         return
 
-    data[target_user]["blacklist"] = True
-    update_json_file(data)
+    user_store.set(target_user, "blacklist", True)
     bot.send_message(ADMIN_ID, success_string)
     print(success_string)
 
@@ -953,7 +1534,10 @@ def handle_block_command(message):
 def handle_stop_command(message):
     if message.from_user.id == ADMIN_ID:
         bot.reply_to(message, "Stopping the script...")
-        bot.stop_polling()
+        if webhook_server is not None:
+            webhook_server.request_stop()
+        else:
+            bot.stop_polling()
 
 
 # Define the handler for the /announce command
@@ -975,7 +1559,26 @@ def handle_announce_command(message):
                               "req1 - расылка всем пользователям, кто сделал хотя бы 1 запрос (любое значение)\n"
                               "bal1000 - рассылка всем пользователям с балансом от 1000 токенов (любое значение)\n"
                               "test - рассылка только админу (тест команды)\n\n"
-                              "Так же можно уведомить только одного пользователя, написав его user_id или @username")
+                              "Так же можно уведомить только одного пользователя, написав его user_id или @username\n\n"
+                              "status - прогресс текущей рассылки\n"
+                              "stop - отменить текущую рассылку")
+        return
+
+    if user_filter == "status":
+        job = broadcaster.progress()
+        if not broadcaster.is_running():
+            bot.reply_to(message, "Сейчас рассылок нет")
+        else:
+            report_broadcast_progress(job)
+        return
+
+    if user_filter == "stop":
+        if not broadcaster.cancel():  # Итоговый отчет отправит сам broadcaster
+            bot.reply_to(message, "Сейчас рассылок нет")
+        return
+
+    if broadcaster.is_running():
+        bot.reply_to(message, "Предыдущая рассылка еще идет!\n/announce status - прогресс, /announce stop - отмена")
         return
 
     bot.reply_to(message, "Введите текст сообщения для рассылки.\nq - отмена")
@@ -1001,7 +1604,7 @@ def process_announcement_message_step(message, user_filter):
                             "Отправить данное сообщение? (y/n)\n"
 
     elif user_filter == "all":
-        recepients_list = list(data.keys())[1:]
+        recepients_list = user_store.user_ids()
         confirmation_text = f"Получатели: все пользователи ({len(recepients_list)})\n\n" \
                             "Разослать данное сообщение? (y/n)\n"
 
@@ -1012,8 +1615,8 @@ def process_announcement_message_step(message, user_filter):
             return
 
         user_filter = int(user_filter)
-        for user_id in list(data.keys())[1:]:
-            if data[user_id]["requests"] >= user_filter:
+        for user_id, user_data in user_store.users():
+            if user_data["requests"] >= user_filter:
                 recepients_list.append(user_id)
         confirmation_text = f"Получатели: юзеры от {user_filter} запросов ({len(recepients_list)})\n\n" \
                             "Разослать данное сообщение? (y/n)\n"
@@ -1025,8 +1628,8 @@ def process_announcement_message_step(message, user_filter):
             return
 
         user_filter = int(user_filter)
-        for user_id in list(data.keys())[1:]:
-            if data[user_id]["balance"] >= user_filter:
+        for user_id, user_data in user_store.users():
+            if user_data["balance"] >= user_filter:
                 recepients_list.append(user_id)
         confirmation_text = f"Получатели: юзеры с балансом от {user_filter} токенов ({len(recepients_list)})\n\n" \
                             "Разослать данное сообщение? (y/n)\n"
@@ -1045,7 +1648,8 @@ def process_announcement_message_step(message, user_filter):
             return
 
         recepients_list.append(user_filter)
-        confirmation_text = f"Получатель: {data[user_filter]['name']} {data[user_filter]['username']} {user_filter}\n\n" \
+        user_data = user_store.get_user(user_filter)
+        confirmation_text = f"Получатель: {user_data['name']} {user_data['username']} {user_filter}\n\n" \
                             "Разослать данное сообщение? (y/n)\n"
 
     elif user_filter[0] == "@":
@@ -1055,7 +1659,8 @@ def process_announcement_message_step(message, user_filter):
             return
 
         recepients_list.append(user_filter)
-        confirmation_text = f"Получатель: {data[user_filter]['name']} {data[user_filter]['username']} {user_filter}\n\n" \
+        user_data = user_store.get_user(user_filter)
+        confirmation_text = f"Получатель: {user_data['name']} {user_data['username']} {user_filter}\n\n" \
                             "Отправить данное сообщение? (y/n)\n"
 
     else:
@@ -1093,23 +1698,9 @@ def process_announcement_confirmation_step(message, recepients_list, announcemen
         print(admin_log)
         return
 
-    msg_counter = 0
-    admin_log = ""
-    for user_id in recepients_list:
-        try:
-            bot.send_message(user_id, announcement_text, parse_mode="HTML")
-            msg_counter += 1
-            admin_log += f"✉️ {data[user_id]['name']} {data[user_id]['username']} {user_id}" + "\n"
-            time.sleep(0.5)
-        except Exception as e:
-            # print(e)
-            admin_log += f"❌ {data[user_id]['name']} {data[user_id]['username']} {user_id}" + "\n"
-
-    admin_log = f"Рассылка завершена!\nОтправлено {msg_counter} из {len(recepients_list)} сообщений." + "\n\nПолучатели:\n" + admin_log
-
-    send_smart_split_message(bot, ADMIN_ID, admin_log)
-
-    print("Рассылка успешно завершена, логи отправлены админу")
+    # Рассылка идет в фоне, бот продолжает отвечать пользователям. Прогресс и итоговый отчет придут админу
+    if not broadcaster.start(recepients_list, announcement_text):
+        bot.send_message(user.id, "Предыдущая рассылка еще идет, эта рассылка отменена")
 
 
 """====================USER_COMMANDS====================="""
@@ -1139,22 +1730,22 @@ def handle_start_command(message):
     referrer = extract_arguments(message.text)
     if referrer and referrer.isdigit() and is_user_exists(int(referrer)) and not is_user_blacklisted(int(referrer)):
         referrer = int(referrer)
-        invited_by_string = f"Ого, тебя пригласил 🤩{data[referrer]['name']}🤩\n\n" \
+        referrer_data = user_store.get_user(referrer)
+        invited_by_string = f"Ого, тебя пригласил 🤩{referrer_data['name']}🤩\n\n" \
                             f"На твой баланс дополнительно зачислено +{str(REFERRAL_BONUS)} токенов! 🎉"
         time.sleep(1.5)
         bot.send_message(message.chat.id, invited_by_string)
 
-        data[referrer]["balance"] += REFERRAL_BONUS
+        user_store.increment(referrer, "balance", REFERRAL_BONUS)
         ref_notification_string = f"Ого, по твоей ссылке присоединился 🤩{user.full_name}🤩\n\n" \
                                   f"Это заслуживает лайка и +{str(REFERRAL_BONUS)} токенов на счет! 🎉"
         bot.send_message(referrer, ref_notification_string)
 
-        new_referral_string = f"{data[referrer]['name']} {data[referrer]['username']} пригласил {user.full_name} 🤝\n"
+        new_referral_string = f"{referrer_data['name']} {referrer_data['username']} пригласил {user.full_name} 🤝\n"
     else:
         referrer = None
 
     add_new_user(user.id, user.first_name, user.username, referrer)
-    update_json_file(data)
 
     new_user_log = f"\nНовый пользователь: {user.full_name} " \
                    f"@{user.username} {user.id}!"
@@ -1194,7 +1785,7 @@ def handle_ref_command(message):
         ref_string = f"Пригласи друга по своей уникальной ссылке и раздели с ним 🎁*{REFERRAL_BONUS*2}*🎁 " \
                      f"токенов на двоих!\n\n" \
                      f"*Твоя реферальная ссылка:* \n" \
-                     f"`https://t.me/{bot.get_me().username}?start={user_id}`\n\n" \
+                     f"`https://t.me/{telegram_cache.get_me().username}?start={user_id}`\n\n" \
                      f"Зарабатывать еще никогда не было так легко! 🤑"
         bot.reply_to(message, ref_string, parse_mode="Markdown")
     else:
@@ -1214,9 +1805,10 @@ def handle_balance_command(message):
         return
 
     # Если юзер есть в базе, то выдаем его баланс
-    balance = data[user_id]["balance"]
-    prem_balance = data[user_id].get("premium_balance", 0)  # Если поля "premium_balance" нет в БД, то выводим 0
-    image_balance = data[user_id].get("image_balance", 0)
+    user_data = user_store.get_user(user_id)
+    balance = user_data["balance"]
+    prem_balance = user_data.get("premium_balance", 0)  # Если поля "premium_balance" нет в БД, то выводим 0
+    image_balance = user_data.get("image_balance", 0)
 
     balance_string = (f"Токены: {balance}\n"
                       f"Премиум токены: {prem_balance}\n"
@@ -1252,7 +1844,7 @@ def handle_stats_command(message):
     if not is_user_exists(user_id):
         bot.reply_to(message, "Вы не зарегистрированы в системе. Напишите /start")
 
-    user_data = data[user_id]
+    user_data = user_store.get_user(user_id)
     user_data_string = (f"Запросов: {user_data['requests']}\n"
                         f"Токенов использовано: {user_data['tokens']}\n"
                         f"Премиум токенов использовано: {user_data.get('premium_tokens', 0)}\n"
@@ -1262,12 +1854,14 @@ def handle_stats_command(message):
     if user_referrals_list:
         user_data_string += f"Вы пригласили {len(user_referrals_list)} пользователей:\n"
         for ref in user_referrals_list:
-            user_data_string += f"{data[ref]['name']} {data[ref]['username']}\n"
+            ref_data = user_store.get_user(ref)
+            user_data_string += f"{ref_data['name']} {ref_data['username']}\n"
 
     # Если пользователя пригласили по рефке, то выдать информацию о пригласившем
-    if "ref_id" in user_data:
-        referrer = user_data["ref_id"]
-        user_data_string += f"\nВас пригласил: {data[referrer]['name']} {data[referrer]['username']}\n\n"
+    referrer = user_store.get_referrer(user_id)
+    if referrer is not None:
+        referrer_data = user_store.get_user(referrer)
+        user_data_string += f"\nВас пригласил: {referrer_data['name']} {referrer_data['username']}\n\n"
 
     bot.reply_to(message, user_data_string)
 
@@ -1287,13 +1881,13 @@ def handle_prompt_command(message):
     # Если юзер есть в базе, то записываем промпт, иначе просим его зарегистрироваться
     if is_user_exists(user.id):
         if prompt:
-            data[user.id]["prompt"] = prompt
-            update_json_file(data)
+            user_store.set(user.id, "prompt", prompt)
             bot.reply_to(message, f"Установлен промпт: `{prompt}`", parse_mode="Markdown")
             print("\nУстановлен промпт: " + prompt)
         else:
-            if "prompt" in data[user.id]:
-                answer = f"*Текущий промпт:* `{str(data[user.id]['prompt'])}`\n\n"
+            current_prompt = user_store.get_user(user.id).get("prompt")
+            if current_prompt is not None:
+                answer = f"*Текущий промпт:* `{str(current_prompt)}`\n\n"
 
             answer += "Системный промпт - это специальное указание, которое будет использоваться ботом вместе "\
                       "с каждым запросом для придания определенного поведения и стиля ответа. \n\n"\
@@ -1317,9 +1911,8 @@ def handle_reset_prompt_command(message):
 
     # Если юзер есть в базе, то сбрасываем промпт, иначе просим его зарегистрироваться
     if is_user_exists(user.id):
-        if data[user.id].get("prompt") is not None:
-            del data[user.id]["prompt"]
-            update_json_file(data)
+        if user_store.get_user(user.id).get("prompt") is not None:
+            user_store.unset(user.id, "prompt")
             bot.reply_to(message, f"Системный промпт сброшен до значения по умолчанию")
             print("\nСистемный промпт сброшен до значения по умолчанию")
         else:
@@ -1357,8 +1950,7 @@ def handle_switch_model_command(message):
                               f"user_id: {user_id}\nМодель юзера: {user_model}")
         return
 
-    data[user_id]["lang_model"] = target_model_type
-    update_json_file(data)
+    user_store.set(user_id, "lang_model", target_model_type)
 
     bot.reply_to(message, f"Языковая модель успешно изменена!\n\n*Текущая модель*: {target_model} {postfix}", parse_mode="Markdown")
     print(f"Модель пользователя {user_id} изменена на {target_model_type}")
@@ -1375,24 +1967,25 @@ def handle_ask_favor_command(message):
     if not is_user_exists(user.id):
         return
 
+    user_data = user_store.get_user(user.id)
+
     if user.id == ADMIN_ID:
         bot.reply_to(message, f"У тебя уже анлимитед саплай токенов, бро")
         return
-    elif data[user.id]["balance"] > FAVOR_MIN_LIMIT:
+    elif user_data["balance"] > FAVOR_MIN_LIMIT:
         bot.reply_to(message, f"Не надо жадничать, бро!\nПриходи, когда у тебя будет меньше {FAVOR_MIN_LIMIT} токенов.")
         return
-    elif data[user.id].get("active_favor_request"):
+    elif user_data.get("active_favor_request"):
         bot.reply_to(message, f"У тебя уже есть активный запрос, бро")
         return
     else:
         bot.reply_to(message, "Ваша заявка отправлена на рассмотрение администратору 🙏\n")
-        data[user.id]["active_favor_request"] = True
-        update_json_file(data)
+        user_store.set(user.id, "active_favor_request", True)
 
         admin_invoice_string = f"Пользователь {user.full_name} @{user.username} {user.id} просит подачку!\n\n" \
-                               f"requests: {data[user.id]['requests']}\n" \
-                               f"tokens: {data[user.id]['tokens']}\n" \
-                               f"balance: {data[user.id]['balance']}\n\n" \
+                               f"requests: {user_data['requests']}\n" \
+                               f"tokens: {user_data['tokens']}\n" \
+                               f"balance: {user_data['balance']}\n\n" \
                                f"Оформляем?"
 
         # add two buttons to the message
@@ -1434,10 +2027,9 @@ def handle_extended_context_command(message):
             return
 
     if max_context == 0:
-        if data[user_id].get("max_context_length"):  # if is_user_extended_chat_context_enabled(user_id):
+        if user_store.get_user(user_id).get("max_context_length"):  # if is_user_extended_chat_context_enabled(user_id):
             delete_user_chat_context(user_id)
-            del data[user_id]["max_context_length"]
-            update_json_file(data)
+            user_store.unset(user_id, "max_context_length")
 
             bot.reply_to(message, "Расширенный контекст отключен, история диалога очищена. \nРаботаем в стандартном режиме")
         else:
@@ -1446,9 +2038,8 @@ def handle_extended_context_command(message):
         bot.reply_to(message, "Воу, полегче! Тебе такое не по карману, попробуй поумерить свой пыл.")
         return
     else:
-        # data[user_id]["is_chat_context_enabled"] = True
-        data[user_id]["max_context_length"] = max_context
-        update_json_file(data)
+        # user_store.set(user_id, "is_chat_context_enabled", True)
+        user_store.set(user_id, "max_context_length", max_context)
 
         bot.reply_to(message, f"Максимальная длина контекста установлена на {max_context} символов. \n\n"
                               f"Напоминание: теперь каждый запрос может расходовать до {max_context} токенов.\n"
@@ -1471,26 +2062,19 @@ def handle_favor_callback(call):
         return
 
     call_data_list[1] = int(call_data_list[1])
-    user = data[call_data_list[1]]
+    user = user_store.get_user(call_data_list[1])
 
     if call_data_list[0] == 'favor_yes':
         bot.answer_callback_query(call.id, "Заявка принята")
         bot.unpin_chat_message(ADMIN_ID, call.message.message_id)
 
-        if "favors" in user:
-            user["favors"] += 1
-        else:
-            user["favors"] = 1
-
-        user["balance"] += FAVOR_AMOUNT
-
-        if user.get("active_favor_request"):
-            del user["active_favor_request"]
-        update_json_file(data)
+        user_store.increment(call_data_list[1], "favors", 1)
+        user_store.increment(call_data_list[1], "balance", FAVOR_AMOUNT)
+        user_store.unset(call_data_list[1], "active_favor_request")
 
         bot.send_message(call_data_list[1], f"Ваши мольбы были услышаны! 🙏\n\n"
                                             f"Вам начислено {FAVOR_AMOUNT} токенов!\n"
-                                            f"Текущий баланс: {data[int(call_data_list[1])]['balance']}")
+                                            f"Текущий баланс: {user['balance']}")
 
         edited_admin_message = f"Заявка от {user['name']} {user['username']} {call_data_list[1]}\n\n" \
                                f"requests: {user['requests']}\n" \
@@ -1503,9 +2087,7 @@ def handle_favor_callback(call):
         bot.answer_callback_query(call.id, "Заявка отклонена")
         bot.unpin_chat_message(ADMIN_ID, call.message.message_id)
 
-        if user.get("active_favor_request"):
-            del user["active_favor_request"]
-        update_json_file(data)
+        user_store.unset(call_data_list[1], "active_favor_request")
 
         bot.send_message(call_data_list[1], "Вам было отказано в просьбе, попробуйте позже!")
 
@@ -1523,7 +2105,6 @@ def handle_favor_callback(call):
 # Define the handler for the /imagine command to generate AI image from text via OpenAi
 @bot.message_handler(commands=["i", "img", "image", "imagine"])
 def handle_imagine_command(message):
-    global session_images, data
     user = message.from_user
 
     if not is_user_exists(user.id):
@@ -1535,7 +2116,7 @@ def handle_imagine_command(message):
             return
 
     # Check for user IMAGE balance
-    if data[user.id].get("image_balance") is None or data[user.id]["image_balance"] <= 0:
+    if not has_positive_balance(user.id, "image_balance"):
         bot.reply_to(message, 'У вас закончились токены для генерации изображений, пополните баланс!')
         return
 
@@ -1549,12 +2130,14 @@ def handle_imagine_command(message):
 
     log_message = f"\nUser {user.id} {user.full_name} has requested image generation"
     print(log_message)
+    request_started = time.perf_counter()
 
     # Симулируем эффект отправки изображения, пока бот получает ответ
     bot.send_chat_action(message.chat.id, "upload_photo")
 
     try:
-        response = generate_image(image_prompt)
+        with metrics.timer("openai", "dall-e-3"):
+            response = generate_image(image_prompt)
     except openai.BadRequestError as e:
         # print(e.http_status)
         error_text = ("Произошла ошибка при генерации изображения 😵\n\n"
@@ -1576,7 +2159,8 @@ def handle_imagine_command(message):
     # revised_prompt = '<span class="tg-spoiler">' + response.data[0].revised_prompt + '</span>'
 
     try:
-        bot.send_photo(message.chat.id, image_url)
+        with metrics.timer("telegram_send", "dall-e-3"):
+            bot.send_photo(message.chat.id, image_url)
     except telebot.apihelper.ApiTelegramException as e:
         error_text = "Произошла ошибка при отправке сгенерированного изображения 😵\n\n"
 
@@ -1599,10 +2183,11 @@ def handle_imagine_command(message):
     )
 
     print("Image was generated and sent to user")
+    metrics.observe("total", time.perf_counter() - request_started, "dall-e-3")
 
     # Кидаем картинку с промптом админу в личку, чтобы он тоже окультуривался (но в обезличенном виде)
     if user.id != ADMIN_ID:
-        bot.send_photo(ADMIN_ID, image_url, caption=f"{image_prompt}\n\n")
+        admin_logs.add_photo(image_url, caption=image_prompt)
 
 
 # Define the handler for the /vision command to use `gpt-4-vision-preview` model for incoming images
@@ -1610,7 +2195,6 @@ def handle_imagine_command(message):
 @bot.message_handler(func=lambda message: message.caption is not None, content_types=["photo"])
 def handle_vision_command(message: types.Message):
     user = message.from_user
-    image_path = "image_for_vision_" + str(user.id) + ".jpg"
 
     # Если пользователя нет в базе, то перенаправляем его на команду /start и выходим
     if not is_user_exists(user.id):
@@ -1624,120 +2208,89 @@ def handle_vision_command(message: types.Message):
     # TODO: или получать аргументы из message.text, если кэпшона к фотке нет (а значит и самой фотки нет, мб она в отвечаемом сообщении)
     user_request = message.caption
 
-    if data[user.id].get("premium_balance") is None or data[user.id]["premium_balance"] <= 0:
+    if not has_positive_balance(user.id, "premium_balance"):
         bot.reply_to(message, 'У вас закончились премиальные токены, пополните баланс!', parse_mode="HTML")
         return
     current_price_cents = PREMIUM_PRICE_CENTS
     admin_log = "ВИЖН "
+    request_started = time.perf_counter()
 
     # if user_request == "":
     #     bot.reply_to(message, "Введите текст после команды /vision или /v для обращения к *GPT-4 Vision*\n\n"
     #                           "Пример: `/v что изображено на картинке?`", parse_mode="Markdown")
     #     return
 
-    # Get the photo
-    photo = message.photo[-1]  # get the highest resolution photo
-
-    # Get the file ID
-    file_id = photo.file_id
-
-    # Download the photo
-    file_info = bot.get_file(file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    # Get the photo: the smallest size, which is enough for the model (the largest one would be downscaled by OpenAI anyway)
+    photo = choose_vision_photo_size(message.photo)
+    if photo.file_size is not None and photo.file_size > VISION_MAX_IMAGE_BYTES:
+        bot.reply_to(message, "Изображение слишком большое, отправьте фото поменьше")
+        return
 
-    # Now `downloaded_file` contains the photo file
-    with open(image_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
-        # print("Картинка получена!")
+    # Download the photo, it's kept in memory without temporary files
+    with metrics.timer("download", "vision"):
+        file_info = bot.get_file(photo.file_id)
+        downloaded_file = bot.download_file(file_info.file_path)
+    if len(downloaded_file) > VISION_MAX_IMAGE_BYTES:
+        bot.reply_to(message, "Изображение слишком большое, отправьте фото поменьше")
+        return
 
     # Симулируем эффект набора текста, пока бот получает ответ
     bot.send_chat_action(message.chat.id, "typing")
 
-    response = get_openai_image_recognition_response(image_path, user_request)
+    try:
+        with metrics.timer("openai", "vision"):
+            response = get_openai_image_recognition_response(downloaded_file, user_request)
+    except Exception as e:
+        print(f"\nОшибка при запросе распознавания изображения: {e}")
+        bot.reply_to(message, "Произошла ошибка на серверах OpenAI.\n"
+                              "Пожалуйста, попробуйте еще раз или повторите запрос позже")
+        return
 
-    # Vision requests still use old api response format
-    request_tokens = response["usage"]["total_tokens"]
+    request_tokens = response.usage.total_tokens
     # print(f"Запрос на {request_tokens} токенов")
 
-    # delete image file
-    os.remove(image_path)
-
-    update_global_user_data(
-        user.id,
-        new_premium_tokens=request_tokens,
-        deduct_tokens=True if user.id != ADMIN_ID else False
-    )
+    with metrics.timer("persist", "vision"):
+        update_global_user_data(
+            user.id,
+            new_premium_tokens=request_tokens,
+            deduct_tokens=True if user.id != ADMIN_ID else False
+        )
 
     # Считаем стоимость запроса в центах
     request_price_cents = request_tokens * current_price_cents
-    response_content = response["choices"][0]["message"]["content"]  # Vision requests still use old api response format
+    response_content = response.choices[0].message.content
 
-    try:  # Send the response back to the user
-        send_smart_split_message(bot, message.chat.id, response_content, parse_mode="Markdown", reply_to_message_id=message.message_id)
-    except telebot.apihelper.ApiTelegramException as e:
-        print(f"\nОшибка отправки из-за форматирования, отправляю без него.\nТекст ошибки: " + str(e))
-        send_smart_split_message(bot, message.chat.id, response_content, reply_to_message_id=message.message_id)
+    with metrics.timer("telegram_send", "vision"):
+        try:  # Send the response back to the user
+            send_smart_split_message(bot, message.chat.id, response_content, parse_mode="Markdown", reply_to_message_id=message.message_id)
+        except telebot.apihelper.ApiTelegramException as e:
+            print(f"\nОшибка отправки из-за форматирования, отправляю без него.\nТекст ошибки: " + str(e))
+            send_smart_split_message(bot, message.chat.id, response_content, reply_to_message_id=message.message_id)
 
     # Формируем лог работы для админа
     admin_log += create_request_report(user, message.chat, request_tokens, request_price_cents)
     print("\n" + admin_log)
 
-    # Отправляем лог работы админу в тг
+    # Отправляем лог работы админу в тг (в фоне, вместе с другими логами)
     if message.chat.id != ADMIN_ID:
-        bot.send_message(ADMIN_ID, admin_log, parse_mode="HTML")
+        admin_logs.add(admin_log)
+
+    metrics.observe("total", time.perf_counter() - request_started, "vision")
 
 
 # Define the message handler for incoming messages (default and premium requests, including voice messages)
 @bot.message_handler(content_types=["text", "voice"])
 def handle_message(message):
-    global session_tokens, premium_session_tokens, session_request_counter, data
     user = message.from_user
+    request_started = time.perf_counter()
 
-    # Если пользователя нет в базе, то перенаправляем его на команду /start и выходим
-    if not is_user_exists(user.id):
-        if is_user_blacklisted(user.id):
-            return
-        else:
-            bot.reply_to(message, "Вы не зарегистрированы в системе. Напишите /start\n\n"
-                                  "Подсказка: за регистрацию по рефке вы получите на 50% больше токенов!")
-        return
-
-    # Если юзер ответил на ответ боту другого юзера в групповом чате, то выходим, отвечать не нужно (issue #27)
-    if message.reply_to_message is not None and message.reply_to_message.from_user.id != bot.get_me().id and not message.text.startswith('/'):
-        # print(f"\nUser {user.full_name} @{user.username} replied to another user, skip")
-        return
-
-    user_model: str
-
-    if extract_command(message.text) in ["pro", "prem", "premium", "gpt4"]:
-        user_model = PREMIUM_MODEL
-        message.text = extract_arguments(message.text)
-        if message.text == "":
-            bot.reply_to(message, "Введите текст после команды /pro или /gpt4 для обращения к *GPT-4* без смены активной языковой модели\n\n"
-                                  "Пример: `/pro напиши код калькулятора на python`", parse_mode="Markdown")
-            return
-    else:
-        user_model = get_user_active_model(user.id)
-
-    # Проверяем, есть ли у пользователя токены на балансе в зависимости от выбранной языковой модели
-    if user_model == DEFAULT_MODEL:
-        if data[user.id]["balance"] <= 0:
-            bot.reply_to(message, 'У вас закончились токены, пополните баланс!\n'
-                                  '<span class="tg-spoiler">/help в помощь</span>', parse_mode="HTML")
-            return
-        current_price_cents = PRICE_CENTS
-        admin_log = ""
-
-    elif user_model == PREMIUM_MODEL:
-        if data[user.id].get("premium_balance") is None or data[user.id]["premium_balance"] <= 0:
-            bot.reply_to(message, 'У вас закончились премиальные токены, пополните баланс!', parse_mode="HTML")
-            return
-        current_price_cents = PREMIUM_PRICE_CENTS
-        admin_log = "ПРЕМ "
-
-    else:  # Этого случая не может произойти, но пусть будет описан
-        bot.reply_to(message, 'У вас нет доступа к этой модели, обратитесь к админу!')
-        print(f"\nUser {user.full_name} @{user.username} has no access to model {user_model}")
+    # Регистрация и баланс. Модель юзера известна только после проверки, отказы пишутся без модели
+    bot_id = telegram_cache.get_me().id if message.reply_to_message is not None else None
+    user_model, refusal = check_chat_request(message, bot_id)
+    metrics.observe("check", time.perf_counter() - request_started, user_model or "")
+    if user_model is None:
+        if refusal is not None:
+            bot.reply_to(message, refusal["text"], parse_mode=refusal["parse_mode"])
         return
 
     voice_duration = None  # duration of the voice message in seconds for transcription
@@ -1746,8 +2299,7 @@ def handle_message(message):
         voice_duration = message.voice.duration
 
         # Войсы могут юзать только премиум юзеры
-        # TODO: мб вот эти проверки на баланс завернуть в отдельные ф-и, чтобы в мейне не надо было трогать БД напрямую (smart?)
-        if data[user.id].get("premium_balance") is None or data[user.id]["premium_balance"] <= 0:
+        if not has_positive_balance(user.id, "premium_balance"):
             bot.reply_to(message, 'Общаться войсами можно только счастливым обладателям премиум токенов!\n\n/balance здесь')
             return
 
@@ -1763,38 +2315,43 @@ def handle_message(message):
         except FileNotFoundError as e:
             print("Внимание: Для работы с войсами необходимо установить FFMPEG!!!\nГолосовой запрос не был обработан.")
             return
-        admin_log += "ВОЙС "
+        except TranscodingBusyError:
+            bot.reply_to(message, "Сейчас обрабатывается слишком много войсов, попробуйте через минуту")
+            return
+        except Exception as e:
+            print(f"\nОшибка распознавания войса: {e}")
+            bot.reply_to(message, "Не удалось распознать голосовое сообщение. Пожалуйста, повторите попытку позже")
+            return
 
     # Симулируем эффект набора текста, пока бот получает ответ
-    bot.send_chat_action(message.chat.id, "typing")
-
-    is_user_chat_context_enabled: bool = is_user_extended_chat_context_enabled(user.id)
-    if is_user_chat_context_enabled:
-        # загружаем историю чата юзера из файла в оперативку, если она есть
-        get_user_chat_context(user.id)
-        # print(f"Длина контекста: {len(get_user_chat_context(user.id))}")
+    with metrics.timer("chat_action", user_model):
+        bot.send_chat_action(message.chat.id, "typing")
 
-        # Сокращаем историю чата до максимальной длины (округление вниз до целого сообщения)
-        trim_user_chat_context(user.id, get_user_max_chat_context_length(user.id))
-        # print(f"Длина после трима: {len(get_user_chat_context(user.id))}")
+    # Контекст диалога: расширенный контекст, сообщение, на которое ответил юзер, или обычный запрос без контекста
+    messages, is_user_chat_context_enabled = prepare_chat_request_messages(message, user_model)
 
-        # Добавляем сообщение пользователя в расширенный контекст
-        update_user_chat_context(user.id, [{"role": "user", "content": message.text}], save_to_file=False)
-        # print(f"Длина после с новым запросом: {len(get_user_chat_context(user.id))}")
-
-        admin_log += "EC "
+    # Такой же запрос без контекста уже был - отвечаем из кэша без обращения к OpenAI
+    cached_response = get_cached_chatgpt_response(messages, user_model, is_user_chat_context_enabled)
+    is_response_sent = False
+    is_response_complete = True  # Прерванный стрим не кэшируем
 
     # Send the user's message to OpenAI API and get the response
-    # Если юзер написал запрос в ответ на сообщение бота, то добавляем предыдущий ответ бота в запрос
-    try:  # если есть контекст сообщения, то работаем с ними, иначе обычный запрос как раньше
-        if is_user_chat_context_enabled:
-            response = get_chatgpt_response(message.text, lang_model=user_model, system_prompt=get_user_prompt(user.id),
-                                            extended_context_messages=get_user_chat_context(user.id))
-        elif message.reply_to_message is not None:
-            prev_answer = message.reply_to_message.caption or message.reply_to_message.text
-            response = get_chatgpt_response(message.text, lang_model=user_model, prev_answer=prev_answer, system_prompt=get_user_prompt(user.id))
+    openai_started = time.perf_counter()
+    try:
+        if cached_response is not None:
+            response_content = cached_response["content"]
+            request_tokens = cached_response["tokens"] if RESPONSE_CACHE_BILL_HITS else 0
+        elif STREAM_RESPONSES:  # Ответ отправляется юзеру по мере генерации
+            response_content, request_tokens, is_response_complete = send_streaming_chatgpt_response(bot, message, messages, user_model)
+            is_response_sent = True
         else:
-            response = get_chatgpt_response(message.text, lang_model=user_model, system_prompt=get_user_prompt(user.id))
+            response = get_chatgpt_response(messages, lang_model=user_model)
+            # Получаем стоимость запроса по АПИ в токенах
+            request_tokens = response.usage.total_tokens  # same: response.usage.total_tokens
+            response_content = response.choices[0].message.content
+    except CircuitOpenError:
+        bot.reply_to(message, "Серверы OpenAI сейчас недоступны. Пожалуйста, повторите запрос через минуту")
+        return
     except openai.RateLimitError:
         print("\nЛимит запросов! Или закончились деньги на счету OpenAI")
         bot.reply_to(message, "Превышен лимит запросов. Пожалуйста, повторите попытку позже")
@@ -1806,66 +2363,96 @@ def handle_message(message):
         print(e)
         return
 
-    # Получаем стоимость запроса по АПИ в токенах
-    request_tokens = response.usage.total_tokens  # same: response.usage.total_tokens
-
-    update_global_user_data(
-        user.id,
-        new_tokens=request_tokens if user_model == DEFAULT_MODEL else None,
-        new_premium_tokens=request_tokens if user_model == PREMIUM_MODEL else None,
-        new_whisper_seconds=voice_duration,
-        deduct_tokens=True if user.id != ADMIN_ID else False
-    )
-
-    # Считаем стоимость запроса в центах в зависимости от выбранной модели
-    request_price_cents = request_tokens * current_price_cents + (voice_duration or 0) * WHISPER_SEC_PRICE_CENTS
-
-    response_content = response.choices[0].message.content
+    if cached_response is None:  # При стриминге сюда входит и отправка ответа юзеру
+        metrics.observe("openai", time.perf_counter() - openai_started, user_model)
 
-    if is_user_chat_context_enabled:
-        update_user_chat_context(user.id, [{"role": "assistant", "content": response_content}])
-        # print(f"Длина после ответа: {len(get_user_chat_context(user.id))}")
+    # Списываем токены, сохраняем ответ в контекст и формируем лог работы для админа
+    with metrics.timer("persist", user_model):
+        admin_log = finish_chat_request(message, user_model, request_tokens, response_content, is_user_chat_context_enabled, voice_duration,
+                                        is_cached=cached_response is not None)
 
     error_text = f"\nОшибка отправки из-за форматирования, отправляю без него.\nТекст ошибки: "
     # Сейчас будет жесткий код
     # Send the response back to the user, but check for `parse_mode` and `message is too long` errors
-    if message.chat.type == "private":
-        try:
-            send_smart_split_message(bot, message.chat.id, response_content, parse_mode="Markdown")
-        except telebot.apihelper.ApiTelegramException as e:
-            print(error_text + str(e))
-            send_smart_split_message(bot, message.chat.id, response_content)
-    else:  # В групповом чате отвечать на конкретное сообщение, а не просто отправлять сообщение в чат
-        try:
-            send_smart_split_message(bot, message.chat.id, response_content, parse_mode="Markdown", reply_to_message_id=message.message_id)
-        except telebot.apihelper.ApiTelegramException as e:
-            print(error_text + str(e))
-            send_smart_split_message(bot, message.chat.id, response_content, reply_to_message_id=message.message_id)
+    if not is_response_sent:  # Стрим уже доставил ответ юзеру
+        with metrics.timer("telegram_send", user_model):
+            if message.chat.type == "private":
+                try:
+                    send_smart_split_message(bot, message.chat.id, response_content, parse_mode="Markdown")
+                except telebot.apihelper.ApiTelegramException as e:
+                    print(error_text + str(e))
+                    send_smart_split_message(bot, message.chat.id, response_content)
+            else:  # В групповом чате отвечать на конкретное сообщение, а не просто отправлять сообщение в чат
+                try:
+                    send_smart_split_message(bot, message.chat.id, response_content, parse_mode="Markdown", reply_to_message_id=message.message_id)
+                except telebot.apihelper.ApiTelegramException as e:
+                    print(error_text + str(e))
+                    send_smart_split_message(bot, message.chat.id, response_content, reply_to_message_id=message.message_id)
+
+    if cached_response is None and is_response_complete:
+        cache_chatgpt_response(messages, user_model, is_user_chat_context_enabled, response_content, request_tokens)
 
-    # Формируем лог работы для админа
-    admin_log += create_request_report(user, message.chat, request_tokens, request_price_cents, voice_duration)
     print("\n" + admin_log)
 
-    # Отправляем лог работы админу в тг
+    # Отправляем лог работы админу в тг (в фоне, вместе с другими логами)
     if message.chat.id != ADMIN_ID:
-        bot.send_message(ADMIN_ID, admin_log, parse_mode="HTML")
+        admin_logs.add(admin_log)
+
+    metrics.observe("total", time.perf_counter() - request_started, user_model)
 
 
 # Handler only for bot pinned messages
 @bot.message_handler(content_types=["pinned_message"])
 def handle_pinned_message(message):
-    if message.from_user.id != bot.get_me().id:
+    if message.from_user.id != telegram_cache.get_me().id:
         return
 
     # Удаляем системное сообщение о закрепе
     bot.delete_message(message.chat.id, message.message_id)
 
 
+# Приём апдейтов вебхуком: Telegram сам присылает их на WEBHOOK_URL, работает до /stop, Ctrl+C или SIGTERM
+def run_webhook() -> None:
+    global webhook_server
+    webhook_server = WebhookServer(bot, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, urlparse(WEBHOOK_URL).path or "/",
+                                   WEBHOOK_QUEUE_SIZE, certificate=WEBHOOK_SSL_CERT, private_key=WEBHOOK_SSL_KEY)
+    metrics.gauge("webhook_queue", "Updates received by webhook and waiting for the handlers", webhook_server.pending_updates)
+    webhook_server.start()
+    signal.signal(signal.SIGTERM, lambda *args: webhook_server.request_stop())
+
+    if WEBHOOK_SSL_CERT:  # Самоподписанный сертификат нужно загрузить в Telegram
+        with open(WEBHOOK_SSL_CERT, "rb") as certificate:
+            bot.set_webhook(WEBHOOK_URL, certificate=certificate, max_connections=WEBHOOK_MAX_CONNECTIONS, secret_token=WEBHOOK_SECRET)
+    else:
+        bot.set_webhook(WEBHOOK_URL, max_connections=WEBHOOK_MAX_CONNECTIONS, secret_token=WEBHOOK_SECRET)
+    print(f"Вебхук: {WEBHOOK_URL}, слушаем {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+
+    try:
+        webhook_server.wait()
+    except KeyboardInterrupt:
+        pass
+    webhook_server.stop()  # Уже принятые апдейты передаются обработчикам
+    stats = webhook_server.stats()
+    print(f"\nВебхук остановлен: принято {stats['received']}, отклонено {stats['rejected']}, с неверным секретом {stats['forbidden']}")
+
+
 if __name__ == '__main__':
     print("---работаем---")
-    bot.infinity_polling()
-
-    # Делаем бэкап бд и уведомляем админа об успешном завершении работы
-    update_json_file(data, BACKUPFILE)
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        bot.remove_webhook()  # Пока установлен вебхук, getUpdates не работает
+        bot.infinity_polling()
+    bot.stop_bot()  # Дожидаемся обработки уже полученных сообщений
+    broadcaster.stop()  # Незаконченная рассылка продолжится при следующем запуске
+    summary_executor.shutdown(cancel_futures=True)  # Дожидаемся начатых пересказов, остальные сделаем в следующий раз
+    transcoder.close()
+    telegram_cache.close()
+    admin_logs.close()  # Досылаем накопившиеся логи
+    chat_context.close()  # Дописываем несохраненный контекст диалогов
+
+    # Сбрасываем журнал в основной файл, делаем бэкап бд и уведомляем админа об успешном завершении работы
+    user_store.export_json(BACKUPFILE)
+    user_store.close()
     bot.send_message(ADMIN_ID, "Бот остановлен")
     print("\n---работа завершена---")
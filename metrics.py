@@ -0,0 +1,136 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+# Границы бакетов гистограмм в секундах: от локальных операций до долгих ответов модели
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets (cumulative in the Prometheus format) and percentile estimates."""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th percentile (0-100) by linear interpolation inside the bucket, like `histogram_quantile`."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+
+class Metrics:
+    """
+    In-process metrics of the bot: latency histograms of the request phases by model and gauges, which are read
+    from the other components when exported. Thread-safe.
+    """
+
+    def __init__(self, prefix: str = "bot"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}  # (phase, model) -> Histogram
+        self.gauges = {}  # name -> (help, function)
+
+    def observe(self, phase: str, seconds: float, model: str = "") -> None:
+        with self.lock:
+            histogram = self.histograms.get((phase, model))
+            if histogram is None:
+                histogram = self.histograms[(phase, model)] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, phase: str, model: str = ""):
+        """Measure the time of the `with` block as `phase` (also if it raised)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - started, model)
+
+    def gauge(self, name: str, help_text: str, function: Callable[[], float]) -> None:
+        """Register a gauge, `function()` returns its current value on export."""
+        self.gauges[name] = (help_text, function)
+
+    def summary(self) -> list:
+        """Return `(phase, model, count, p50, p95, p99, max)` for each histogram, times in seconds."""
+        with self.lock:
+            return [(phase, model, histogram.count, histogram.percentile(50), histogram.percentile(95),
+                     histogram.percentile(99), histogram.max)
+                    for (phase, model), histogram in sorted(self.histograms.items())]
+
+    def render_prometheus(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        name = f"{self.prefix}_request_phase_seconds"
+        lines = [f"# HELP {name} Duration of the request phases", f"# TYPE {name} histogram"]
+        with self.lock:
+            for (phase, model), histogram in sorted(self.histograms.items()):
+                labels = f'phase="{phase}",model="{model}"' if model else f'phase="{phase}"'  # Пустые метки не пишем
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        for gauge_name, (help_text, function) in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception as e:  # Сломанная метрика не должна ломать весь экспорт
+                print(f"\nОшибка метрики {gauge_name}: {e}")
+                continue
+            lines += [f"# HELP {self.prefix}_{gauge_name} {help_text}", f"# TYPE {self.prefix}_{gauge_name} gauge",
+                      f"{self.prefix}_{gauge_name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port: int, host: str = "127.0.0.1") -> Optional[ThreadingHTTPServer]:
+        """Serve the metrics at `http://host:port/metrics` in a background thread. Returns None if the port is busy."""
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # Не засоряем консоль запросами Prometheus
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        except OSError as e:
+            print(f"\nНе удалось запустить экспорт метрик на {host}:{port}: {e}")
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+        return server
@@ -0,0 +1,295 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Optional
+
+import openai
+import requests
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """The request was not sent, because the circuit breaker is open (the API keeps failing)."""
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    """Return the HTTP status code of the failed request (OpenAI SDK or `requests` error), or None."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Return the delay in seconds from the `Retry-After` (or `retry-after-ms`) header of the failed request, or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:  # Retry-After может быть датой - тогда считаем паузу сами
+        pass
+    return None
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Check if the request can succeed on retry: connection errors, timeouts, 429 (except the exhausted quota) and 5xx."""
+    if isinstance(error, (openai.APIConnectionError, requests.ConnectionError, requests.Timeout)):
+        return True
+    if getattr(error, "code", None) == "insufficient_quota":  # Закончились деньги на счету - повтор не поможет
+        return False
+    return get_status_code(error) in RETRYABLE_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Fails fast during the API outages: after `failure_threshold` failures in a row the circuit opens and requests
+    are rejected for `reset_timeout` seconds, then one probe request is let through to check if the API is back.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.failures = 0
+        self.opened_at = None
+        self.is_probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.is_probing or self.clock() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.is_probing and self.clock() - self.opened_at >= self.reset_timeout:
+                self.is_probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.is_probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.is_probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.is_probing:
+                    print(f"\nAPI недоступен: {self.failures} ошибок подряд, запросы отклоняются {self.reset_timeout} с")
+                self.opened_at = self.clock()
+                self.is_probing = False
+
+
+class ResilientCaller:
+    """
+    Calls of an unreliable API (OpenAI) with retries, concurrency limits and circuit breakers, for sync and async code.
+
+    `key` of a call (the model name) selects its concurrency limit and circuit breaker, so an outage or a rate limit
+    of one model doesn't block the others. Transient errors are retried with exponential backoff and full jitter,
+    or after the `Retry-After` delay if the API sent it.
+    """
+
+    def __init__(self, max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 20, concurrency: dict = None,
+                 default_concurrency: int = 20, failure_threshold: int = 5, reset_timeout: float = 30, sleep=time.sleep,
+                 clock=time.monotonic):
+        """
+        :param max_retries: How many times to retry a request after a transient error
+        :param base_delay: The delay before the first retry (doubled for each next one, with random jitter)
+        :param max_delay: The max delay between retries
+        :param concurrency: Max simultaneous requests per key, `{model: limit}`
+        :param default_concurrency: The limit for the keys, which are not in `concurrency`
+        :param failure_threshold: Open the circuit after n failures in a row
+        :param reset_timeout: Reject requests for n seconds after the circuit was opened
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.breakers = {}  # key -> CircuitBreaker
+        self.semaphores = {}  # key -> threading.BoundedSemaphore
+        self.async_semaphores = {}  # key -> asyncio.Semaphore
+
+        self.retries = 0
+        self.rejected = 0
+
+    def _get_breaker(self, key: str) -> CircuitBreaker:
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout, self.clock)
+            return self.breakers[key]
+
+    def _get_semaphore(self, key: str) -> threading.BoundedSemaphore:
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(self.concurrency.get(key, self.default_concurrency))
+            return self.semaphores[key]
+
+    def _get_async_semaphore(self, key: str) -> asyncio.Semaphore:
+        with self.lock:
+            if key not in self.async_semaphores:
+                self.async_semaphores[key] = asyncio.Semaphore(self.concurrency.get(key, self.default_concurrency))
+            return self.async_semaphores[key]
+
+    def get_retry_delay(self, error: Exception, attempt: int) -> float:
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _before_attempt(self, key: str, breaker: CircuitBreaker) -> None:
+        if not breaker.allow():
+            with self.lock:
+                self.rejected += 1
+            raise CircuitOpenError(f"API {key} is unavailable, requests are rejected for {self.reset_timeout} s")
+
+    @staticmethod
+    def _record_error(error: Exception, breaker: CircuitBreaker) -> None:
+        if not is_transient_error(error) or get_status_code(error) == 429:
+            breaker.record_success()  # API отвечает: ошибка в запросе или лимит запросов, а не сбой
+        else:
+            breaker.record_failure()
+
+    def _after_error(self, error: Exception, breaker: CircuitBreaker, attempt: int) -> Optional[float]:
+        """Update the breaker after a failed attempt. Returns the delay before the retry, or None to raise the error."""
+        self._record_error(error, breaker)
+        if not is_transient_error(error) or attempt == self.max_retries:
+            return None
+        with self.lock:
+            self.retries += 1
+        return self.get_retry_delay(error, attempt)
+
+    def call(self, key: str, function, *args, **kwargs):
+        """Call `function(*args, **kwargs)` with the retry policy of `key`. Raises `CircuitOpenError` during outages."""
+        breaker = self._get_breaker(key)
+        for attempt in range(self.max_retries + 1):
+            self._before_attempt(key, breaker)
+            try:
+                with self._get_semaphore(key):
+                    result = function(*args, **kwargs)
+            except Exception as e:
+                delay = self._after_error(e, breaker, attempt)
+                if delay is None:
+                    raise
+                self.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+
+    def call_stream(self, key: str, function, *args, **kwargs):
+        """
+        Generator version of `call()` for streamed responses: yields the chunks of the stream returned by `function`.
+
+        The concurrency slot of `key` is held until the stream is consumed, and the breaker gets the outcome
+        of the whole stream, not only of the request, which opened it. Only opening the stream is retried:
+        the chunks already given to the caller can't be taken back.
+        """
+        breaker = self._get_breaker(key)
+        semaphore = self._get_semaphore(key)
+        for attempt in range(self.max_retries + 1):
+            self._before_attempt(key, breaker)
+            semaphore.acquire()
+            try:
+                stream = function(*args, **kwargs)
+                break
+            except Exception as e:
+                semaphore.release()
+                delay = self._after_error(e, breaker, attempt)
+                if delay is None:
+                    raise
+                self.sleep(delay)
+
+        is_failed = False
+        try:
+            yield from stream
+        except Exception as e:
+            is_failed = True
+            self._record_error(e, breaker)
+            raise
+        finally:
+            if not is_failed:  # В том числе если стрим бросили на середине: API отвечал
+                breaker.record_success()
+            try:
+                if hasattr(stream, "close"):  # Освобождаем соединение недочитанного стрима
+                    stream.close()
+            finally:
+                semaphore.release()
+
+    async def call_async(self, key: str, function, *args, **kwargs):
+        """Async version of `call()` for coroutine functions."""
+        breaker = self._get_breaker(key)
+        for attempt in range(self.max_retries + 1):
+            self._before_attempt(key, breaker)
+            try:
+                async with self._get_async_semaphore(key):
+                    result = await function(*args, **kwargs)
+            except Exception as e:
+                delay = self._after_error(e, breaker, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+
+    async def call_stream_async(self, key: str, function, *args, **kwargs):
+        """Async version of `call_stream()`, use it with `contextlib.aclosing()` to release the slot on early exit."""
+        breaker = self._get_breaker(key)
+        semaphore = self._get_async_semaphore(key)
+        for attempt in range(self.max_retries + 1):
+            self._before_attempt(key, breaker)
+            await semaphore.acquire()
+            try:
+                stream = await function(*args, **kwargs)
+                break
+            except Exception as e:
+                semaphore.release()
+                delay = self._after_error(e, breaker, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+        is_failed = False
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            is_failed = True
+            self._record_error(e, breaker)
+            raise
+        finally:
+            if not is_failed:
+                breaker.record_success()
+            try:
+                if hasattr(stream, "close"):
+                    await stream.close()
+            finally:
+                semaphore.release()
+
+    def stats(self) -> dict:
+        """Return the number of retries and rejected requests and the keys with open circuits."""
+        with self.lock:
+            breakers = dict(self.breakers)
+            stats = {"retries": self.retries, "rejected": self.rejected}
+        stats["open_circuits"] = [key for key, breaker in breakers.items() if breaker.state != "closed"]
+        return stats
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from storage import write_json_atomic
+
+
+class ResponseCache:
+    """
+    Cache of the model answers for identical requests: in-memory LRU of `max_entries` answers and an optional disk tier
+    in `folder` (one file per answer), which survives restarts. Answers older than `ttl` seconds are not returned.
+    The disk tier keeps at most `max_disk_entries` answers: when it grows over the limit, the expired and the oldest
+    files are removed (down to 90% of the limit, so the folder isn't scanned on every write), also on start.
+
+    The key is a hash of the model and all messages of the request (including the system prompt), so only exactly
+    the same request gets the cached answer. Thread-safe.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 24 * 60 * 60, folder: str = None,
+                 max_disk_entries: int = 100000, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.folder = folder
+        self.max_disk_entries = max_disk_entries
+        self.clock = clock
+
+        self.entries = OrderedDict()  # key -> {"content": str, "tokens": int, "created": float}, the least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0  # part of `hits`, loaded from the disk tier
+        self.misses = 0
+        self.disk_entries = 0  # files in the disk tier (approximately, between the cleanups)
+        self._is_pruning = False
+
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+            self._prune_disk()
+
+    @staticmethod
+    def make_key(model: str, messages: list) -> str:
+        request = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.json")
+
+    def _is_expired(self, entry: dict) -> bool:
+        return self.ttl is not None and self.clock() - entry["created"] > self.ttl
+
+    def _load(self, key: str) -> Optional[dict]:
+        if self.folder is None:
+            return None
+        try:
+            with open(self._path(key), "r", encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _prune_disk(self) -> None:
+        """Remove the expired answers from the disk tier and the oldest ones over 90% of `max_disk_entries`."""
+        files = []  # (time of the write, path)
+        with os.scandir(self.folder) as folder_entries:
+            for folder_entry in folder_entries:
+                if folder_entry.name.endswith(".json") and folder_entry.is_file():
+                    try:
+                        files.append((folder_entry.stat().st_mtime, folder_entry.path))
+                    except OSError:
+                        pass
+        files.sort()
+
+        keep = int(self.max_disk_entries * 0.9) if self.max_disk_entries is not None else len(files)
+        now = time.time()  # Время файлов - системное, а не `clock`
+        removed = 0
+        for modified, path in files:  # От старых к новым: просроченные всегда в начале
+            if len(files) - removed <= keep and (self.ttl is None or now - modified <= self.ttl):
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+
+        with self.lock:
+            self.disk_entries = len(files) - removed
+
+    def _remember(self, key: str, entry: dict) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, model: str, messages: list) -> Optional[dict]:
+        """Return the cached answer `{"content": ..., "tokens": ..., "created": ...}` for the request, or None."""
+        key = self.make_key(model, messages)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._is_expired(entry):
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._load(key)  # Диск читаем без блокировки
+        if entry is not None and self._is_expired(entry):
+            try:
+                os.remove(self._path(key))
+                with self.lock:
+                    self.disk_entries -= 1
+            except OSError:
+                pass
+            entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.hits += 1
+            self.disk_hits += 1
+            return entry
+
+    def put(self, model: str, messages: list, content: str, tokens: int) -> None:
+        """Save the answer to the request and the number of tokens it cost."""
+        key = self.make_key(model, messages)
+        entry = {"content": content, "tokens": tokens, "created": self.clock()}
+        with self.lock:
+            self._remember(key, entry)
+
+        if self.folder is None:
+            return
+        path = self._path(key)
+        is_new_file = not os.path.exists(path)
+        try:
+            write_json_atomic(path, entry, indent=None)
+        except OSError as e:
+            print(f"\nОшибка сохранения кэша ответов: {e}")
+            return
+
+        with self.lock:
+            if is_new_file:
+                self.disk_entries += 1
+            # Чистит один поток, остальные пишут дальше
+            should_prune = (self.max_disk_entries is not None and self.disk_entries > self.max_disk_entries
+                            and not self._is_pruning)
+            if should_prune:
+                self._is_pruning = True
+        if should_prune:
+            try:
+                self._prune_disk()
+            except OSError as e:
+                print(f"\nОшибка очистки кэша ответов: {e}")
+            finally:
+                self._is_pruning = False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "disk_entries": self.disk_entries, "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses}
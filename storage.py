@@ -0,0 +1,541 @@
+import heapq
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Optional
+
+
+def parse_data_key(key):
+    """
+    Convert JSON object key back to the bot's key type: user ids are ints, everything else (e.g. "global") stays a string.
+    """
+    if isinstance(key, str) and key.lstrip("-").isdigit():
+        return int(key)
+    return key
+
+
+def load_json_data(file_name: str) -> dict:
+    """Read the data file in the `data.json` format and convert user ids back to ints."""
+    with open(file_name, "r", encoding='utf-8') as file:
+        content = json.load(file)
+    return {parse_data_key(key): value for key, value in content.items()}
+
+
+def write_json_atomic(file_name: str, content, indent: Optional[int] = 4) -> None:
+    """
+    Write JSON to a temporary file and atomically replace the target, so a crash mid-write never truncates it.
+    Every write uses its own temporary file, so concurrent writes of the same file (e.g. the compaction and
+    the admin's export) can't mix up: the last replace wins.
+    """
+    fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(file_name) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(file_name) or ".")
+    try:
+        with os.fdopen(fd, "w", encoding='utf-8') as file:
+            json.dump(content, file, ensure_ascii=False, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+class UserStore:
+    """
+    Data-access layer for the users and global statistics.
+
+    All reads go to the in-memory mirror of the data (`get_user`, `get_global`, `users`), all writes go through
+    `add`, `update`, `set`, `increment` and `unset`, which update the mirror and persist the change in the backend.
+    Records returned by the store must be treated as read-only.
+
+    Secondary indexes (username -> user id, referrer -> referrals, time of the last request) are kept in memory and updated on every write, so they are always in sync
+    with the data regardless of the backend.
+
+    This base class keeps everything in memory only and is used as the test backend.
+    """
+
+    def __init__(self):
+        self.data: dict = {}
+        self.lock = threading.RLock()
+        self.username_index: dict = {}  # lowercase username without "@" -> user_id
+        self.referrals_index: dict = {}  # referrer id -> {referral id: None} (dict as an ordered set, in order of registration)
+        # user_id -> lastdate_ts in order of activity, the most recent last. Новый запрос всегда самый поздний,
+        # поэтому юзер просто переносится в конец, а "активные за n дней" - это хвост словаря
+        self.activity_index: dict = {}
+        self._is_activity_index_sorted = True
+
+    def load(self, default_data: dict = None) -> dict:
+        """
+        Load the data from the backend. If the backend is empty, `default_data` is used and saved.
+
+        :param default_data: The data to start with, if there is nothing saved yet
+        :type default_data: dict
+
+        :return: The in-memory data dict (the same object is kept up to date by the store)
+        :rtype: dict
+        """
+        with self.lock:
+            self.data = {}
+            self._rebuild_indexes()
+            for key, record in (default_data or {}).items():
+                self._apply({"id": key, "new": True, "set": dict(record)})
+        return self.data
+
+    def _apply(self, change: dict) -> None:
+        key = change["id"]
+        old_entry = self.data.get(key)
+        old_username = None if old_entry is None else old_entry.get("username")
+        old_referrer = None if old_entry is None else old_entry.get("ref_id")
+        old_timestamp = None if old_entry is None else old_entry.get("lastdate_ts")
+
+        if change.get("new"):
+            self.data[key] = {}
+        entry = self.data.setdefault(key, {})
+        entry.update(change.get("set", {}))
+        for field in change.get("unset", []):
+            entry.pop(field, None)
+
+        if key != "global" and entry.get("username") != old_username:
+            self._unindex_username(key, old_username)
+            self._index_username(key, entry.get("username"))
+        if key != "global" and entry.get("ref_id") != old_referrer:
+            self._unindex_referral(key, old_referrer)
+            self._index_referral(key, entry.get("ref_id"))
+        if key != "global" and entry.get("lastdate_ts") != old_timestamp:
+            self.activity_index.pop(key, None)
+            self._index_activity(key, entry.get("lastdate_ts"))
+
+    @staticmethod
+    def _normalize_username(username) -> Optional[str]:
+        if not username or username == "None":  # У юзеров без username в data.json записано "None"
+            return None
+        return username.lstrip("@").lower()
+
+    def _index_username(self, user_id, username) -> None:
+        username = self._normalize_username(username)
+        if username is not None:
+            self.username_index[username] = user_id
+
+    def _unindex_username(self, user_id, username) -> None:
+        username = self._normalize_username(username)
+        if username is not None and self.username_index.get(username) == user_id:
+            del self.username_index[username]
+
+    def _index_referral(self, user_id, referrer) -> None:
+        if referrer is not None:
+            self.referrals_index.setdefault(referrer, {})[user_id] = None
+
+    def _unindex_referral(self, user_id, referrer) -> None:
+        referrals = self.referrals_index.get(referrer)
+        if referrals is not None:
+            referrals.pop(user_id, None)
+            if not referrals:
+                del self.referrals_index[referrer]
+
+    def _index_activity(self, user_id, timestamp) -> None:
+        if not timestamp:  # 0 - юзер еще не делал запросов
+            return
+        if self.activity_index and timestamp < next(reversed(self.activity_index.values())):
+            self._is_activity_index_sorted = False  # Время из прошлого (перевод часов) - пересортируем при следующем запросе
+        self.activity_index[user_id] = timestamp
+
+    def _sort_activity_index(self) -> None:
+        self.activity_index = dict(sorted(self.activity_index.items(), key=lambda x: x[1]))
+        self._is_activity_index_sorted = True
+
+    def _rebuild_indexes(self) -> None:
+        """Build the secondary indexes from scratch in one pass over the data (after a bulk load)."""
+        self.username_index = {}
+        self.referrals_index = {}
+        self.activity_index = {}
+        for key, entry in self.data.items():
+            if key != "global":
+                self._index_username(key, entry.get("username"))
+                self._index_referral(key, entry.get("ref_id"))
+                if entry.get("lastdate_ts"):
+                    self.activity_index[key] = entry["lastdate_ts"]
+        self._sort_activity_index()
+
+    def _persist(self, change: dict) -> None:
+        """Save one change (`{"id": key, "new": bool, "set": {...}, "unset": [...]}`) in the backend."""
+        pass
+
+    def _write(self, change: dict) -> None:
+        self._apply(change)
+        self._persist(change)
+
+    # ---------- reads ----------
+
+    def is_user_exists(self, user_id) -> bool:
+        return user_id in self.data and user_id != "global"
+
+    def get_user(self, user_id) -> dict:
+        return self.data[user_id]
+
+    def get_global(self) -> dict:
+        return self.data["global"]
+
+    def user_ids(self) -> list:
+        with self.lock:
+            return [key for key in self.data if key != "global"]
+
+    def users(self) -> list:
+        """Return the list of `(user_id, user_data)` pairs of all users."""
+        with self.lock:
+            return [(key, value) for key, value in self.data.items() if key != "global"]
+
+    def count_users(self) -> int:
+        return len(self.data) - 1
+
+    def find_user_by_username(self, username: str) -> Optional[int]:
+        """Return the id of the user with the given username (case-insensitive, with or without "@"), or None."""
+        username = self._normalize_username(username)
+        return None if username is None else self.username_index.get(username)
+
+    def get_referrer(self, user_id) -> Optional[int]:
+        """Return the id of the user who invited the given user, or None."""
+        return self.data.get(user_id, {}).get("ref_id")
+
+    def get_referrals(self, user_id) -> list:
+        """Return the ids of the users invited by the given user, in order of registration."""
+        with self.lock:
+            return list(self.referrals_index.get(user_id, ()))
+
+    def top_referrers(self, max_users: int) -> list:
+        """Return up to `max_users` pairs `(user_id, number of referrals)` with the most referrals."""
+        with self.lock:
+            return heapq.nlargest(max_users, ((user_id, len(referrals)) for user_id, referrals in self.referrals_index.items()),
+                                  key=lambda x: x[1])
+
+    def top_users(self, parameter: str, max_users: int) -> list:
+        """Return up to `max_users` pairs `(user_id, value)` with the highest positive value of the numeric `parameter`."""
+        # nlargest держит кучу из max_users элементов вместо сортировки всех юзеров: O(n log k)
+        with self.lock:
+            return heapq.nlargest(max_users, ((user_id, user_data[parameter]) for user_id, user_data in self.data.items()
+                                              if user_id != "global" and user_data.get(parameter, 0) > 0), key=lambda x: x[1])
+
+    def top_users_by_weighted_sum(self, weights: dict, max_users: int) -> list:
+        """
+        Return up to `max_users` pairs `(user_id, value)` with the highest positive weighted sum of the numeric fields
+        (e.g. the cost of the requests: `{"tokens": price, "premium_tokens": premium_price}`). Missing fields count as 0.
+        """
+        def score(user_data: dict) -> float:
+            return sum(user_data.get(field, 0) * weight for field, weight in weights.items())
+
+        with self.lock:
+            scores = ((user_id, score(user_data)) for user_id, user_data in self.data.items() if user_id != "global")
+            return heapq.nlargest(max_users, (item for item in scores if item[1] > 0), key=lambda x: x[1])
+
+    def recent_users(self, since_timestamp: float) -> list:
+        """Return pairs `(user_id, lastdate_ts)` of users active after the given unix time, most recent first."""
+        with self.lock:
+            if not self._is_activity_index_sorted:
+                self._sort_activity_index()
+
+            recent = []
+            for user_id in reversed(self.activity_index):
+                timestamp = self.activity_index[user_id]
+                if timestamp <= since_timestamp:
+                    break
+                recent.append((user_id, timestamp))
+            return recent
+
+    # ---------- writes ----------
+
+    def add(self, key, record: dict) -> None:
+        """Add a new entry (user) to the data, replacing the existing one."""
+        with self.lock:
+            self._write({"id": key, "new": True, "set": dict(record)})
+
+    def update(self, key, fields: dict) -> None:
+        """Set several fields of the entry at once."""
+        with self.lock:
+            self._write({"id": key, "set": fields})
+
+    def set(self, key, field: str, value) -> None:
+        self.update(key, {field: value})
+
+    def increment(self, key, field: str, amount) -> int:
+        """Add `amount` to the numeric field (missing field counts as 0) and return the new value."""
+        with self.lock:
+            new_value = self.data[key].get(field, 0) + amount
+            self._write({"id": key, "set": {field: new_value}})
+            return new_value
+
+    def unset(self, key, field: str) -> None:
+        with self.lock:
+            if field in self.data.get(key, {}):
+                self._write({"id": key, "unset": [field]})
+
+    # ---------- maintenance ----------
+
+    def export_json(self, file_name: str) -> None:
+        """Dump the whole data to the JSON file in the `data.json` format (for backups and the admin `/data` command)."""
+        with self.lock:
+            snapshot = {key: value.copy() for key, value in self.data.items()}
+        write_json_atomic(file_name, snapshot)
+
+    def start_background_compaction(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class JournalStore(UserStore):
+    """
+    Append-only storage engine for the users data.
+
+    Every change is appended to the journal as one JSON line with the *new values* of the changed fields only,
+    so a write costs O(1) regardless of the number of users. Records are idempotent (they set values instead of
+    adding deltas), which makes replaying the same record twice harmless after a crash during compaction.
+
+    The snapshot (`data.json`) keeps the old format and is rewritten by `compact()`, either by the background
+    thread on a timer or when the journal grows over `compact_threshold` records.
+    On startup `load()` reads the snapshot and replays the journal on top of it.
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: str = None, compact_threshold: int = 1000, compact_interval: int = 300):
+        super().__init__()
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + ".journal"
+        self.rotated_journal_path = self.journal_path + ".old"
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+
+        self._compaction_lock = threading.Lock()
+        self._journal = None
+        self._journal_records = 0
+        self._compact_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._compaction_thread = None
+
+    def load(self, default_data: dict = None) -> dict:
+        with self.lock:
+            if os.path.isfile(self.snapshot_path):
+                self.data = load_json_data(self.snapshot_path)
+            else:
+                self.data = default_data if default_data is not None else {}
+                write_json_atomic(self.snapshot_path, self.data)
+            self._rebuild_indexes()
+
+            replayed = 0
+            for path in (self.rotated_journal_path, self.journal_path):
+                replayed += self._replay(path)
+
+            self._journal = open(self.journal_path, "a", encoding='utf-8')
+            self._journal_records = replayed
+
+        if replayed:
+            print(f"Журнал {self.journal_path}: восстановлено {replayed} записей")
+            self.compact()
+
+        return self.data
+
+    def _replay(self, path: str) -> int:
+        if not os.path.isfile(path):
+            return 0
+
+        replayed = 0
+        with open(path, "r", encoding='utf-8') as file:
+            for line in file:
+                try:
+                    change = json.loads(line)
+                except ValueError:  # Недописанная строка после падения - все предыдущие записи уже применены
+                    break
+                self._apply(change)
+                replayed += 1
+        return replayed
+
+    def _persist(self, change: dict) -> None:
+        self._journal.write(json.dumps(change, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._journal_records += 1
+
+        if self._journal_records >= self.compact_threshold:
+            self._compact_event.set()
+
+    def compact(self) -> None:
+        """
+        Write a fresh snapshot and drop the journal records it contains.
+
+        The journal is rotated under the lock together with a shallow copy of the data, the snapshot itself is
+        serialized outside the lock, so request handlers are blocked only for the copy.
+        """
+        with self._compaction_lock:
+            with self.lock:
+                if self._journal_records == 0:
+                    return
+
+                self._journal.close()
+                if os.path.isfile(self.rotated_journal_path):  # Прошлая компактификация не завершилась, дописываем журнал к старому
+                    with open(self.journal_path, "r", encoding='utf-8') as src, open(self.rotated_journal_path, "a", encoding='utf-8') as dst:
+                        dst.write(src.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.rotated_journal_path)
+                self._journal = open(self.journal_path, "a", encoding='utf-8')
+                self._journal_records = 0
+
+                snapshot = {key: value.copy() for key, value in self.data.items()}
+
+            write_json_atomic(self.snapshot_path, snapshot)
+            os.remove(self.rotated_journal_path)
+
+    def export_json(self, file_name: str) -> None:
+        # Экспорт в файл снапшота не должен перезаписать более новый снапшот компактификации более старым
+        with self._compaction_lock:
+            super().export_json(file_name)
+
+    def _compaction_loop(self) -> None:
+        while not self._stop_event.is_set():
+            self._compact_event.wait(self.compact_interval)
+            self._compact_event.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"\nОшибка при компактификации журнала {self.journal_path}: {e}")
+
+    def start_background_compaction(self) -> None:
+        """Start the daemon thread which periodically compacts the journal into the snapshot."""
+        if self._compaction_thread is None:
+            self._compaction_thread = threading.Thread(target=self._compaction_loop, name="JournalCompaction", daemon=True)
+            self._compaction_thread.start()
+
+    def close(self) -> None:
+        """Stop the background thread and write the final snapshot."""
+        self._stop_event.set()
+        self._compact_event.set()
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+            self._compaction_thread = None
+        self.compact()
+        with self.lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class SQLiteUserStore(UserStore):
+    """
+    SQLite (WAL mode) backend: one row per user with typed columns for the counters and balances, so every change
+    updates a single row. Fields without a column (prompt, lang_model, blacklist, etc.) are kept in the `extra` JSON column.
+    A NULL column means the field is absent, same as a missing key in `data.json`.
+
+    Admin queries (`top_users`, `recent_users`) run as indexed SQL instead of scanning all users.
+    """
+
+    INTEGER_COLUMNS = ("requests", "tokens", "balance", "premium_tokens", "premium_balance", "images", "image_balance",
+                       "whisper_seconds", "favors", "ref_id")
+    REAL_COLUMNS = ("lastdate_ts",)
+    TEXT_COLUMNS = ("name", "username", "lastdate")
+    INDEXED_COLUMNS = ("requests", "tokens", "balance", "premium_tokens", "premium_balance", "images", "image_balance", "favors", "ref_id",
+                       "lastdate_ts")
+
+    def __init__(self, db_path: str, import_path: str = None):
+        """
+        :param db_path: Path to the SQLite database file
+        :type db_path: str
+
+        :param import_path: Path to the `data.json` file (with its journal) to import the data from, if the database is empty
+        :type import_path: str
+        """
+        super().__init__()
+        self.db_path = db_path
+        self.import_path = import_path
+        self.columns = self.INTEGER_COLUMNS + self.REAL_COLUMNS + self.TEXT_COLUMNS
+
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        columns_sql = ", ".join([f"{column} INTEGER" for column in self.INTEGER_COLUMNS] + [f"{column} REAL" for column in self.REAL_COLUMNS]
+                                + [f"{column} TEXT" for column in self.TEXT_COLUMNS])
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, {columns_sql}, "
+                                f"extra TEXT NOT NULL DEFAULT '{{}}')")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS global_stats (field TEXT PRIMARY KEY, value)")
+        for column in self.INDEXED_COLUMNS:
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS users_{column} ON users ({column})")
+
+    def load(self, default_data: dict = None) -> dict:
+        with self.lock:
+            self.data = {"global": {}}
+            for field, value in self.connection.execute("SELECT field, value FROM global_stats"):
+                self.data["global"][field] = value
+
+            cursor = self.connection.execute(f"SELECT id, {', '.join(self.columns)}, extra FROM users")
+            for row in cursor:
+                record = {column: value for column, value in zip(self.columns, row[1:-1]) if value is not None}
+                record.update(json.loads(row[-1]))
+                self.data[row[0]] = record
+            self._rebuild_indexes()
+
+            if len(self.data) == 1 and not self.data["global"]:
+                if self.import_path is not None and os.path.isfile(self.import_path):
+                    print(f"База {self.db_path} пуста, импортируем данные из {self.import_path}")
+                    journal_store = JournalStore(self.import_path)  # С учетом недосохраненного журнала
+                    initial_data = journal_store.load()
+                    journal_store.close()
+                else:
+                    initial_data = default_data or {}
+
+                self.connection.execute("BEGIN")
+                for key, record in initial_data.items():
+                    self._write({"id": key, "new": True, "set": dict(record)})
+                self.connection.execute("COMMIT")
+
+        return self.data
+
+    def _persist(self, change: dict) -> None:
+        key = change["id"]
+
+        if key == "global":
+            for field, value in change.get("set", {}).items():
+                self.connection.execute("INSERT OR REPLACE INTO global_stats (field, value) VALUES (?, ?)", (field, value))
+            for field in change.get("unset", []):
+                self.connection.execute("DELETE FROM global_stats WHERE field = ?", (field,))
+            return
+
+        # Колонки и extra пишем целиком из зеркала в памяти, так запись остается в одну строку при любом наборе полей
+        record = self.data[key]
+        values = [record.get(column) for column in self.columns]
+        extra = {field: value for field, value in record.items() if field not in self.columns}
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO users (id, {', '.join(self.columns)}, extra) "
+            f"VALUES (?, {', '.join('?' * len(self.columns))}, ?)",
+            (key, *values, json.dumps(extra, ensure_ascii=False))
+        )
+
+    def top_users(self, parameter: str, max_users: int) -> list:
+        if parameter not in self.INTEGER_COLUMNS:
+            return super().top_users(parameter, max_users)
+
+        with self.lock:
+            cursor = self.connection.execute(f"SELECT id, {parameter} FROM users WHERE {parameter} > 0 "
+                                             f"ORDER BY {parameter} DESC LIMIT ?", (max_users,))
+            return cursor.fetchall()
+
+    def top_users_by_weighted_sum(self, weights: dict, max_users: int) -> list:
+        if not set(weights) <= set(self.INTEGER_COLUMNS):
+            return super().top_users_by_weighted_sum(weights, max_users)
+
+        score_sql = " + ".join(f"COALESCE({field}, 0) * ?" for field in weights)
+        with self.lock:
+            cursor = self.connection.execute(f"SELECT id, {score_sql} AS score FROM users WHERE score > 0 "
+                                             f"ORDER BY score DESC LIMIT ?", (*weights.values(), max_users))
+            return cursor.fetchall()
+
+    def recent_users(self, since_timestamp: float) -> list:
+        with self.lock:
+            cursor = self.connection.execute("SELECT id, lastdate_ts FROM users WHERE lastdate_ts > ? "
+                                             "ORDER BY lastdate_ts DESC", (since_timestamp,))
+            return cursor.fetchall()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,95 @@
+import time
+
+
+class StreamingMessageBuffer:
+    """
+    Splits the streamed model answer into Telegram messages and decides when to send or edit them.
+
+    It doesn't do any IO itself, so the same logic is used by the sync and async bots: `feed()` and `finish()` return
+    the list of operations `(action, part_index, text)`, where `action` is "send" (new message for the part)
+    or "edit" (update the already sent message of the part). Edits are rate limited by `edit_interval`,
+    except for the first message, which is sent as soon as the first text arrives.
+    """
+
+    def __init__(self, max_length: int = 4096, edit_interval: float = 1.5, clock=time.monotonic):
+        self.max_length = max_length
+        self.edit_interval = edit_interval
+        self.clock = clock
+
+        self.text = ""
+        self.part_start = 0  # index in `text` where the current (last) part starts
+        self.closed_parts = 0  # number of parts, which reached the length limit and won't change anymore
+        self.parts = []  # last text sent for each part
+        self.last_flush = None
+
+    def feed(self, delta: str) -> list:
+        """Add the next piece of the answer. Returns the operations to execute now (may be empty)."""
+        if not delta:
+            return []
+        self.text += delta
+
+        if self.last_flush is not None and self.clock() - self.last_flush < self.edit_interval:
+            return []
+        return self._flush()
+
+    def finish(self) -> list:
+        """
+        Return the final operations: the whole answer split into messages, with an "edit" for every already sent part
+        (even if its text didn't change), so the caller can apply formatting to the finished text.
+        """
+        new_parts = {index for action, index, _ in self._flush() if action == "send"}
+        return [("send" if index in new_parts else "edit", index, text) for index, text in enumerate(self.parts)]
+
+    def _split_point(self, text: str) -> int:
+        # Режем по последнему переносу строки или пробелу во второй половине сообщения, иначе ровно по лимиту
+        for separator in ("\n", " "):
+            position = text.rfind(separator, self.max_length // 2, self.max_length)
+            if position != -1:
+                return position + 1
+        return self.max_length
+
+    def _update_part(self, index: int, text: str, operations: list) -> None:
+        if index == len(self.parts):
+            self.parts.append(text)
+            operations.append(("send", index, text))
+        elif self.parts[index] != text:
+            self.parts[index] = text
+            operations.append(("edit", index, text))
+
+    def _flush(self) -> list:
+        operations = []
+
+        # Текущая часть переросла лимит Telegram - дописываем ее до точки разреза и начинаем следующее сообщение
+        while len(self.text) - self.part_start > self.max_length:
+            cut = self._split_point(self.text[self.part_start:self.part_start + self.max_length])
+            self._update_part(self.closed_parts, self.text[self.part_start:self.part_start + cut], operations)
+            self.part_start += cut
+            self.closed_parts += 1
+
+        current_text = self.text[self.part_start:]
+        if current_text.strip():
+            self._update_part(self.closed_parts, current_text, operations)
+
+        if operations:  # Пока текста нет (только пробелы), первое сообщение ждет следующего куска без задержки
+            self.last_flush = self.clock()
+        return operations
+
+
+def get_chunk_usage_tokens(chunk):
+    """
+    Return `total_tokens` from the usage of the stream chunk (the API sends it in the last chunk, if it was requested
+    with `stream_options.include_usage`), or None if the chunk has no usage.
+    """
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        return None
+    if isinstance(usage, dict):  # Старые версии openai не знают поля usage у чанка и оставляют его словарем
+        return usage.get("total_tokens")
+    return getattr(usage, "total_tokens", None)
+
+
+def get_chunk_content(chunk) -> str:
+    """Return the text delta of the stream chunk."""
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import telebot
+
+
+class TelegramMetadataCache:
+    """
+    Local cache of slow-changing Telegram metadata (the bot's own user, etc.), so handlers don't make
+    an API round trip for it on every update.
+
+    A value is loaded once and then served from memory. After `start()` all loaded keys are refreshed on a schedule
+    every `ttl` seconds by a background thread. Without it (or if the scheduled refresh is late) a value older than
+    `ttl` is refreshed in the background on the next request, while the old value is still returned, so only
+    the very first request of a key waits for the API. If a refresh fails, the old value is kept until the next attempt.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, ttl: float = 60 * 60, clock=time.monotonic):
+        self.bot = bot
+        self.ttl = ttl
+        self.clock = clock
+
+        self.values = {}  # key -> (value, loaded_at)
+        self.loaders = {}  # key -> loader, for the scheduled refresh
+        self.refreshing = set()  # keys being refreshed in the background
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+
+    def get(self, key, loader):
+        """Return the cached value of `key`, `loader()` loads it from the API."""
+        with self.lock:
+            cached = self.values.get(key)
+            if cached is not None:
+                value, loaded_at = cached
+                if self.clock() - loaded_at >= self.ttl and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, loader), name="TelegramCacheRefresh", daemon=True).start()
+                return value
+
+        value = loader()  # Первая загрузка - ждем ответа API
+        with self.lock:
+            self.values[key] = (value, self.clock())
+            self.loaders[key] = loader
+        return value
+
+    def _refresh_loop(self) -> None:
+        while not self._stop_event.wait(self.ttl):
+            with self.lock:
+                keys = [key for key in self.loaders if key not in self.refreshing]
+                self.refreshing.update(keys)
+                loaders = [self.loaders[key] for key in keys]
+            for key, loader in zip(keys, loaders):
+                self._refresh(key, loader)
+
+    def start(self) -> None:
+        """Start the daemon thread, which refreshes all loaded values every `ttl` seconds."""
+        if self._refresh_thread is None:
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, name="TelegramCacheRefresh", daemon=True)
+            self._refresh_thread.start()
+
+    def close(self) -> None:
+        """Stop the scheduled refresh."""
+        self._stop_event.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+    def _refresh(self, key, loader) -> None:
+        try:
+            value = loader()
+            with self.lock:
+                self.values[key] = (value, self.clock())
+        except Exception as e:
+            print(f"\nНе удалось обновить {key} из Telegram, используем старое значение: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def get_me(self) -> telebot.types.User:
+        """The bot's own user (id, username), instead of `bot.get_me()`."""
+        return self.get("me", self.bot.get_me)
@@ -0,0 +1,123 @@
+import telebot
+
+from admin_reports import AdminLogQueue
+
+
+def telegram_error(error_code: int, description: str, retry_after: int = None) -> telebot.apihelper.ApiTelegramException:
+    result_json = {"ok": False, "error_code": error_code, "description": description}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return telebot.apihelper.ApiTelegramException("sendMessage", None, result_json)
+
+
+class FakeBot:
+    def __init__(self, errors: list = ()):
+        self.errors = list(errors)  # ошибки, которые вернут следующие вызовы
+        self.messages = []  # (text, parse_mode)
+        self.photos = []
+        self.albums = []
+
+    def _maybe_fail(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        self._maybe_fail()
+        self.messages.append((text, parse_mode))
+
+    def send_photo(self, chat_id, photo, caption=None):
+        self._maybe_fail()
+        self.photos.append((photo, caption))
+
+    def send_media_group(self, chat_id, media):
+        self._maybe_fail()
+        self.albums.append([item.media for item in media])
+
+
+def test_logs_are_joined_into_one_digest():
+    bot = FakeBot()
+    logs = AdminLogQueue(bot, chat_id=1)
+    for i in range(3):
+        logs.add(f"<b>log {i}</b>")
+    logs.flush()
+
+    assert bot.messages == [("<b>log 0</b>\n\n<b>log 1</b>\n\n<b>log 2</b>", "HTML")]
+    logs.flush()
+    assert len(bot.messages) == 1  # Пустую очередь не отправляем
+
+
+def test_digest_is_split_at_max_message_length():
+    bot = FakeBot()
+    logs = AdminLogQueue(bot, chat_id=1)
+    for i in range(10):
+        logs.add(f"{i}" * 1000)
+    logs.add("x" * 5000)  # Один лог длиннее лимита режется на части
+    logs.flush()
+
+    texts = [text for text, _ in bot.messages]
+    assert all(len(text) <= 4096 for text in texts)
+    assert len(texts) == 5  # 4 + 4 + 2 лога и 2 части длинного
+    assert texts[0] == "\n\n".join(f"{i}" * 1000 for i in range(4))
+    assert "".join(texts[-2:]) == "x" * 5000
+
+
+def test_overflow_drops_oldest_logs_and_reports_them():
+    bot = FakeBot()
+    logs = AdminLogQueue(bot, chat_id=1, max_entries=3)
+    for i in range(5):
+        logs.add(f"log {i}")
+    logs.flush()
+
+    assert bot.messages[0][0] == "⚠️ Пропущено логов: 2 (очередь переполнена)\n\nlog 2\n\nlog 3\n\nlog 4"
+    logs.add("log 5")
+    logs.flush()
+    assert bot.messages[1][0] == "log 5"  # Счетчик сброшен после отчета
+
+
+def test_broken_markup_is_sent_as_plain_text():
+    bot = FakeBot([telegram_error(400, "Bad Request: can't parse entities")])
+    logs = AdminLogQueue(bot, chat_id=1)
+    logs.add("Юзер <code>1</code> написал <script>")
+    logs.flush()
+
+    assert bot.messages == [("Юзер <code>1</code> написал <script>", None)]
+
+
+def test_rate_limit_is_retried():
+    bot = FakeBot([telegram_error(429, "Too Many Requests", retry_after=0)])
+    logs = AdminLogQueue(bot, chat_id=1)
+    logs.add("log")
+    logs.flush()
+
+    assert bot.messages == [("log", "HTML")]
+
+
+def test_other_errors_drop_the_digest_without_retry():
+    bot = FakeBot([telegram_error(403, "Forbidden: bot was blocked by the user"), telegram_error(400, "Bad Request")])
+    logs = AdminLogQueue(bot, chat_id=1)
+    logs.add("log")
+    logs.flush()
+
+    assert bot.messages == []
+    assert len(bot.errors) == 1
+
+
+def test_photos_are_sent_as_albums_of_10():
+    bot = FakeBot()
+    logs = AdminLogQueue(bot, chat_id=1)
+    for i in range(11):
+        logs.add_photo(f"photo{i}", caption=f"caption {i}")
+    logs.flush()
+
+    assert bot.albums == [[f"photo{i}" for i in range(10)]]
+    assert bot.photos == [("photo10", "caption 10")]
+
+
+def test_close_sends_the_rest():
+    bot = FakeBot()
+    logs = AdminLogQueue(bot, chat_id=1, flush_interval=60)
+    logs.start()
+    logs.add("log")
+    logs.close()
+
+    assert bot.messages == [("log", "HTML")]
@@ -0,0 +1,159 @@
+import json
+import threading
+
+import telebot
+
+from broadcast import Broadcaster, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def telegram_error(error_code: int, description: str, retry_after: int = None) -> telebot.apihelper.ApiTelegramException:
+    result_json = {"ok": False, "error_code": error_code, "description": description}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return telebot.apihelper.ApiTelegramException("sendMessage", None, result_json)
+
+
+class FakeBot:
+    def __init__(self, blocked: set = (), rate_limited: set = (), gate_at: int = None):
+        self.blocked = set(blocked)
+        self.rate_limited = set(rate_limited)  # chat ids, which get one 429 before the message is sent
+        self.gate_at = gate_at  # chat id, on which sending waits for `gate`
+        self.gate = threading.Event()
+        self.reached_gate = threading.Event()
+        self.sent = []
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if chat_id == self.gate_at:
+            self.reached_gate.set()
+            self.gate.wait(5)
+        if chat_id in self.blocked:
+            raise telegram_error(403, "Forbidden: bot was blocked by the user")
+        if chat_id in self.rate_limited:
+            self.rate_limited.discard(chat_id)
+            raise telegram_error(429, "Too Many Requests", retry_after=0)
+        self.sent.append(chat_id)
+
+
+def make_broadcaster(bot, tmp_path, finished: list = None) -> Broadcaster:
+    return Broadcaster(bot, str(tmp_path / "broadcast.json"), rate=10000, save_interval=0,
+                       on_finish=finished.append if finished is not None else None)
+
+
+def stop_at_gate(bot: FakeBot, stop) -> None:
+    """Call `stop()` while the bot is sending to `gate_at`, so the job stops right after this recipient."""
+    assert bot.reached_gate.wait(5)
+    stopper = threading.Thread(target=stop)
+    stopper.start()
+    bot.gate.set()
+    stopper.join(5)
+
+
+def test_token_bucket_limits_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=4, clock=clock, sleep=clock.sleep)  # Степени двойки - время без ошибок округления
+
+    for _ in range(4):  # Полное ведро - без ожидания
+        assert bucket.acquire()
+    assert clock.sleeps == []
+
+    for _ in range(8):
+        assert bucket.acquire()
+    assert clock.sleeps == [0.25] * 8
+    assert clock.now == 2
+
+
+def test_token_bucket_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=4, clock=clock, sleep=clock.sleep)
+    bucket.pause(5)
+
+    assert bucket.acquire()
+    assert clock.now == 5.25  # Пауза, затем ведро наполняется с нуля
+
+
+def test_token_bucket_stops_on_event():
+    bucket = TokenBucket(rate=0.001)
+    bucket.tokens = 0
+    stop_event = threading.Event()
+    stop_event.set()
+    assert not bucket.acquire(stop_event)
+
+
+def test_broadcast_counts_blocked_users(tmp_path):
+    bot = FakeBot(blocked={2, 4}, rate_limited={3})
+    finished = []
+    broadcaster = make_broadcaster(bot, tmp_path, finished)
+
+    assert broadcaster.start([1, 2, 3, 4, 5], "Hello")
+    broadcaster.thread.join(5)
+
+    assert bot.sent == [1, 3, 5]  # После 429 сообщение отправлено повторно
+    assert finished[0]["sent"] == 3
+    assert finished[0]["failed"] == [2, 4]
+    assert not finished[0]["cancelled"]
+    assert not (tmp_path / "broadcast.json").exists()
+
+
+def test_only_one_broadcast_at_a_time(tmp_path):
+    bot = FakeBot(gate_at=1)
+    broadcaster = make_broadcaster(bot, tmp_path)
+    assert broadcaster.start([1, 2], "Hello")
+    assert bot.reached_gate.wait(5)
+
+    assert not broadcaster.start([3], "Other")
+    bot.gate.set()
+    broadcaster.thread.join(5)
+    assert bot.sent == [1, 2]
+
+
+def test_stopped_broadcast_is_resumed_after_restart(tmp_path):
+    bot = FakeBot(blocked={2}, gate_at=3)
+    broadcaster = make_broadcaster(bot, tmp_path)
+    broadcaster.start([1, 2, 3, 4, 5], "<b>Hello</b>")
+    stop_at_gate(bot, broadcaster.stop)
+
+    with open(tmp_path / "broadcast.json", encoding="utf-8") as file:
+        state = json.load(file)
+    assert state["position"] == 3
+    assert state["failed"] == [2]
+
+    # Новый процесс бота продолжает с того же места
+    new_bot = FakeBot()
+    finished = []
+    restarted = make_broadcaster(new_bot, tmp_path, finished)
+    assert restarted.resume()
+    restarted.thread.join(5)
+
+    assert new_bot.sent == [4, 5]
+    assert finished[0]["sent"] == 4
+    assert finished[0]["failed"] == [2]
+    assert finished[0]["text"] == "<b>Hello</b>"
+    assert not (tmp_path / "broadcast.json").exists()
+    assert not make_broadcaster(FakeBot(), tmp_path).resume()  # Нечего продолжать
+
+
+def test_cancel(tmp_path):
+    bot = FakeBot(gate_at=2)
+    finished = []
+    broadcaster = make_broadcaster(bot, tmp_path, finished)
+    broadcaster.start([1, 2, 3, 4], "Hello")
+    stop_at_gate(bot, broadcaster.cancel)
+
+    assert bot.sent == [1, 2]
+    assert finished[0]["cancelled"]
+    assert finished[0]["position"] == 2
+    assert not (tmp_path / "broadcast.json").exists()  # Отмененную рассылку не продолжаем
+    assert not broadcaster.cancel()
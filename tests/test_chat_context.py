@@ -0,0 +1,317 @@
+import json
+
+import chat_context
+from chat_context import ChatContextStore
+
+MODEL = "gpt-3.5-turbo"
+
+
+def message(i: int, role: str = "user") -> dict:
+    return {"role": role, "content": f"message number {i} " + "word " * 20}
+
+
+def make_store(tmp_path, **kwargs) -> ChatContextStore:
+    return ChatContextStore(str(tmp_path / "chat_context"), **kwargs)
+
+
+def read_lines(store: ChatContextStore, user_id: int) -> list:
+    with open(store._path(user_id), encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_no_summary_candidates_for_short_history(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(i) for i in range(3)], MODEL)
+
+    assert store.get_summary_candidates(1, max_tokens=10000, keep_last=1) is None
+    assert store.get_summary_candidates(1, max_tokens=1, keep_last=3) is None  # Нечего пересказывать
+    assert store.get_summary_candidates(2, max_tokens=1, keep_last=1) is None  # Истории нет в кэше
+
+
+def test_summary_replaces_oldest_messages(tmp_path):
+    store = make_store(tmp_path)
+    messages = [message(i) for i in range(6)]
+    store.add_messages(1, messages, MODEL)
+    store.flush()
+
+    context, summary, candidates = store.get_summary_candidates(1, max_tokens=50, keep_last=2)
+    assert summary is None
+    assert candidates == messages[:4]
+
+    assert store.apply_summary(1, context, "They talked about numbers", candidates)
+    assert context.history() == messages[4:]
+    assert context.messages()[0]["role"] == "system"
+    assert "They talked about numbers" in context.messages()[0]["content"]
+    assert context.summary_tokens > 0
+
+    store.flush()  # Файл переписан: пересказ первой строкой, затем оставшиеся сообщения
+    assert read_lines(store, 1) == [{"summary": "They talked about numbers"}] + messages[4:]
+
+    reloaded = make_store(tmp_path).get(1, MODEL)
+    assert reloaded.summary == "They talked about numbers"
+    assert reloaded.history() == messages[4:]
+
+
+def test_next_summary_gets_previous_one(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(i) for i in range(4)], MODEL)
+    context, _, candidates = store.get_summary_candidates(1, max_tokens=10, keep_last=1)
+    store.apply_summary(1, context, "first summary", candidates)
+
+    store.add_messages(1, [message(i) for i in range(4, 8)], MODEL)
+    _, summary, candidates = store.get_summary_candidates(1, max_tokens=10, keep_last=1)
+    assert summary == "first summary"
+    assert candidates[0] == context.history()[0]
+
+
+def test_messages_added_while_summarizing_are_kept(tmp_path):
+    store = make_store(tmp_path)
+    messages = [message(i) for i in range(6)]
+    store.add_messages(1, messages, MODEL)
+    context, _, candidates = store.get_summary_candidates(1, max_tokens=50, keep_last=2)
+
+    # Пока модель пересказывала, юзер прислал новое сообщение, а старые обрезались по лимиту
+    new_message = message(6)
+    store.add_messages(1, [new_message], MODEL)
+    store.trim(1, max_chars=sum(len(m["content"]) for m in messages[2:]) + len(new_message["content"]))
+    assert context.history()[0] == messages[2]
+
+    assert store.apply_summary(1, context, "summary", candidates)
+    assert context.history() == messages[4:] + [new_message]
+
+    store.flush()
+    assert read_lines(store, 1) == [{"summary": "summary"}] + messages[4:] + [new_message]
+
+
+def test_summary_is_not_applied_to_deleted_or_reloaded_history(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(i) for i in range(4)], MODEL)
+    context, _, candidates = store.get_summary_candidates(1, max_tokens=10, keep_last=1)
+
+    store.delete(1)  # /new_chat во время пересказа
+    assert not store.apply_summary(1, context, "summary", candidates)
+    assert 1 not in store
+
+    store.add_messages(1, [message(10)], MODEL)  # Новая история - чужой пересказ к ней не применяется
+    assert not store.apply_summary(1, context, "summary", candidates)
+    assert store.get(1, MODEL).summary is None
+
+
+def test_new_messages_are_appended_on_flush(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(0), message(1, "assistant")], MODEL)
+    assert not (tmp_path / "chat_context" / "1.jsonl").exists()  # Запись отложена до flush
+
+    store.flush()
+    store.add_messages(1, [message(2)], MODEL, save=False)  # Сохранится вместе со следующими
+    store.flush()
+    assert read_lines(store, 1) == [message(0), message(1, "assistant")]
+
+    store.add_messages(1, [message(3, "assistant")], MODEL)
+    store.flush()
+    assert read_lines(store, 1) == [message(0), message(1, "assistant"), message(2), message(3, "assistant")]
+
+    assert make_store(tmp_path).get(1, MODEL).history() == read_lines(store, 1)
+
+
+def test_trimmed_history_rewrites_file(tmp_path):
+    store = make_store(tmp_path)
+    messages = [message(i) for i in range(5)]
+    store.add_messages(1, messages, MODEL)
+    store.flush()
+
+    assert store.trim(1, max_chars=len(messages[0]["content"]) * 2) == 3
+    store.flush()
+    assert read_lines(store, 1) == messages[3:]
+    assert not (tmp_path / "chat_context" / "1.jsonl.tmp").exists()
+
+
+def test_legacy_json_history_is_converted(tmp_path):
+    folder = tmp_path / "chat_context"
+    folder.mkdir()
+    with open(folder / "1.json", "w", encoding="utf-8") as file:
+        json.dump([message(0), message(1, "assistant")], file)
+
+    store = make_store(tmp_path)
+    assert store.get(1, MODEL).history() == [message(0), message(1, "assistant")]
+    store.add_messages(1, [message(2)], MODEL)
+    store.flush()
+
+    assert not (folder / "1.json").exists()
+    assert read_lines(store, 1) == [message(0), message(1, "assistant"), message(2)]
+
+
+def test_truncated_line_is_dropped_and_file_rewritten(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(0)], MODEL)
+    store.flush()
+    with open(store._path(1), "a", encoding="utf-8") as file:
+        file.write('{"role": "user", "cont')  # Падение посреди записи
+
+    reloaded = make_store(tmp_path)
+    reloaded.add_messages(1, [message(1)], MODEL)
+    reloaded.flush()
+    assert read_lines(reloaded, 1) == [message(0), message(1)]
+
+
+def test_failed_write_is_retried_with_rewrite(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(0)], MODEL)
+    store.flush()
+    store.add_messages(1, [message(1)], MODEL)
+
+    real_write = store._write
+    monkeypatch.setattr(store, "_write", lambda *args: (_ for _ in ()).throw(OSError("disk full")))
+    store.flush()
+    monkeypatch.setattr(store, "_write", real_write)
+    store.flush()
+
+    assert read_lines(store, 1) == [message(0), message(1)]
+
+
+def test_delete_removes_history(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(0)], MODEL)
+    store.flush()
+    store.delete(1)
+
+    assert 1 not in store
+    assert not (tmp_path / "chat_context" / "1.jsonl").exists()
+    assert make_store(tmp_path).get(1, MODEL).history() == []
+
+
+def test_least_recently_used_history_is_evicted(tmp_path):
+    store = make_store(tmp_path)
+    for user_id in (1, 2, 3):
+        store.add_messages(user_id, [message(user_id)], MODEL)
+    store.get(1, MODEL)  # 2 - самая давно использованная
+    store.max_bytes = store.resident_bytes - 1
+    store._evict_over_limit()
+
+    assert list(store.contexts) == [3, 1]
+    assert 2 in store.evicted
+    assert store.stats()["evictions"] == 1
+
+
+def test_newest_history_is_kept_over_limit(tmp_path):
+    store = make_store(tmp_path, max_bytes=1)
+    store.add_messages(1, [message(0)], MODEL)
+    store.add_messages(2, [message(1)], MODEL)
+
+    assert list(store.contexts) == [2]
+    assert store.resident_bytes == store.contexts[2].total_bytes
+
+
+def test_evicted_unsaved_history_is_returned_from_memory(tmp_path):
+    store = make_store(tmp_path, max_bytes=1)
+    store.add_messages(1, [message(0), message(1, "assistant")], MODEL)
+    evicted = store.get(1, MODEL)
+    store.add_messages(2, [message(2)], MODEL)
+    assert store.evicted[1] is evicted
+    assert not (tmp_path / "chat_context" / "1.jsonl").exists()
+
+    misses = store.misses
+    assert store.get(1, MODEL) is evicted  # Без чтения с диска
+    assert store.misses == misses
+    assert 1 not in store.evicted
+
+
+def test_evicted_history_is_reloaded_intact_after_flush(tmp_path):
+    store = make_store(tmp_path, max_bytes=1)
+    messages = [message(0), message(1, "assistant"), message(2)]
+    store.add_messages(1, messages[:2], MODEL)
+    store.add_messages(1, messages[2:], MODEL, save=False)
+    store.trim(1, max_tokens=10 ** 6)  # Ничего не удаляет
+    context, _, candidates = store.get_summary_candidates(1, max_tokens=1, keep_last=2)
+    store.apply_summary(1, context, "A summary", candidates)
+    store.add_messages(2, [message(3)], MODEL)  # Вытесняет 1
+
+    store.flush()
+    assert 1 not in store.evicted
+    assert 1 not in store
+
+    reloaded = store.get(1, MODEL)
+    assert reloaded is not context
+    assert reloaded.history() == messages[1:]
+    assert reloaded.summary == "A summary"
+    assert reloaded.total_tokens == context.total_tokens
+    assert reloaded.summary_tokens == context.summary_tokens
+
+
+def test_saved_history_is_dropped_on_eviction(tmp_path):
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(0)], MODEL)
+    store.flush()
+    store.max_bytes = 1
+    store.add_messages(2, [message(1)], MODEL)
+
+    assert 1 not in store  # Уже на диске - держать в памяти незачем
+    assert store.get(1, MODEL).history() == [message(0)]
+
+
+def test_idle_histories_are_evicted_after_ttl(tmp_path):
+    store = make_store(tmp_path, ttl=60)
+    store.add_messages(1, [message(0)], MODEL)
+    store.add_messages(2, [message(1)], MODEL)
+    store.contexts[1].last_used -= 61
+
+    store.evict_idle()
+    assert list(store.contexts) == [2]
+    assert 1 in store.evicted
+
+    store.flush()
+    assert 1 not in store.evicted
+    assert make_store(tmp_path).get(1, MODEL).history() == [message(0)]
+
+
+def test_close_saves_everything(tmp_path):
+    store = make_store(tmp_path, flush_interval=3600)
+    store.start()
+    store.add_messages(1, [message(0)], MODEL)
+    store.add_messages(2, [message(1)], MODEL)
+    store.close()
+
+    reloaded = make_store(tmp_path)
+    assert reloaded.get(1, MODEL).history() == [message(0)]
+    assert reloaded.get(2, MODEL).history() == [message(1)]
+
+
+def fake_tokenizer(monkeypatch) -> None:
+    # "wide" модель считает каждое слово за 2 токена, остальные - за 1
+    monkeypatch.setattr(chat_context, "get_encoding_name", lambda model: "wide" if model == "wide" else "narrow")
+    monkeypatch.setattr(chat_context, "count_tokens", lambda text, model: len(text.split()) * (2 if model == "wide" else 1))
+
+
+def test_tokens_are_recounted_for_model_with_other_encoding(tmp_path, monkeypatch):
+    fake_tokenizer(monkeypatch)
+    store = make_store(tmp_path)
+    messages = [message(i) for i in range(4)]  # 23 слова + 3 служебных токена
+    store.add_messages(1, messages, MODEL)
+    context = store.get(1, MODEL)
+    assert context.total_tokens == 4 * 26
+
+    # Бюджет проверяется токенами новой модели, а не старыми числами
+    assert store.trim(1, max_tokens=2 * 49, model="wide") == 2
+    assert context.model == "wide"
+    assert context.total_tokens == 2 * 49
+    assert [tokens for _, _, tokens in context.entries] == [49, 49]
+
+    store.add_messages(1, [message(4)], "wide")  # Та же кодировка - без пересчета
+    assert context.total_tokens == 3 * 49
+
+    assert store.trim(1, max_tokens=10 ** 6, model="gpt-4") == 0
+    assert context.total_tokens == 3 * 26
+
+
+def test_summary_tokens_follow_model_of_history(tmp_path, monkeypatch):
+    fake_tokenizer(monkeypatch)
+    store = make_store(tmp_path)
+    store.add_messages(1, [message(i) for i in range(3)], "wide")
+    context, _, candidates = store.get_summary_candidates(1, max_tokens=1, keep_last=1)
+    store.apply_summary(1, context, "two words", candidates)
+    wide_summary_tokens = context.summary_tokens
+
+    context.recount(MODEL)
+    assert context.summary_tokens < wide_summary_tokens
+    assert context.summary_tokens == len(context.summary_message()["content"].split()) + 3
+    assert context.total_tokens == 26
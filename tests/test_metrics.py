@@ -0,0 +1,95 @@
+import pytest
+
+from metrics import Histogram, Metrics
+
+
+def make_histogram() -> Histogram:
+    histogram = Histogram(buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    return histogram
+
+
+def test_histogram_counts_values_into_buckets():
+    histogram = make_histogram()
+
+    assert histogram.counts == [1, 2, 1, 1]  # Последний бакет - +Inf
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(16.5)
+    assert histogram.max == 10
+
+
+def test_histogram_value_on_bound_goes_to_lower_bucket():
+    histogram = Histogram(buckets=(1, 2))
+    histogram.observe(1)
+
+    assert histogram.counts == [1, 0, 0]
+
+
+@pytest.mark.parametrize("q, expected", [(0, 0.0), (20, 1.0), (50, 1.75), (80, 4.0), (90, 7.0), (100, 10.0)])
+def test_histogram_percentiles_are_interpolated_inside_bucket(q, expected):
+    assert make_histogram().percentile(q) == pytest.approx(expected)
+
+
+def test_histogram_percentile_is_capped_by_max():
+    histogram = Histogram(buckets=(1, 2))
+    for _ in range(10):
+        histogram.observe(0.01)
+
+    assert histogram.percentile(99) == 0.01
+
+
+def test_empty_histogram_percentile_is_zero():
+    assert Histogram().percentile(95) == 0.0
+
+
+def test_metrics_summary():
+    metrics = Metrics()
+    metrics.observe("openai", 0.5, "gpt-4")
+    metrics.observe("check", 0.001)
+
+    assert [row[:3] for row in metrics.summary()] == [("check", "", 1), ("openai", "gpt-4", 1)]
+
+
+def test_timer_observes_also_on_error():
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.timer("openai", "gpt-4"):
+            raise ValueError
+
+    assert metrics.histograms[("openai", "gpt-4")].count == 1
+
+
+def test_prometheus_text_format():
+    metrics = Metrics(prefix="test")
+    metrics.histograms[("openai", "gpt-4")] = make_histogram()
+    metrics.observe("check", 0.001)
+    metrics.gauge("queue", "Waiting updates", lambda: 3)
+
+    assert metrics.render_prometheus().splitlines() == [
+        "# HELP test_request_phase_seconds Duration of the request phases",
+        "# TYPE test_request_phase_seconds histogram",
+        *[f'test_request_phase_seconds_bucket{{phase="check",le="{bound}"}} 1' for bound in
+          (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, "+Inf")],
+        'test_request_phase_seconds_sum{phase="check"} 0.001',
+        'test_request_phase_seconds_count{phase="check"} 1',
+        'test_request_phase_seconds_bucket{phase="openai",model="gpt-4",le="1"} 1',
+        'test_request_phase_seconds_bucket{phase="openai",model="gpt-4",le="2"} 3',
+        'test_request_phase_seconds_bucket{phase="openai",model="gpt-4",le="4"} 4',
+        'test_request_phase_seconds_bucket{phase="openai",model="gpt-4",le="+Inf"} 5',
+        'test_request_phase_seconds_sum{phase="openai",model="gpt-4"} 16.5',
+        'test_request_phase_seconds_count{phase="openai",model="gpt-4"} 5',
+        "# HELP test_queue Waiting updates",
+        "# TYPE test_queue gauge",
+        "test_queue 3",
+    ]
+
+
+def test_broken_gauge_is_skipped():
+    metrics = Metrics(prefix="test")
+    metrics.gauge("broken", "Always fails", lambda: 1 / 0)
+    metrics.gauge("ok", "Works", lambda: 1)
+
+    text = metrics.render_prometheus()
+    assert "test_broken" not in text
+    assert text.endswith("test_ok 1\n")
@@ -0,0 +1,259 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, get_retry_after, is_transient_error
+
+
+class APIError(Exception):
+    def __init__(self, status_code: int, headers: dict = None, code: str = None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.code = code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_caller(**kwargs):
+    delays = []
+    clock = FakeClock()
+    kwargs.setdefault("failure_threshold", 100)
+    caller = ResilientCaller(sleep=delays.append, clock=clock, **kwargs)
+    return caller, delays, clock
+
+
+def failing(errors: list, result="ok"):
+    """Function, which raises the errors one by one and then returns the result."""
+    calls = []
+
+    def function():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    function.calls = calls
+    return function
+
+
+def test_transient_errors():
+    assert is_transient_error(APIError(500))
+    assert is_transient_error(APIError(429))
+    assert not is_transient_error(APIError(429, code="insufficient_quota"))
+    assert not is_transient_error(APIError(400))
+    assert not is_transient_error(ValueError())
+
+
+def test_retry_after_header():
+    assert get_retry_after(APIError(429, {"retry-after": "3"})) == 3
+    assert get_retry_after(APIError(429, {"retry-after-ms": "1500", "retry-after": "3"})) == 1.5
+    assert get_retry_after(APIError(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) is None
+    assert get_retry_after(APIError(429)) is None
+
+
+def test_transient_errors_are_retried_with_backoff():
+    caller, delays, _ = make_caller(max_retries=3, base_delay=1, max_delay=100)
+    function = failing([APIError(500), APIError(502), APIError(503)])
+
+    assert caller.call("gpt", function) == "ok"
+    assert len(function.calls) == 4
+    # Full jitter: пауза случайная, но не больше base_delay * 2^attempt
+    assert [0 <= delay <= 2 ** attempt for attempt, delay in enumerate(delays)] == [True] * 3
+    assert caller.stats()["retries"] == 3
+
+
+def test_backoff_is_capped_by_max_delay():
+    caller, _, _ = make_caller(base_delay=1, max_delay=5)
+    assert all(caller.get_retry_delay(APIError(500), 10) <= 5 for _ in range(100))
+
+
+def test_retry_after_is_used_as_delay():
+    caller, delays, _ = make_caller(max_delay=10)
+    function = failing([APIError(429, {"retry-after": "4"}), APIError(429, {"retry-after": "60"})])
+
+    assert caller.call("gpt", function) == "ok"
+    assert delays == [4, 10]  # Не дольше max_delay
+
+
+def test_retries_give_up_after_max_retries():
+    caller, delays, _ = make_caller(max_retries=2)
+    function = failing([APIError(500)] * 5)
+
+    with pytest.raises(APIError):
+        caller.call("gpt", function)
+    assert len(function.calls) == 3
+    assert len(delays) == 2
+
+
+def test_permanent_error_is_not_retried():
+    caller, delays, _ = make_caller()
+    function = failing([APIError(400)])
+
+    with pytest.raises(APIError):
+        caller.call("gpt", function)
+    assert len(function.calls) == 1
+    assert delays == []
+
+
+def test_circuit_breaker_states():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    clock.now = 31
+    assert breaker.state == "half-open"
+    assert breaker.allow()  # Одна пробная заявка
+    assert not breaker.allow()
+
+    breaker.record_failure()  # Проба не прошла - снова открыт
+    assert breaker.state == "open"
+    clock.now = 62
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_open_circuit_rejects_calls_per_key():
+    caller, _, clock = make_caller(max_retries=0, failure_threshold=2, reset_timeout=30)
+    for _ in range(2):
+        with pytest.raises(APIError):
+            caller.call("gpt", failing([APIError(503)]))
+
+    with pytest.raises(CircuitOpenError):
+        caller.call("gpt", failing([]))
+    assert caller.call("other-model", failing([])) == "ok"  # Сбой одной модели не блокирует другие
+    assert caller.stats()["open_circuits"] == ["gpt"]
+    assert caller.stats()["rejected"] == 1
+
+    clock.now = 31
+    assert caller.call("gpt", failing([])) == "ok"
+    assert caller.stats()["open_circuits"] == []
+
+
+def test_rate_limit_does_not_open_circuit():
+    caller, _, _ = make_caller(max_retries=0, failure_threshold=1)
+    with pytest.raises(APIError):
+        caller.call("gpt", failing([APIError(429)]))
+    assert caller.call("gpt", failing([])) == "ok"
+
+
+def test_stream_holds_slot_until_consumed():
+    caller, _, _ = make_caller(concurrency={"gpt": 1})
+    stream = caller.call_stream("gpt", lambda: iter([1, 2, 3]))
+
+    assert next(stream) == 1
+    acquired = caller._get_semaphore("gpt").acquire(blocking=False)
+    assert not acquired  # Стрим не дочитан - слот занят
+    assert list(stream) == [2, 3]
+    assert caller._get_semaphore("gpt").acquire(blocking=False)
+
+
+def test_stream_released_on_early_close():
+    caller, _, _ = make_caller(concurrency={"gpt": 1})
+    closed = threading.Event()
+
+    class Stream:
+        def __iter__(self):
+            yield from (1, 2, 3)
+
+        def close(self):
+            closed.set()
+
+    stream = caller.call_stream("gpt", Stream)
+    assert next(stream) == 1
+    stream.close()
+    assert closed.is_set()
+    assert caller._get_semaphore("gpt").acquire(blocking=False)
+
+
+def test_stream_error_trips_breaker():
+    caller, _, _ = make_caller(max_retries=0, failure_threshold=1)
+
+    def broken_stream():
+        yield "Hello"
+        raise APIError(502)
+
+    with pytest.raises(APIError):
+        list(caller.call_stream("gpt", broken_stream))
+    with pytest.raises(CircuitOpenError):
+        list(caller.call_stream("gpt", broken_stream))
+    assert caller._get_semaphore("gpt").acquire(blocking=False)
+
+
+def test_opening_stream_is_retried():
+    caller, delays, _ = make_caller()
+    function = failing([APIError(500)], result=iter(["a", "b"]))
+
+    assert list(caller.call_stream("gpt", function)) == ["a", "b"]
+    assert len(delays) == 1
+
+
+def test_async_stream_holds_slot_and_trips_breaker():
+    caller, _, _ = make_caller(max_retries=0, failure_threshold=1, concurrency={"gpt": 1})
+
+    class Stream:
+        def __init__(self, error=None):
+            self.error = error
+            self.is_closed = False
+
+        async def __aiter__(self):
+            yield "Hello"
+            if self.error is not None:
+                raise self.error
+            yield "world"
+
+        async def close(self):
+            self.is_closed = True
+
+    async def main():
+        ok_stream = Stream()
+
+        async def open_ok():
+            return ok_stream
+
+        stream = caller.call_stream_async("gpt", open_ok)
+        assert await stream.__anext__() == "Hello"
+        assert caller._get_async_semaphore("gpt").locked()
+        assert [chunk async for chunk in stream] == ["world"]
+        assert ok_stream.is_closed
+        assert not caller._get_async_semaphore("gpt").locked()
+
+        async def open_broken():
+            return Stream(APIError(502))
+
+        with pytest.raises(APIError):
+            [chunk async for chunk in caller.call_stream_async("gpt", open_broken)]
+        with pytest.raises(CircuitOpenError):
+            [chunk async for chunk in caller.call_stream_async("gpt", open_ok)]
+        assert not caller._get_async_semaphore("gpt").locked()
+
+    asyncio.run(main())
+
+
+def test_async_call_retries():
+    caller, _, _ = make_caller(base_delay=0)
+    errors = [APIError(500)]
+
+    async def function():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert asyncio.run(caller.call_async("gpt", function)) == "ok"
+    assert caller.stats()["retries"] == 1
@@ -0,0 +1,59 @@
+import os
+import time
+
+from response_cache import ResponseCache
+
+MESSAGES = [{"role": "system", "content": "You are a bot"}, {"role": "user", "content": "hi"}]
+
+
+def request(i: int) -> list:
+    return [MESSAGES[0], {"role": "user", "content": f"question {i}"}]
+
+
+def test_answer_is_returned_from_memory_and_disk(tmp_path):
+    cache = ResponseCache(folder=str(tmp_path))
+    assert cache.get("gpt", MESSAGES) is None
+    cache.put("gpt", MESSAGES, "hello", 42)
+
+    assert cache.get("gpt", MESSAGES)["content"] == "hello"
+    assert cache.get("other-model", MESSAGES) is None
+
+    restarted = ResponseCache(folder=str(tmp_path))
+    assert restarted.get("gpt", MESSAGES)["tokens"] == 42
+    assert restarted.stats()["disk_hits"] == 1
+
+
+def test_expired_answer_is_not_returned(tmp_path):
+    now = [1000.0]
+    cache = ResponseCache(ttl=60, folder=str(tmp_path), clock=lambda: now[0])
+    cache.put("gpt", MESSAGES, "hello", 42)
+
+    now[0] += 61
+    assert cache.get("gpt", MESSAGES) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_tier_removes_oldest_answers_over_limit(tmp_path):
+    cache = ResponseCache(max_entries=1, folder=str(tmp_path), max_disk_entries=10)
+    started = time.time() - 100
+    for i in range(11):
+        cache.put("gpt", request(i), f"answer {i}", 1)
+        path = cache._path(cache.make_key("gpt", request(i)))
+        os.utime(path, (started + i, started + i))  # Порядок записи не зависит от точности времени файловой системы
+
+    # Лимит превышен - остается 90% самых новых ответов
+    assert len(os.listdir(tmp_path)) == 9
+    assert cache.stats()["disk_entries"] == 9
+    assert cache.get("gpt", request(0)) is None
+    assert cache.get("gpt", request(10))["content"] == "answer 10"
+
+
+def test_expired_files_are_removed_on_start(tmp_path):
+    cache = ResponseCache(folder=str(tmp_path))
+    cache.put("gpt", MESSAGES, "hello", 42)
+    old = time.time() - 2 * 24 * 60 * 60
+    os.utime(cache._path(cache.make_key("gpt", MESSAGES)), (old, old))
+
+    restarted = ResponseCache(folder=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+    assert restarted.stats()["disk_entries"] == 0
@@ -0,0 +1,368 @@
+import json
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from storage import JournalStore, SQLiteUserStore, UserStore, write_json_atomic
+
+
+def default_data() -> dict:
+    return {"global": {"requests": 0, "tokens": 0}}
+
+
+def make_store(backend: str, tmp_path):
+    if backend == "memory":
+        return UserStore()
+    if backend == "journal":
+        return JournalStore(str(tmp_path / "data.json"))
+    return SQLiteUserStore(str(tmp_path / "data.db"))
+
+
+def reopen(store, backend: str, tmp_path):
+    """Close the store and load its data again from the backend (the memory store has nothing to reload)."""
+    if backend == "memory":
+        return store
+    store.close()
+    reopened = make_store(backend, tmp_path)
+    reopened.load(default_data())
+    return reopened
+
+
+@pytest.fixture(params=["memory", "journal", "sqlite"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def store(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    store.load(default_data())
+    yield store
+    store.close()
+
+
+def add_user(store, user_id: int, **fields) -> None:
+    record = {"requests": 0, "tokens": 0, "balance": 1000, "name": f"User{user_id}", "username": f"@user{user_id}",
+              "lastdate": "01.01.2024 00:00:00", "lastdate_ts": 0}
+    record.update(fields)
+    store.add(user_id, record)
+
+
+def test_add_get_and_update(store, backend, tmp_path):
+    add_user(store, 1)
+    store.update(1, {"balance": 500, "prompt": "Be short"})  # prompt - поле без колонки в SQLite
+    assert store.increment(1, "requests", 2) == 2
+    store.increment("global", "requests", 2)
+    store.unset(1, "prompt")
+    store.set(1, "lang_model", "gpt-4o")
+
+    store = reopen(store, backend, tmp_path)
+    user = store.get_user(1)
+    assert user["balance"] == 500
+    assert user["requests"] == 2
+    assert user["lang_model"] == "gpt-4o"
+    assert "prompt" not in user
+    assert store.get_global()["requests"] == 2
+    assert store.is_user_exists(1)
+    assert not store.is_user_exists(2)
+    assert not store.is_user_exists("global")
+    assert store.count_users() == 1
+    assert store.user_ids() == [1]
+
+
+def test_add_replaces_existing_user(store, backend, tmp_path):
+    add_user(store, 1, prompt="old")
+    add_user(store, 1, balance=7)
+
+    store = reopen(store, backend, tmp_path)
+    assert store.get_user(1)["balance"] == 7
+    assert "prompt" not in store.get_user(1)
+
+
+def test_username_index(store, backend, tmp_path):
+    add_user(store, 1, username="@Alice")
+    add_user(store, 2, username="None")  # Так в data.json записаны юзеры без username
+
+    assert store.find_user_by_username("alice") == 1
+    assert store.find_user_by_username("@ALICE") == 1
+    assert store.find_user_by_username("None") is None
+
+    store.set(1, "username", "@alice_new")
+    store = reopen(store, backend, tmp_path)
+    assert store.find_user_by_username("alice") is None
+    assert store.find_user_by_username("alice_new") == 1
+
+
+def test_referral_index(store, backend, tmp_path):
+    add_user(store, 1)
+    add_user(store, 2, ref_id=1)
+    add_user(store, 3, ref_id=1)
+    add_user(store, 4, ref_id=2)
+
+    store = reopen(store, backend, tmp_path)
+    assert store.get_referrer(2) == 1
+    assert store.get_referrer(1) is None
+    assert store.get_referrals(1) == [2, 3]
+    assert store.top_referrers(1) == [(1, 2)]
+
+    store.set(3, "ref_id", 2)
+    assert store.get_referrals(1) == [2]
+    assert sorted(store.get_referrals(2)) == [3, 4]
+
+
+def test_top_users(store, backend, tmp_path):
+    add_user(store, 1, tokens=100, favors=0)
+    add_user(store, 2, tokens=300)
+    add_user(store, 3, tokens=200)
+    add_user(store, 4, tokens=0)
+
+    store = reopen(store, backend, tmp_path)
+    assert store.top_users("tokens", 2) == [(2, 300), (3, 200)]
+    assert store.top_users("tokens", 10) == [(2, 300), (3, 200), (1, 100)]  # Нулевые не попадают в топ
+    assert store.top_users("favors", 10) == []
+
+
+def test_top_users_by_weighted_sum(store, backend, tmp_path):
+    add_user(store, 1, tokens=1000, premium_tokens=0)
+    add_user(store, 2, tokens=100, premium_tokens=100)
+    add_user(store, 3, tokens=0)  # premium_tokens нет - считается как 0
+
+    store = reopen(store, backend, tmp_path)
+    top = store.top_users_by_weighted_sum({"tokens": 0.1, "premium_tokens": 5}, 10)
+    assert [user_id for user_id, _ in top] == [2, 1]
+    assert top[0][1] == pytest.approx(510)
+    assert top[1][1] == pytest.approx(100)
+    assert store.top_users_by_weighted_sum({"tokens": 0.1, "premium_tokens": 5}, 1) == top[:1]
+
+
+def test_recent_users(store, backend, tmp_path):
+    add_user(store, 1, lastdate_ts=100)
+    add_user(store, 2, lastdate_ts=300)
+    add_user(store, 3, lastdate_ts=200)
+    add_user(store, 4)  # Еще не делал запросов
+
+    store.set(1, "lastdate_ts", 400)
+    store = reopen(store, backend, tmp_path)
+    assert store.recent_users(150) == [(1, 400), (2, 300), (3, 200)]
+    assert store.recent_users(1000) == []
+
+
+def test_recent_users_after_clock_goes_back(store):
+    add_user(store, 1, lastdate_ts=300)
+    add_user(store, 2, lastdate_ts=200)  # Время из прошлого
+
+    assert store.recent_users(0) == [(1, 300), (2, 200)]
+
+
+def test_export_json(store, tmp_path):
+    add_user(store, 1, balance=42)
+    store.export_json(str(tmp_path / "backup.json"))
+
+    with open(tmp_path / "backup.json", encoding="utf-8") as file:
+        backup = json.load(file)
+    assert backup["1"]["balance"] == 42
+    assert backup["global"] == default_data()["global"]
+
+
+def test_sqlite_schema(tmp_path):
+    store = SQLiteUserStore(str(tmp_path / "data.db"))
+    store.load(default_data())
+    add_user(store, 1, prompt="Be short", ref_id=5)
+    store.close()
+
+    connection = sqlite3.connect(str(tmp_path / "data.db"))
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    columns = {row[1]: row[2] for row in connection.execute("PRAGMA table_info(users)")}
+    assert columns["id"] == "INTEGER"
+    assert columns["balance"] == "INTEGER"
+    assert columns["lastdate_ts"] == "REAL"
+    assert columns["username"] == "TEXT"
+    indexes = {row[1] for row in connection.execute("PRAGMA index_list(users)")}
+    assert {f"users_{column}" for column in SQLiteUserStore.INDEXED_COLUMNS} <= indexes
+
+    balance, ref_id, extra = connection.execute("SELECT balance, ref_id, extra FROM users WHERE id = 1").fetchone()
+    assert (balance, ref_id) == (1000, 5)
+    assert json.loads(extra) == {"prompt": "Be short"}
+    assert dict(connection.execute("SELECT field, value FROM global_stats")) == default_data()["global"]
+    connection.close()
+
+
+def test_sqlite_imports_data_json_with_journal(tmp_path):
+    data_path = str(tmp_path / "data.json")
+    write_json_atomic(data_path, {"global": {"requests": 5}, "1": {"name": "Old", "balance": 10, "prompt": "hi"}})
+    with open(data_path + ".journal", "w", encoding="utf-8") as journal:  # Недосохраненные изменения тоже переносятся
+        journal.write(json.dumps({"id": 1, "set": {"balance": 20}}) + "\n")
+        journal.write(json.dumps({"id": 2, "new": True, "set": {"name": "New", "ref_id": 1}}) + "\n")
+
+    store = SQLiteUserStore(str(tmp_path / "data.db"), import_path=data_path)
+    store.load(default_data())
+    store.close()
+
+    # Импорт только в пустую базу: второй запуск читает уже саму базу
+    write_json_atomic(data_path, {"global": {"requests": 999}})
+    store = SQLiteUserStore(str(tmp_path / "data.db"), import_path=data_path)
+    store.load(default_data())
+    assert store.get_global() == {"requests": 5}
+    assert store.get_user(1) == {"name": "Old", "balance": 20, "prompt": "hi"}
+    assert store.get_user(2) == {"name": "New", "ref_id": 1}
+    assert store.get_referrals(1) == [2]
+    store.close()
+
+
+def test_sqlite_without_import_uses_default_data(tmp_path):
+    store = SQLiteUserStore(str(tmp_path / "data.db"), import_path=str(tmp_path / "missing.json"))
+    assert store.load(default_data()) == default_data()
+    store.close()
+
+
+def read_journal(path) -> list:
+    with open(path, encoding="utf-8") as journal:
+        return [json.loads(line) for line in journal]
+
+
+def test_journal_records_only_changed_fields(tmp_path):
+    store = JournalStore(str(tmp_path / "data.json"))
+    store.load(default_data())
+    add_user(store, 1)
+    store.increment(1, "requests", 1)
+    store.unset(1, "lastdate")
+
+    records = read_journal(tmp_path / "data.json.journal")
+    assert records[1:] == [{"id": 1, "set": {"requests": 1}}, {"id": 1, "unset": ["lastdate"]}]
+    store.close()
+
+
+def test_journal_is_replayed_after_crash(tmp_path):
+    store = JournalStore(str(tmp_path / "data.json"))
+    store.load(default_data())
+    add_user(store, 1, username="@alice", lastdate_ts=100)
+    add_user(store, 2, ref_id=1)
+    store.set(1, "balance", 5)
+    store._journal.close()  # Падение: снапшот не переписан, в журнале все изменения
+
+    with open(tmp_path / "data.json.journal", "a", encoding="utf-8") as journal:
+        journal.write('{"id": 1, "set": {"bala')  # Недописанная строка
+
+    restored = JournalStore(str(tmp_path / "data.json"))
+    restored.load(default_data())
+    assert restored.get_user(1)["balance"] == 5
+    assert restored.find_user_by_username("alice") == 1
+    assert restored.get_referrals(1) == [2]
+    assert restored.recent_users(0) == [(1, 100)]
+
+    # После восстановления журнал сразу сброшен в снапшот
+    with open(tmp_path / "data.json", encoding="utf-8") as snapshot:
+        assert json.load(snapshot)["1"]["balance"] == 5
+    assert read_journal(tmp_path / "data.json.journal") == []
+    restored.close()
+
+
+def test_rotated_journal_of_interrupted_compaction_is_replayed(tmp_path):
+    write_json_atomic(str(tmp_path / "data.json"), {"global": {}, "1": {"balance": 1}})
+    with open(tmp_path / "data.json.journal.old", "w", encoding="utf-8") as journal:
+        journal.write(json.dumps({"id": 1, "set": {"balance": 2}}) + "\n")
+    with open(tmp_path / "data.json.journal", "w", encoding="utf-8") as journal:  # Более новые записи
+        journal.write(json.dumps({"id": 1, "set": {"balance": 3}}) + "\n")
+
+    store = JournalStore(str(tmp_path / "data.json"))
+    store.load(default_data())
+    assert store.get_user(1)["balance"] == 3
+    assert not (tmp_path / "data.json.journal.old").exists()
+    store.close()
+
+
+def test_compaction_writes_snapshot_and_empties_journal(tmp_path):
+    store = JournalStore(str(tmp_path / "data.json"), compact_threshold=3, compact_interval=60)
+    store.load(default_data())
+    for user_id in range(1, 3):
+        add_user(store, user_id)
+    assert not store._compact_event.is_set()
+    add_user(store, 3)
+    assert store._compact_event.is_set()  # Порог достигнут - фоновый поток разбужен
+
+    store.compact()
+    with open(tmp_path / "data.json", encoding="utf-8") as snapshot:
+        assert set(json.load(snapshot)) == {"global", "1", "2", "3"}
+    assert read_journal(tmp_path / "data.json.journal") == []
+
+    store.set(1, "balance", 7)
+    store.close()  # Последний снапшот при остановке
+    with open(tmp_path / "data.json", encoding="utf-8") as snapshot:
+        assert json.load(snapshot)["1"]["balance"] == 7
+    assert read_journal(tmp_path / "data.json.journal") == []
+
+
+def test_indexes_are_rebuilt_on_load(tmp_path):
+    write_json_atomic(str(tmp_path / "data.json"), {
+        "global": {},
+        "1": {"username": "@Alice", "lastdate_ts": 300},
+        "2": {"username": "None", "ref_id": 1, "lastdate_ts": 100},
+        "3": {"username": "@bob", "ref_id": 1, "lastdate_ts": 200},
+    })
+    store = JournalStore(str(tmp_path / "data.json"))
+    store.load(default_data())
+
+    assert store.find_user_by_username("alice") == 1
+    assert store.find_user_by_username("bob") == 3
+    assert store.get_referrals(1) == [2, 3]
+    assert store.recent_users(150) == [(1, 300), (3, 200)]
+    store.close()
+
+
+def test_username_index_keeps_new_owner_of_username(store):
+    add_user(store, 1, username="@alice")
+    add_user(store, 2, username="@alice")  # Юзер 1 сменил username, юзер 2 занял старый
+    store.set(1, "username", "@alice_new")
+
+    assert store.find_user_by_username("alice") == 2
+    assert store.find_user_by_username("alice_new") == 1
+
+
+def test_concurrent_atomic_writes_of_same_file(tmp_path):
+    path = str(tmp_path / "data.json")
+    errors = []
+
+    def write(value: int) -> None:
+        try:
+            for _ in range(50):
+                write_json_atomic(path, {"value": value, "padding": "x" * 10000})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(value,)) for value in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with open(path, encoding="utf-8") as file:
+        assert json.load(file)["value"] in range(4)
+    assert os.listdir(tmp_path) == ["data.json"]  # Временные файлы не остаются
+
+
+def test_export_during_compaction(tmp_path):
+    store = JournalStore(str(tmp_path / "data.json"), compact_threshold=1)
+    store.load(default_data())
+    errors = []
+
+    def export() -> None:  # /data пишет тот же файл, что и компактификация
+        try:
+            for _ in range(30):
+                store.export_json(str(tmp_path / "data.json"))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=export)
+    thread.start()
+    for user_id in range(1, 31):
+        add_user(store, user_id)
+        store.compact()
+    thread.join()
+    store.close()
+
+    assert errors == []
+    with open(tmp_path / "data.json", encoding="utf-8") as file:
+        assert len(json.load(file)) == 31
@@ -0,0 +1,78 @@
+from streaming import StreamingMessageBuffer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def apply(parts: list, operations: list) -> None:
+    """Apply the operations of the buffer to the list of message texts, like the bot does with Telegram messages."""
+    for action, index, text in operations:
+        if action == "send":
+            assert index == len(parts)
+            parts.append(text)
+        else:
+            assert index < len(parts)
+            parts[index] = text
+
+
+def test_first_text_is_sent_at_once_and_edits_are_rate_limited():
+    clock = FakeClock()
+    buffer = StreamingMessageBuffer(edit_interval=1.5, clock=clock)
+
+    assert buffer.feed("   ") == []  # Пробелы не отправляем
+    assert buffer.feed("Hello") == [("send", 0, "   Hello")]
+    assert buffer.feed(" world") == []
+
+    clock.now = 2
+    assert buffer.feed("!") == [("edit", 0, "   Hello world!")]
+
+
+def test_finish_edits_every_sent_part_for_formatting():
+    buffer = StreamingMessageBuffer(edit_interval=100, clock=FakeClock())
+    buffer.feed("Hello")
+    buffer.feed(" world")
+
+    assert buffer.finish() == [("edit", 0, "Hello world")]
+
+
+def test_long_answer_rolls_over_to_new_message_at_4096():
+    clock = FakeClock()
+    buffer = StreamingMessageBuffer(clock=clock)
+    parts = []
+
+    words = [f"word{i} " for i in range(2000)]
+    for word in words:
+        clock.now += 1  # Каждый кусок приходит после интервала редактирования
+        apply(parts, buffer.feed(word))
+    apply(parts, buffer.finish())
+
+    assert len(parts) > 1
+    assert all(len(part) <= 4096 for part in parts)
+    assert "".join(parts) == "".join(words)
+    # Режем по пробелу, а не посреди слова
+    assert all(part.endswith(" ") for part in parts[:-1])
+
+
+def test_text_without_separators_is_cut_exactly_at_limit():
+    buffer = StreamingMessageBuffer(max_length=10, clock=FakeClock())
+    parts = []
+
+    apply(parts, buffer.feed("a" * 25))
+    apply(parts, buffer.finish())
+
+    assert parts == ["a" * 10, "a" * 10, "a" * 5]
+
+
+def test_big_delta_closes_sent_part_and_sends_next_ones():
+    clock = FakeClock()
+    buffer = StreamingMessageBuffer(max_length=10, edit_interval=1, clock=clock)
+
+    assert buffer.feed("abc") == [("send", 0, "abc")]
+    clock.now = 5
+    assert buffer.feed("d" * 15) == [("edit", 0, "abcddddddd"), ("send", 1, "d" * 8)]
+    assert buffer.finish() == [("edit", 0, "abcddddddd"), ("edit", 1, "d" * 8)]
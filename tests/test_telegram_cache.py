@@ -0,0 +1,70 @@
+import threading
+import time
+
+from telegram_cache import TelegramMetadataCache
+
+
+class Loader:
+    def __init__(self):
+        self.calls = 0
+        self.loaded = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.loaded.set()
+        return f"value {self.calls}"
+
+
+def test_value_is_loaded_once():
+    cache = TelegramMetadataCache(bot=None, ttl=60)
+    loader = Loader()
+
+    assert cache.get("me", loader) == "value 1"
+    assert cache.get("me", loader) == "value 1"
+    assert loader.calls == 1
+
+
+def test_stale_value_is_returned_while_refreshing():
+    now = [0.0]
+    cache = TelegramMetadataCache(bot=None, ttl=60, clock=lambda: now[0])
+    loader = Loader()
+    cache.get("me", loader)
+
+    now[0] = 61
+    loader.loaded.clear()
+    assert cache.get("me", loader) == "value 1"
+    assert loader.loaded.wait(1)
+    for _ in range(100):  # Новое значение сохраняется сразу после загрузки
+        if cache.get("me", loader) == "value 2":
+            break
+        time.sleep(0.01)
+    assert cache.get("me", loader) == "value 2"
+
+
+def test_failed_refresh_keeps_old_value():
+    now = [0.0]
+    cache = TelegramMetadataCache(bot=None, ttl=60, clock=lambda: now[0])
+    cache.get("me", lambda: "old")
+
+    def fail():
+        raise ConnectionError("Telegram is down")
+
+    now[0] = 61
+    assert cache.get("me", fail) == "old"
+    for _ in range(100):
+        if not cache.refreshing:
+            break
+        time.sleep(0.01)
+    assert cache.get("me", fail) == "old"
+
+
+def test_scheduled_refresh():
+    cache = TelegramMetadataCache(bot=None, ttl=0.05)
+    loader = Loader()
+    cache.get("me", loader)
+    cache.start()
+
+    loader.loaded.clear()
+    assert loader.loaded.wait(1)  # Обновилось по расписанию, без запросов к кэшу
+    cache.close()
+    assert cache._refresh_thread is None
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+import transcoding
+from transcoding import TranscodingBusyError, TranscodingService
+
+
+# Вместо ogg_to_mp3 - функции уровня модуля, чтобы их можно было передать в процесс пула
+def reverse(data: bytes) -> bytes:
+    return data[::-1]
+
+
+def sleep_seconds(data: bytes) -> bytes:
+    time.sleep(float(data))
+    return data
+
+
+def missing_ffmpeg(data: bytes) -> bytes:
+    raise FileNotFoundError(2, "No such file or directory", "ffmpeg")
+
+
+@pytest.fixture
+def service():
+    service = TranscodingService(max_workers=1, max_pending=1, timeout=10)
+    yield service
+    service.close()
+
+
+def wait_for_free_slot(service: TranscodingService) -> None:
+    deadline = time.monotonic() + 10
+    while not service.slots.acquire(blocking=False):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    service.slots.release()
+
+
+def test_transcodes_in_process_pool(service, monkeypatch):
+    monkeypatch.setattr(transcoding, "ogg_to_mp3", reverse)
+
+    assert service.transcode(b"abc") == b"cba"
+    assert isinstance(service.executor, ProcessPoolExecutor)
+    wait_for_free_slot(service)  # Слот освобождает колбэк задачи, он может сработать чуть позже result()
+    assert service.transcode(b"xyz") == b"zyx"
+
+
+def test_threads_without_fork(service, monkeypatch):
+    monkeypatch.setattr(transcoding, "ogg_to_mp3", reverse)
+    monkeypatch.setattr(transcoding.multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+
+    assert service.transcode(b"abc") == b"cba"
+    assert isinstance(service.executor, ThreadPoolExecutor)
+
+
+def test_rejects_when_all_slots_are_busy(service, monkeypatch):
+    monkeypatch.setattr(transcoding, "ogg_to_mp3", sleep_seconds)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(service.transcode(b"0.5")))
+    thread.start()
+    deadline = time.monotonic() + 10
+    while service.slots._value:  # Ждем, пока первая задача займет слот
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    with pytest.raises(TranscodingBusyError):
+        service.transcode(b"0")
+
+    thread.join()
+    assert results == [b"0.5"]
+    wait_for_free_slot(service)
+    assert service.transcode(b"0") == b"0"
+
+
+def test_timeout_keeps_slot_until_job_ends(service, monkeypatch):
+    monkeypatch.setattr(transcoding, "ogg_to_mp3", sleep_seconds)
+    service.timeout = 0.1
+
+    with pytest.raises(TimeoutError):
+        service.transcode(b"0.5")
+    with pytest.raises(TranscodingBusyError):  # Задача еще выполняется в процессе пула
+        service.transcode(b"0")
+
+    wait_for_free_slot(service)
+    assert service.transcode(b"0") == b"0"
+
+
+def test_missing_ffmpeg_error_reaches_caller(service, monkeypatch):
+    # main.py по FileNotFoundError сообщает, что не установлен ffmpeg - ошибка должна пройти через pickle как есть
+    monkeypatch.setattr(transcoding, "ogg_to_mp3", missing_ffmpeg)
+
+    with pytest.raises(FileNotFoundError) as error:
+        service.transcode(b"ogg")
+    assert error.value.filename == "ffmpeg"
+
+    wait_for_free_slot(service)
+    monkeypatch.setattr(transcoding, "ogg_to_mp3", reverse)
+    assert service.transcode(b"ab") == b"ba"
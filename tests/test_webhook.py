@@ -0,0 +1,113 @@
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from webhook import WebhookServer
+from workers import KeyedWorkerPool
+
+SECRET = "secret"
+
+
+class FakeBot:
+    def __init__(self, num_workers: int = 1):
+        self.keyed_worker_pool = KeyedWorkerPool(num_workers)
+        self.release = threading.Event()
+        self.release.set()
+        self.processed = []
+
+    def process_new_updates(self, updates: list) -> None:
+        for update in updates:
+            self.keyed_worker_pool.put(update.update_id, self._handle, update.update_id)
+
+    def _handle(self, update_id: int) -> None:
+        self.release.wait(5)
+        self.processed.append(update_id)
+
+
+def make_update(update_id: int) -> bytes:
+    return json.dumps({"update_id": update_id}).encode()
+
+
+def post(server: WebhookServer, body: bytes, secret: str = SECRET, path: str = "/hook") -> int:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Length": str(len(body))}
+    return server.handle_request(path, headers, io.BytesIO(body))
+
+
+@pytest.fixture
+def bot():
+    bot = FakeBot()
+    yield bot
+    bot.release.set()
+    bot.keyed_worker_pool.close()
+
+
+def make_server(bot, **kwargs) -> WebhookServer:
+    return WebhookServer(bot, SECRET, host="127.0.0.1", port=0, path="/hook", **kwargs)
+
+
+def test_wrong_secret_is_forbidden(bot):
+    server = make_server(bot)
+    assert post(server, make_update(1), secret="wrong") == 403
+    assert post(server, make_update(1), secret="") == 403
+    assert server.stats()["forbidden"] == 2
+    assert server.stats()["received"] == 0
+    server.stop()
+
+
+def test_wrong_path_and_bad_body(bot):
+    server = make_server(bot, max_body_bytes=100)
+    assert post(server, make_update(1), path="/other") == 404
+    assert post(server, b"x" * 101) == 413
+    assert post(server, b"") == 400
+    assert post(server, b"not json") == 400
+    assert post(server, make_update(1), path="/hook?x=1") == 200
+    server.stop()
+
+
+def test_full_queue_rejects_with_503(bot):
+    server = make_server(bot, queue_size=2)  # Диспетчер не запущен - апдейты копятся в очереди
+    assert post(server, make_update(1)) == 200
+    assert post(server, make_update(2)) == 200
+    assert post(server, make_update(3)) == 503
+    assert server.stats() == {"received": 2, "rejected": 1, "forbidden": 0, "queued": 2}
+    server.stop()
+
+
+def test_busy_handlers_reject_with_503(bot):
+    bot.release.clear()  # Обработчики висят - апдейты копятся в пуле бота, а не в очереди вебхука
+    server = make_server(bot, queue_size=3)
+    server.start()
+    statuses = [post(server, make_update(update_id)) for update_id in range(1, 6)]
+
+    assert statuses[:3] == [200, 200, 200]
+    assert statuses[3:] == [503, 503]
+    bot.release.set()
+    server.stop()
+    bot.keyed_worker_pool.close()
+    assert sorted(bot.processed) == [1, 2, 3]
+    assert post(server, make_update(6)) == 200  # Место освободилось
+
+
+def test_stop_passes_queued_updates_to_bot(bot):
+    server = make_server(bot)
+    server.start()
+    url = f"http://127.0.0.1:{server.httpd.server_address[1]}/hook"
+    for update_id in range(1, 4):
+        request = urllib.request.Request(url, data=make_update(update_id), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+        with urllib.request.urlopen(request, timeout=5) as response:
+            assert response.status == 200
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(urllib.request.Request(url, data=make_update(4)), timeout=5)
+    assert error.value.code == 403
+
+    server.request_stop()
+    server.wait()  # Сразу возвращается после request_stop()
+    server.stop()
+    bot.keyed_worker_pool.close()
+    assert bot.processed == [1, 2, 3]
+    assert server._server_thread is None and server._dispatcher_thread is None
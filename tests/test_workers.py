@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from workers import KeyedWorkerPool, get_update_order_key
+
+
+def test_tasks_with_same_key_run_in_order():
+    pool = KeyedWorkerPool(num_workers=8)
+    results = {key: [] for key in range(5)}
+
+    def task(key, i):
+        time.sleep(random.random() / 1000)  # Разная длительность задач не должна менять порядок
+        results[key].append(i)
+
+    for i in range(50):
+        for key in results:
+            pool.put(key, task, key, i)
+    pool.close()
+
+    assert all(values == list(range(50)) for values in results.values())
+    assert pool.pending_count() == 0
+
+
+def test_tasks_with_same_key_never_overlap():
+    pool = KeyedWorkerPool(num_workers=4)
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def task(key):
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+        time.sleep(0.001)
+        with lock:
+            running.discard(key)
+
+    for i in range(100):
+        pool.put(i % 3, task, i % 3)
+    pool.close()
+
+    assert overlaps == []
+
+
+def test_slow_key_does_not_block_other_keys():
+    pool = KeyedWorkerPool(num_workers=2)
+    release = threading.Event()
+    done = threading.Event()
+
+    pool.put("slow", release.wait, 5)
+    pool.put("slow", lambda: None)  # Ждет первую задачу своего ключа
+    pool.put("fast", done.set)
+
+    assert done.wait(1)
+    assert pool.pending_count() == 2
+    release.set()
+    pool.close()
+
+
+def test_failed_task_does_not_stop_the_key():
+    pool = KeyedWorkerPool(num_workers=1)
+    results = []
+
+    def fail():
+        raise ValueError("boom")
+
+    pool.put(1, fail)
+    pool.put(1, results.append, "next")
+    pool.close()
+
+    assert results == ["next"]
+
+
+def test_none_key_tasks_are_not_ordered():
+    pool = KeyedWorkerPool(num_workers=2)
+    release = threading.Event()
+    done = threading.Event()
+
+    pool.put(None, release.wait, 5)
+    pool.put(None, done.set)
+
+    assert done.wait(1)
+    release.set()
+    pool.close()
+
+
+def test_update_order_key():
+    user = SimpleNamespace(id=1)
+    chat = SimpleNamespace(id=-100)
+
+    assert get_update_order_key(SimpleNamespace(from_user=user, chat=chat)) == 1
+    assert get_update_order_key(SimpleNamespace(from_user=None, chat=chat)) == -100  # Пост в канале
+    assert get_update_order_key(SimpleNamespace()) is None
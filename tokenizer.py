@@ -0,0 +1,54 @@
+import functools
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, without it the number of tokens is estimated by the text size
+    tiktoken = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """
+    Return the tiktoken encoding for the model (loaded once and cached), or None if tiktoken is not available.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:  # Неизвестная tiktoken модель
+            return tiktoken.get_encoding("o200k_base" if model.startswith("gpt-4o") else "cl100k_base")
+    except Exception as e:  # tiktoken качает словари при первом использовании - без сети считаем приблизительно
+        print(f"\nНе удалось загрузить токенизатор для {model}, токены будут считаться приблизительно: {e}")
+        return None
+
+
+def get_encoding_name(model: str) -> Optional[str]:
+    """
+    Return the name of the tiktoken encoding of the model, or None if the tokens are estimated without tiktoken.
+    Models with the same encoding count the same number of tokens in any text.
+    """
+    encoding = get_encoding(model)
+    return None if encoding is None else encoding.name
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Count the number of tokens in the text for the model. Without tiktoken it's an estimate: ~4 bytes of UTF-8 per token.
+    """
+    if not text:
+        return 0
+
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text.encode("utf-8")) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_messages_tokens(messages: list, model: str) -> int:
+    """
+    Count the number of prompt tokens of the chat messages, including the service tokens of the chat format.
+    """
+    # Каждое сообщение обрамляется служебными токенами (~3 на сообщение) и еще 3 токена на начало ответа ассистента
+    return sum(count_tokens(message["content"], model) + 3 for message in messages if isinstance(message.get("content"), str)) + 3
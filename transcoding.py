@@ -0,0 +1,75 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from pydub import AudioSegment
+
+
+class TranscodingBusyError(Exception):
+    """All transcoding slots are taken, the audio was not queued."""
+
+
+def ogg_to_mp3(ogg_bytes: bytes) -> bytes:
+    """Convert OGG audio to MP3 in memory with pydub and ffmpeg. Runs in the worker processes of `TranscodingService`."""
+    sound = AudioSegment.from_file(io.BytesIO(ogg_bytes), format="ogg")
+    mp3_buffer = io.BytesIO()
+    sound.export(mp3_buffer, format="mp3")
+    return mp3_buffer.getvalue()
+
+
+class TranscodingService:
+    """
+    Bounded pool for CPU-heavy audio transcoding, so it runs on other cores and never blocks the bot's handler threads
+    for long. At most `max_pending` jobs (running and queued) are accepted, the next ones are rejected with
+    `TranscodingBusyError` instead of piling up. The worker processes are started on the first job.
+
+    The processes are forked: a spawned process would import the main module of the bot again and start a second bot.
+    Where fork is not available (Windows) the jobs run in threads, ffmpeg itself is a separate process anyway.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 4, timeout: float = 60):
+        """
+        :param max_workers: Number of worker processes
+        :param max_pending: Max number of jobs in the pool, including the running ones
+        :param timeout: Max seconds to wait for the result of one job
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        with self.lock:
+            if self.executor is None:
+                if "fork" in multiprocessing.get_all_start_methods():
+                    self.executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("fork"))
+                else:
+                    self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="Transcoding")
+            return self.executor
+
+    def transcode(self, ogg_bytes: bytes) -> bytes:
+        """
+        Convert OGG audio to MP3 in the pool. Raises `TranscodingBusyError` if the pool is full
+        and `concurrent.futures.TimeoutError` if the job takes longer than `timeout`.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise TranscodingBusyError("All transcoding slots are busy")
+
+        try:
+            future = self._get_executor().submit(ogg_to_mp3, ogg_bytes)
+        except Exception:
+            self.slots.release()
+            raise
+        # Слот освобождается, когда задача реально закончится, даже если мы перестали ее ждать по таймауту
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result(timeout=self.timeout)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
@@ -0,0 +1,161 @@
+import hmac
+import json
+import queue
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot
+from telebot import types
+
+
+class WebhookServer:
+    """
+    Receives updates from Telegram by webhook instead of long polling.
+
+    The HTTP handler only checks the `X-Telegram-Bot-Api-Secret-Token` header, puts the update to a bounded queue
+    and answers 200 at once, so Telegram doesn't wait for the bot handlers and doesn't resend the update.
+    One dispatcher thread passes the queued updates to `bot.process_new_updates()` in the order they came,
+    the bot's own worker pool runs the handlers. `queue_size` limits the updates in the queue together with the tasks
+    waiting in the worker pool of the bot (`OrderedTeleBot`): over the limit Telegram gets 503 and delivers
+    the update later, so a burst of updates doesn't pile up in memory.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, secret_token: str, host: str = "0.0.0.0", port: int = 8443,
+                 path: str = "/", queue_size: int = 1000, max_body_bytes: int = 1024 * 1024,
+                 certificate: str = None, private_key: str = None):
+        """
+        :param secret_token: The `secret_token` of `set_webhook`, requests without it are rejected with 403
+        :param path: The URL path of the webhook, other paths get 404
+        :param queue_size: Max number of updates waiting for the dispatcher and for the handlers
+        :param max_body_bytes: Max size of one update
+        :param certificate: Path to the TLS certificate, if the server is not behind an HTTPS reverse proxy
+        :param private_key: Path to the private key of the certificate
+        """
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.queue_size = queue_size
+        self.max_body_bytes = max_body_bytes
+
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0  # the queue was full
+        self.forbidden = 0  # wrong secret token
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        if certificate is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certificate, private_key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+
+        self._server_thread = None
+        self._dispatcher_thread = None
+
+    def _make_request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = server.handle_request(self.path, self.headers, self.rfile)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                self.send_error(405)
+
+            def log_message(self, format, *args):  # Не пишем в консоль каждый апдейт
+                pass
+
+        return WebhookRequestHandler
+
+    def pending_updates(self) -> int:
+        """Return the number of updates waiting for the dispatcher and the handlers waiting or running in the bot's pool."""
+        worker_pool = getattr(self.bot, "keyed_worker_pool", None)
+        # unfinished_tasks учитывает и апдейт, который диспетчер уже взял, но еще не передал в пул
+        return self.updates.unfinished_tasks + (worker_pool.pending_count() if worker_pool is not None else 0)
+
+    def handle_request(self, path: str, headers, body) -> int:
+        """Check and queue one webhook request. Returns the HTTP status code of the answer."""
+        if path.split("?")[0] != self.path:
+            return 404
+
+        secret_token = headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+        if not hmac.compare_digest(secret_token.encode(), self.secret_token.encode()):
+            with self.lock:
+                self.forbidden += 1
+            return 403
+
+        length = int(headers.get("Content-Length") or 0)
+        if length <= 0 or length > self.max_body_bytes:
+            return 413 if length > 0 else 400
+        try:
+            update = json.loads(body.read(length))
+        except ValueError:
+            return 400
+
+        # Обработчики не успевают - Telegram пришлет апдейт повторно
+        is_queued = False
+        if self.pending_updates() < self.queue_size:
+            try:
+                self.updates.put_nowait(update)
+                is_queued = True
+            except queue.Full:
+                pass
+        if not is_queued:
+            with self.lock:
+                self.rejected += 1
+            return 503
+
+        with self.lock:
+            self.received += 1
+        return 200
+
+    def _dispatch(self) -> None:
+        while True:
+            update = self.updates.get()
+            if update is None:
+                self.updates.task_done()
+                return
+            try:
+                self.bot.process_new_updates([types.Update.de_json(update)])
+            except Exception as e:
+                print(f"\nОшибка обработки апдейта {update.get('update_id')} из вебхука: {e}")
+            finally:
+                self.updates.task_done()
+
+    def start(self) -> None:
+        """Start accepting updates."""
+        self._dispatcher_thread = threading.Thread(target=self._dispatch, name="WebhookDispatcher", daemon=True)
+        self._dispatcher_thread.start()
+        self._server_thread = threading.Thread(target=self.httpd.serve_forever, name="WebhookServer", daemon=True)
+        self._server_thread.start()
+
+    def request_stop(self) -> None:
+        """Ask `wait()` to return (from a handler or a signal handler)."""
+        self.stop_event.set()
+
+    def wait(self) -> None:
+        """Block until `request_stop()` is called."""
+        while not self.stop_event.wait(1):  # Ждем короткими интервалами, чтобы в главном потоке срабатывал Ctrl+C
+            pass
+
+    def stop(self) -> None:
+        """Stop accepting updates and pass the already queued ones to the bot."""
+        if self._server_thread is not None:
+            self.httpd.shutdown()
+            self._server_thread = None
+        self.httpd.server_close()
+        if self._dispatcher_thread is not None:
+            self.updates.put(None)
+            self._dispatcher_thread.join()
+            self._dispatcher_thread = None
+
+    def stats(self) -> dict:
+        """Return the number of received, rejected (queue full) and forbidden (wrong secret) requests and the queue length."""
+        with self.lock:
+            return {"received": self.received, "rejected": self.rejected, "forbidden": self.forbidden, "queued": self.pending_updates()}
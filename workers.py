@@ -0,0 +1,148 @@
+import queue
+import threading
+import traceback
+from collections import deque
+
+import telebot
+
+
+class KeyedWorkerPool:
+    """
+    Thread pool, which runs tasks with different keys in parallel and tasks with the same key strictly in order.
+
+    Each key has its own FIFO of pending tasks. Only one task of a key is running at a time, so a slow key
+    (e.g. a user waiting for a long completion) never blocks the other keys - unlike sharding keys between
+    single-thread queues, where users on the same shard would wait for each other.
+    """
+
+    def __init__(self, num_workers: int = 8, name: str = "KeyedWorker"):
+        self.num_workers = num_workers
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # notified when the last pending task is done
+        self._pending = {}  # key -> deque of (task, args, kwargs), the first one is running or scheduled
+        self._ready = queue.Queue()  # keys which have a task to run and no running task
+        self._task_count = 0  # tasks waiting or running of all keys
+        self._workers = []
+
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def put(self, key, task, *args, **kwargs) -> None:
+        """
+        Schedule the task. Tasks with the same key are executed in the order they were put.
+        Tasks with the `None` key are not ordered with anything.
+        """
+        if key is None:
+            key = object()  # Уникальный ключ - задача ни с чем не упорядочена
+
+        with self._lock:
+            self._task_count += 1
+            if key in self._pending:  # У ключа уже есть задача в работе, новая запустится после нее
+                self._pending[key].append((task, args, kwargs))
+                return
+            self._pending[key] = deque([(task, args, kwargs)])
+        self._ready.put(key)
+
+    def pending_count(self) -> int:
+        """Return the number of tasks waiting or running."""
+        with self._lock:
+            return self._task_count
+
+    def _run(self) -> None:
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+
+            with self._lock:
+                task, args, kwargs = self._pending[key][0]
+
+            try:
+                task(*args, **kwargs)
+            except Exception:
+                print(f"\nОшибка в обработчике:\n{traceback.format_exc()}")
+
+            with self._lock:
+                tasks = self._pending[key]
+                tasks.popleft()
+                self._task_count -= 1
+                if tasks:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+                    if not self._pending:
+                        self._idle.notify_all()
+
+    def close(self, wait: bool = True) -> None:
+        """Stop the workers after the already scheduled tasks are done."""
+        if wait:
+            with self._idle:
+                while self._pending:
+                    self._idle.wait()
+
+        for _ in self._workers:
+            self._ready.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+def get_update_order_key(obj):
+    """
+    Return the key to order the handler calls by: the id of the user who sent the message/callback,
+    or the chat id for the updates without a user (e.g. channel posts).
+    """
+    from_user = getattr(obj, "from_user", None)
+    if from_user is not None:
+        return from_user.id
+
+    chat = getattr(obj, "chat", None)
+    if chat is not None:
+        return chat.id
+
+    return None
+
+
+class OrderedTeleBot(telebot.TeleBot):
+    """
+    TeleBot which runs handlers in a `KeyedWorkerPool`: different users are served in parallel,
+    while the updates of the same user are processed strictly in order, so the chat context stays consistent.
+    """
+
+    def __init__(self, token: str, num_workers: int = 8, **kwargs):
+        # Встроенный пул потоков TeleBot не используется, все задачи уходят в KeyedWorkerPool
+        super().__init__(token, threaded=False, **kwargs)
+        self.keyed_worker_pool = KeyedWorkerPool(num_workers, name="HandlerWorker")
+        self._inline = threading.local()
+
+    def process_new_updates_inline(self, updates: list) -> None:
+        """
+        Process the updates in the calling thread instead of the worker pool,
+        for callers which keep the order of the updates themselves (the asyncio entry point).
+        """
+        self._inline.is_enabled = True
+        try:
+            self.process_new_updates(updates)
+        finally:
+            self._inline.is_enabled = False
+
+    def _exec_task(self, task, *args, **kwargs):
+        if getattr(self._inline, "is_enabled", False):
+            self._run_task(task, *args, **kwargs)
+            return
+        key = get_update_order_key(args[0]) if args else None
+        self.keyed_worker_pool.put(key, self._run_task, task, *args, **kwargs)
+
+    def stop_bot(self):
+        """Stop polling and wait until the already received updates are processed."""
+        super().stop_bot()
+        self.keyed_worker_pool.close()
+
+    def _run_task(self, task, *args, **kwargs):
+        try:
+            task(*args, **kwargs)
+        except Exception as e:
+            if not self._handle_exception(e):
+                raise